@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+"""
+Memory and time of loading the builders config with many appliances.
+
+Runs configure_builders with --appliances synthetic repositories, then
+again as a reconfig, and reports the time of each load, the resident
+memory of the process and the number of factories and steps created.
+
+--tree loads the package from another checkout, to compare two versions:
+
+    git worktree add /tmp/before <commit>
+    python benchmarks/config_load.py --tree /tmp/before --output before.json
+    python benchmarks/config_load.py --output after.json
+
+Needs buildbot, as on the master.
+"""
+import gc
+import json
+import os
+import platform
+import resource
+import sys
+import time
+from argparse import ArgumentParser
+
+
+def rss_kib():
+    """
+    Return the resident memory of the process in KiB.
+    """
+    try:
+        with open('/proc/self/status') as file_handle:
+            for line in file_handle:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+    # Peak instead of current, in KiB on Linux.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _measure(func):
+    """
+    Call func, return (seconds, resident memory after it in KiB).
+    """
+    gc.collect()
+    start = time.time()
+    func()
+    seconds = time.time() - start
+    gc.collect()
+    return seconds, rss_kib()
+
+
+def _config(appliances, slaves):
+    from buildbot.buildslave import BuildSlave
+    fc = dict(region='bench-1', location='bench-1a')
+    meta = {'public-ipv4': '192.0.2.1', 'local-ipv4': '10.0.0.1',
+            'public-hostname': 'master.example.com'}
+    repos = [('appliance-{:04d}'.format(index),
+              'https://git.example.com/appliance-{:04d}.git'.format(index),
+              'master')
+             for index in range(appliances)]
+    c = dict(slaves=[BuildSlave('slave-{}'.format(index), 'password')
+                     for index in range(slaves)])
+    return c, fc, repos, meta
+
+
+def main():
+    """
+    Main function.
+    """
+    parser = ArgumentParser(description='Measure the load of the builders '
+                                        'config.')
+    parser.add_argument('--appliances', type=int, default=500)
+    parser.add_argument('--slaves', type=int, default=4)
+    parser.add_argument('--tree', default=os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__))), help='checkout to load the package from')
+    parser.add_argument('--output', help='JSON file of the results')
+    args = parser.parse_args()
+
+    sys.path.insert(0, os.path.abspath(args.tree))
+    # The ec2buildslave shim of buildbot 0.8.12 deprecates its attribute
+    # in buildbot.libvirtbuildslave, which must be imported first.
+    import buildbot.libvirtbuildslave
+    gc.collect()
+    rss_start = rss_kib()
+    import_seconds, rss_imported = _measure(
+        lambda: __import__('outscale_factory_buildbot.buildbot.builders'))
+    from outscale_factory_buildbot.buildbot import builders
+
+    c, fc, repos, meta = _config(args.appliances, args.slaves)
+    load_seconds, rss_loaded = _measure(
+        lambda: builders.configure_builders(c, fc, repos, meta))
+    first = c['builders']
+
+    c, fc, repos, meta = _config(args.appliances, args.slaves)
+    reload_seconds, rss_reloaded = _measure(
+        lambda: builders.configure_builders(c, fc, repos, meta))
+
+    factories = dict((id(each.factory), each.factory)
+                     for each in first + c['builders'])
+    result = dict(
+        tree=os.path.abspath(args.tree),
+        python=platform.python_version(),
+        appliances=args.appliances,
+        builders=len(c['builders']),
+        factories=len(factories),
+        steps=sum(len(each.steps) for each in factories.values()),
+        import_seconds=import_seconds,
+        load_seconds=load_seconds,
+        reload_seconds=reload_seconds,
+        rss_start_kib=rss_start,
+        rss_imported_kib=rss_imported,
+        rss_loaded_kib=rss_loaded,
+        rss_reloaded_kib=rss_reloaded,
+        load_rss_kib=rss_loaded - rss_imported,
+    )
+    json.dump(result, sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write('\n')
+    if args.output:
+        with open(args.output, 'w') as file_handle:
+            json.dump(result, file_handle, indent=2, sort_keys=True)
+            file_handle.write('\n')
+
+if __name__ == '__main__':
+    main()
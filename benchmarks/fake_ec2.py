@@ -0,0 +1,606 @@
+"""
+Local fake of the EC2 query API, for the benchmarks.
+
+FakeEC2Server answers the subset of EC2 actions used by the package
+(images, snapshots, volumes, tags, instances, zones) from an in-memory
+state, over HTTP, so that boto, ec2_pool and the rate limiter run
+unchanged. Latency, throttling and the delay of state changes can be
+injected.
+"""
+import collections
+import fnmatch
+import itertools
+import random
+import threading
+import time
+import uuid
+from xml.sax.saxutils import escape
+
+from boto.ec2.connection import EC2Connection
+from boto.ec2.regioninfo import RegionInfo
+from boto.vendored.six.moves import BaseHTTPServer
+from boto.vendored.six.moves import socketserver
+from boto.vendored.six.moves.urllib.parse import parse_qs, urlparse
+
+
+OWNER_ID = '111122223333'
+ROOT_DEVICE = '/dev/sda1'
+XMLNS = 'http://ec2.amazonaws.com/doc/2014-10-01/'
+
+
+class FakeError(Exception):
+
+    """
+    EC2 error returned to the client.
+    """
+
+    def __init__(self, status, code, message=''):
+        Exception.__init__(self, message or code)
+        self.status = status
+        self.code = code
+
+
+def _timestamp(seconds):
+    return time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime(seconds))
+
+
+def _element(name, value):
+    if value is None:
+        return '<{}/>'.format(name)
+    return '<{0}>{1}</{0}>'.format(name, escape(str(value)))
+
+
+def _tag_set(tags):
+    return '<tagSet>{}</tagSet>'.format(''.join(
+        '<item>{}{}</item>'.format(_element('key', key),
+                                   _element('value', value))
+        for key, value in sorted(tags.items())))
+
+
+def _indexed(params, prefix):
+    """
+    Return the values of Prefix.1, Prefix.2... in order.
+    """
+    values = []
+    for index in itertools.count(1):
+        value = params.get('{}.{}'.format(prefix, index))
+        if value is None:
+            return values
+        values.append(value)
+
+
+def _filters(params):
+    """
+    Return dictionary of filter name -> list of values.
+    """
+    filters = {}
+    for index in itertools.count(1):
+        name = params.get('Filter.{}.Name'.format(index))
+        if name is None:
+            return filters
+        filters[name] = _indexed(params, 'Filter.{}.Value'.format(index))
+
+
+def _matches(values, value):
+    return any(fnmatch.fnmatchcase(value or '', each) for each in values)
+
+
+class FakeEC2(object):
+
+    """
+    In-memory EC2 state and the actions working on it.
+
+    latency: seconds added to every request
+    throttle_rate: requests per second accepted, 0 for no limit
+    throttle_burst: requests accepted at once above throttle_rate
+    throttle_probability: fraction of requests throttled at random
+    state_delay: seconds before a volume reaches its next state
+    """
+
+    def __init__(self,
+                 region='bench-1',
+                 latency=0,
+                 throttle_rate=0,
+                 throttle_burst=None,
+                 throttle_probability=0,
+                 state_delay=0,
+                 seed=0):
+        self.region = region
+        self.zone = region + 'a'
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.throttle_burst = throttle_burst or max(1, throttle_rate)
+        self.throttle_probability = throttle_probability
+        self.state_delay = state_delay
+        self.images = collections.OrderedDict()
+        self.snapshots = {}
+        self.volumes = {}
+        self.instances = {}
+        self.requests = collections.Counter()
+        self.throttled = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._tokens = float(self.throttle_burst)
+        self._updated = time.time()
+
+    def _new_id(self, prefix):
+        return '{}-{:08x}'.format(prefix, next(self._ids))
+
+    def seed(self, images, appliances=None, extra_tags=0, volumes=0,
+             instance_id='i-bench'):
+        """
+        Replace the state with images of appliances, each with a root
+        snapshot and extra_tags tags, volumes tagged like build volumes
+        and one running instance.
+
+        Images are spread over appliances in versions: with the default
+        of images / 10 appliances, each appliance has 10 versions.
+        """
+        appliances = appliances or max(1, images // 10)
+        with self._lock:
+            self.images.clear()
+            self.snapshots.clear()
+            self.volumes.clear()
+            self.instances.clear()
+            base = time.time() - images * 60
+            for index in range(images):
+                appliance = 'app-{:04d}'.format(index % appliances)
+                version = index // appliances
+                stamp = time.strftime('%y%m%d_%H%M',
+                                      time.localtime(base + version * 3600))
+                tags = dict(appliance=appliance,
+                            timestamp=stamp,
+                            revision=uuid.UUID(int=index).hex)
+                for tag in range(extra_tags):
+                    tags['tag-{}'.format(tag)] = 'value-{}'.format(tag)
+                snapshot_id = self._new_id('snap')
+                self.snapshots[snapshot_id] = dict(
+                    id=snapshot_id, volume_id=None, size=10,
+                    start_time=base, tags={})
+                image_id = self._new_id('ami')
+                self.images[image_id] = dict(
+                    id=image_id, name='{}_{}'.format(appliance, stamp),
+                    tags=tags, snapshot_id=snapshot_id, size=10,
+                    is_public=False)
+            for index in range(volumes):
+                volume_id = self._new_id('vol')
+                self.volumes[volume_id] = dict(
+                    id=volume_id, size=10, snapshot_id=None,
+                    zone=self.zone, status='available', created=base,
+                    attachment=None, next=None,
+                    tags=dict(slave='slave'))
+            self.instances[instance_id] = dict(id=instance_id,
+                                               state='running')
+
+    # Requests
+
+    def _throttle(self):
+        if self.throttle_probability and (self._random.random()
+                                          < self.throttle_probability):
+            return True
+        if not self.throttle_rate:
+            return False
+        now = time.time()
+        self._tokens = min(self.throttle_burst,
+                           self._tokens
+                           + (now - self._updated) * self.throttle_rate)
+        self._updated = now
+        if self._tokens < 1:
+            return True
+        self._tokens -= 1
+        return False
+
+    def handle(self, params):
+        """
+        Run the action of a request, return (HTTP status, XML body).
+        """
+        action = params.get('Action', '')
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            self.requests[action] += 1
+            try:
+                if self._throttle():
+                    self.throttled += 1
+                    raise FakeError(503, 'RequestLimitExceeded',
+                                    'Request limit exceeded.')
+                method = getattr(self, '_' + action, None)
+                if method is None:
+                    raise FakeError(400, 'InvalidAction',
+                                    'Unknown action {}'.format(action))
+                body = method(params)
+            except FakeError as error:
+                return error.status, (
+                    '<?xml version="1.0" encoding="UTF-8"?>\n<Response>'
+                    '<Errors><Error>{}{}</Error></Errors>{}</Response>'
+                    .format(_element('Code', error.code),
+                            _element('Message', str(error)),
+                            _element('RequestID', uuid.uuid4())))
+        return 200, (
+            '<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<{0}Response xmlns="{1}">{2}{3}</{0}Response>'
+            .format(action, XMLNS, _element('requestId', uuid.uuid4()), body))
+
+    # State changes
+
+    def _settle(self, volume):
+        """
+        Apply the pending state change of a volume, if due.
+        """
+        pending = volume['next']
+        if pending is not None and time.time() >= pending[0]:
+            volume['next'] = None
+            pending[1](volume)
+
+    def _later(self, volume, change):
+        volume['next'] = (time.time() + self.state_delay, change)
+        if not self.state_delay:
+            self._settle(volume)
+
+    def _volume(self, volume_id):
+        volume = self.volumes.get(volume_id)
+        if volume is None:
+            raise FakeError(400, 'InvalidVolume.NotFound',
+                            'The volume {} does not exist.'.format(volume_id))
+        self._settle(volume)
+        return volume
+
+    # Images
+
+    def _image_xml(self, image):
+        mapping = ('<blockDeviceMapping><item>{}<ebs>{}{}{}</ebs></item>'
+                   '</blockDeviceMapping>').format(
+            _element('deviceName', ROOT_DEVICE),
+            _element('snapshotId', image['snapshot_id']),
+            _element('volumeSize', image['size']),
+            _element('deleteOnTermination', 'true'))
+        return '<item>{}</item>'.format(''.join((
+            _element('imageId', image['id']),
+            _element('imageLocation', OWNER_ID + '/' + image['name']),
+            _element('imageState', 'available'),
+            _element('imageOwnerId', OWNER_ID),
+            _element('isPublic', 'true' if image['is_public'] else 'false'),
+            _element('architecture', 'x86_64'),
+            _element('imageType', 'machine'),
+            _element('name', image['name']),
+            _element('rootDeviceType', 'ebs'),
+            _element('rootDeviceName', ROOT_DEVICE),
+            mapping,
+            _element('virtualizationType', 'paravirtual'),
+            _tag_set(image['tags']))))
+
+    def _image_matches(self, image, filters):
+        for name, values in filters.items():
+            if name.startswith('tag:'):
+                if not _matches(values, image['tags'].get(name[4:])):
+                    return False
+            elif name == 'name':
+                if not _matches(values, image['name']):
+                    return False
+            elif name == 'image-id':
+                if image['id'] not in values:
+                    return False
+            elif name == 'is-public':
+                if ('true' if image['is_public'] else 'false') not in values:
+                    return False
+        return True
+
+    def _DescribeImages(self, params):
+        image_ids = _indexed(params, 'ImageId')
+        owners = _indexed(params, 'Owner')
+        if owners and not set(owners) & set(('self', OWNER_ID)):
+            images = []
+        elif image_ids:
+            missing = [each for each in image_ids if each not in self.images]
+            if missing:
+                raise FakeError(400, 'InvalidAMIID.NotFound',
+                                'The image id {} does not exist'
+                                .format(missing[0]))
+            images = [self.images[each] for each in image_ids]
+        else:
+            images = list(self.images.values())
+        filters = _filters(params)
+        images = [each for each in images
+                  if self._image_matches(each, filters)]
+
+        next_token = None
+        if params.get('MaxResults'):
+            start = int(params.get('NextToken') or 0)
+            end = start + int(params['MaxResults'])
+            if end < len(images):
+                next_token = str(end)
+            images = images[start:end]
+        return '<imagesSet>{}</imagesSet>{}'.format(
+            ''.join(self._image_xml(each) for each in images),
+            _element('nextToken', next_token) if next_token else '')
+
+    def _DeregisterImage(self, params):
+        image_id = params.get('ImageId')
+        if self.images.pop(image_id, None) is None:
+            raise FakeError(400, 'InvalidAMIID.NotFound',
+                            'The image id {} does not exist'.format(image_id))
+        return _element('return', 'true')
+
+    # Snapshots
+
+    def _DescribeSnapshots(self, params):
+        snapshot_ids = _indexed(params, 'SnapshotId')
+        snapshots = [self.snapshots[each] for each in snapshot_ids
+                     if each in self.snapshots] if snapshot_ids else \
+            list(self.snapshots.values())
+        return '<snapshotSet>{}</snapshotSet>'.format(''.join(
+            '<item>{}</item>'.format(''.join((
+                _element('snapshotId', each['id']),
+                _element('volumeId', each['volume_id']),
+                _element('status', 'completed'),
+                _element('startTime', _timestamp(each['start_time'])),
+                _element('progress', '100%'),
+                _element('ownerId', OWNER_ID),
+                _element('volumeSize', each['size']),
+                _element('description', ''),
+                _tag_set(each['tags']))))
+            for each in snapshots))
+
+    def _DeleteSnapshot(self, params):
+        snapshot_id = params.get('SnapshotId')
+        if self.snapshots.pop(snapshot_id, None) is None:
+            raise FakeError(400, 'InvalidSnapshot.NotFound',
+                            'The snapshot {} does not exist.'
+                            .format(snapshot_id))
+        return _element('return', 'true')
+
+    # Volumes
+
+    def _volume_xml(self, volume, top=False):
+        attachment = volume['attachment']
+        attachments = ''
+        if attachment is not None:
+            attachments = '<item>{}</item>'.format(''.join((
+                _element('volumeId', volume['id']),
+                _element('instanceId', attachment['instance_id']),
+                _element('device', attachment['device']),
+                _element('status', attachment['status']),
+                _element('attachTime', _timestamp(attachment['time'])),
+                _element('deleteOnTermination', 'false'))))
+        fields = ''.join((
+            _element('volumeId', volume['id']),
+            _element('size', volume['size']),
+            _element('snapshotId', volume['snapshot_id'] or ''),
+            _element('availabilityZone', volume['zone']),
+            _element('status', volume['status']),
+            _element('createTime', _timestamp(volume['created'])),
+            _element('volumeType', 'standard')))
+        if top:
+            return fields
+        return '<item>{}<attachmentSet>{}</attachmentSet>{}</item>'.format(
+            fields, attachments, _tag_set(volume['tags']))
+
+    def _volume_matches(self, volume, filters):
+        attachment = volume['attachment'] or {}
+        for name, values in filters.items():
+            if name.startswith('tag:'):
+                if not _matches(values, volume['tags'].get(name[4:])):
+                    return False
+            elif name == 'volume-id':
+                if volume['id'] not in values:
+                    return False
+            elif name == 'status':
+                if volume['status'] not in values:
+                    return False
+            elif name == 'attachment.instance-id':
+                if attachment.get('instance_id') not in values:
+                    return False
+        return True
+
+    def _DescribeVolumes(self, params):
+        volume_ids = _indexed(params, 'VolumeId')
+        if volume_ids:
+            volumes = [self._volume(each) for each in volume_ids]
+        else:
+            volumes = list(self.volumes.values())
+            for volume in volumes:
+                self._settle(volume)
+        filters = _filters(params)
+        return '<volumeSet>{}</volumeSet>'.format(''.join(
+            self._volume_xml(each) for each in volumes
+            if self._volume_matches(each, filters)))
+
+    def _CreateVolume(self, params):
+        snapshot_id = params.get('SnapshotId')
+        if snapshot_id and snapshot_id not in self.snapshots:
+            raise FakeError(400, 'InvalidSnapshot.NotFound',
+                            'The snapshot {} does not exist.'
+                            .format(snapshot_id))
+        volume_id = self._new_id('vol')
+        volume = self.volumes[volume_id] = dict(
+            id=volume_id, size=int(params.get('Size') or 10),
+            snapshot_id=snapshot_id, zone=params.get('AvailabilityZone'),
+            status='creating', created=time.time(), attachment=None,
+            next=None, tags={})
+        body = self._volume_xml(volume, top=True)
+
+        def available(volume):
+            volume['status'] = 'available'
+        self._later(volume, available)
+        return body
+
+    def _AttachVolume(self, params):
+        volume = self._volume(params.get('VolumeId'))
+        instance_id = params.get('InstanceId')
+        if instance_id not in self.instances:
+            raise FakeError(400, 'InvalidInstanceID.NotFound',
+                            'The instance {} does not exist'
+                            .format(instance_id))
+        if volume['status'] != 'available':
+            raise FakeError(400, 'IncorrectState',
+                            'Volume {} is {}'.format(volume['id'],
+                                                     volume['status']))
+        volume['status'] = 'in-use'
+        volume['attachment'] = dict(instance_id=instance_id,
+                                    device=params.get('Device'),
+                                    status='attaching', time=time.time())
+
+        def attached(volume):
+            volume['attachment']['status'] = 'attached'
+        self._later(volume, attached)
+        return _element('return', 'true')
+
+    def _DetachVolume(self, params):
+        volume = self._volume(params.get('VolumeId'))
+        if volume['attachment'] is None:
+            raise FakeError(400, 'IncorrectState',
+                            'Volume {} is not attached'.format(volume['id']))
+        volume['attachment']['status'] = 'detaching'
+
+        def detached(volume):
+            volume['attachment'] = None
+            volume['status'] = 'available'
+        self._later(volume, detached)
+        return _element('return', 'true')
+
+    def _DeleteVolume(self, params):
+        volume = self._volume(params.get('VolumeId'))
+        if volume['status'] != 'available':
+            raise FakeError(400, 'VolumeInUse',
+                            'Volume {} is {}'.format(volume['id'],
+                                                     volume['status']))
+        del self.volumes[volume['id']]
+        return _element('return', 'true')
+
+    # Tags, instances, zones
+
+    def _CreateTags(self, params):
+        keys = []
+        values = []
+        for index in itertools.count(1):
+            key = params.get('Tag.{}.Key'.format(index))
+            if key is None:
+                break
+            keys.append(key)
+            values.append(params.get('Tag.{}.Value'.format(index), ''))
+        tags = dict(zip(keys, values))
+        for resource_id in _indexed(params, 'ResourceId'):
+            for collection in self.images, self.volumes, self.snapshots:
+                if resource_id in collection:
+                    collection[resource_id]['tags'].update(tags)
+                    break
+            else:
+                raise FakeError(400, 'InvalidID',
+                                'The ID {} is not valid'.format(resource_id))
+        return _element('return', 'true')
+
+    def _instance_xml(self, instance):
+        devices = ['<item>{}<ebs>{}{}</ebs></item>'.format(
+            _element('deviceName', ROOT_DEVICE),
+            _element('volumeId', 'vol-root'),
+            _element('status', 'attached'))]
+        for volume in self.volumes.values():
+            attachment = volume['attachment']
+            if attachment and attachment['instance_id'] == instance['id']:
+                devices.append('<item>{}<ebs>{}{}</ebs></item>'.format(
+                    _element('deviceName', attachment['device']),
+                    _element('volumeId', volume['id']),
+                    _element('status', attachment['status'])))
+        return '<item>{}<instanceState>{}{}</instanceState>{}{}' \
+            '<blockDeviceMapping>{}</blockDeviceMapping></item>'.format(
+                _element('instanceId', instance['id']),
+                _element('code', 16),
+                _element('name', instance['state']),
+                _element('instanceType', 'm1.small'),
+                _element('rootDeviceName', ROOT_DEVICE),
+                ''.join(devices))
+
+    def _DescribeInstances(self, params):
+        instance_ids = _indexed(params, 'InstanceId')
+        filters = _filters(params)
+        instance_ids = instance_ids or filters.get('instance-id')
+        states = filters.get('instance-state-name')
+        instances = [each for each in self.instances.values()
+                     if (not instance_ids or each['id'] in instance_ids)
+                     and (not states or each['state'] in states)]
+        if not instances:
+            return '<reservationSet/>'
+        return ('<reservationSet><item>{}{}<groupSet/><instancesSet>{}'
+                '</instancesSet></item></reservationSet>').format(
+            _element('reservationId', 'r-bench'),
+            _element('ownerId', OWNER_ID),
+            ''.join(self._instance_xml(each) for each in instances))
+
+    def _DescribeAvailabilityZones(self, params):
+        return '<availabilityZoneInfo><item>{}{}{}</item>' \
+            '</availabilityZoneInfo>'.format(
+                _element('zoneName', self.zone),
+                _element('zoneState', 'available'),
+                _element('regionName', self.region))
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def _respond(self, query):
+        params = dict((key, values[0]) for key, values
+                      in parse_qs(query, keep_blank_values=True).items())
+        status, body = self.server.ec2.handle(params)
+        data = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/xml;charset=UTF-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        self._respond(urlparse(self.path).query)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length)
+        if isinstance(body, bytes):
+            body = body.decode('utf-8')
+        query = urlparse(self.path).query
+        self._respond('&'.join(part for part in (query, body) if part))
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _Server(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    daemon_threads = True
+
+
+class FakeEC2Server(object):
+
+    """
+    HTTP server answering EC2 requests from a FakeEC2, on localhost.
+    """
+
+    def __init__(self, ec2):
+        self.ec2 = ec2
+        self._server = _Server(('127.0.0.1', 0), _Handler)
+        self._server.ec2 = ec2
+        self.port = self._server.server_address[1]
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def connect(self, region):
+        """
+        Return a boto connection to the server, for ec2_pool.configure.
+        """
+        return EC2Connection(
+            aws_access_key_id='bench',
+            aws_secret_access_key='bench',
+            region=RegionInfo(name=region, endpoint='127.0.0.1'),
+            port=self.port,
+            is_secure=False,
+            proxy=None)
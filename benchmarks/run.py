@@ -0,0 +1,427 @@
+#!/usr/bin/env python
+"""
+Benchmarks of the image and volume code paths against a local fake EC2.
+
+Each benchmark runs at every image count of --sizes against a freshly
+seeded FakeEC2, --repeat times. The durations, the EC2 requests made and
+the throttled requests are written as JSON to --output, and compared with
+the results of a previous run given with --compare.
+
+The buildstep benchmarks need buildbot; they are reported as skipped
+when it cannot be imported.
+
+Usage:
+    python benchmarks/run.py --sizes 100,1000,10000 --output results.json
+    python benchmarks/run.py --compare results.json --output new.json \
+        --max-regression 0.2
+"""
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import threading
+import time
+from argparse import ArgumentParser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import boto
+
+import fake_ec2
+from outscale_factory_buildbot.tools import delete_images
+from outscale_factory_buildbot.tools import ec2_pool
+from outscale_factory_buildbot.tools import find_images
+from outscale_factory_buildbot.tools import get_image
+from outscale_factory_buildbot.tools import image_cache
+from outscale_factory_buildbot.tools import ratelimit
+from outscale_factory_buildbot.tools import volumes
+
+
+REGION = 'bench-1'
+INSTANCE_ID = 'i-bench'
+MAX_VERSIONS = 2
+
+# Seconds between two volume state checks of the benchmarks.
+POLL_INTERVAL_SECONDS = 0.01
+
+
+class Skip(Exception):
+
+    """
+    Error raised when a benchmark cannot run here.
+    """
+
+
+class Context(object):
+
+    """
+    Fake EC2 of a benchmark run, and its options.
+    """
+
+    def __init__(self, ec2, args):
+        self.ec2 = ec2
+        self.args = args
+
+    def seed(self, images):
+        self.ec2.seed(images,
+                      appliances=self.args.appliances or None,
+                      extra_tags=self.args.extra_tags,
+                      volumes=self.args.volumes,
+                      instance_id=INSTANCE_ID)
+        image_cache.invalidate()
+
+    def appliance(self):
+        return 'app-0001'
+
+
+def _wait_volume(conn, volume_id, status, attachment=None):
+    while True:
+        current, current_attachment = volumes.volume_status(conn, volume_id)
+        if current == status and (attachment is None
+                                  or current_attachment == attachment):
+            return
+        time.sleep(POLL_INTERVAL_SECONDS)
+
+
+# Benchmarks: functions taking the context, returning a dictionary of
+# counts checked and reported with the durations.
+
+def bench_find_images_cold(ctx):
+    images = find_images.find_images(REGION,
+                                     tags=dict(appliance=ctx.appliance()),
+                                     owners=['self'])
+    return dict(found=len(images))
+
+
+def bench_find_images_warm(ctx):
+    find_images.find_images(REGION, owners=['self'])
+    start = time.time()
+    images = find_images.find_images(REGION,
+                                     tags=dict(appliance=ctx.appliance()),
+                                     owners=['self'])
+    return dict(found=len(images), cached_seconds=time.time() - start)
+
+
+def bench_list_all_images(ctx):
+    count = 0
+    for _ in find_images.iter_images(REGION, owners=['self'],
+                                     page_size=ctx.args.page_size):
+        count += 1
+    return dict(found=count)
+
+
+def bench_get_image_id(ctx):
+    image_id = get_image.get_image_id(REGION, ctx.appliance() + '_*')
+    return dict(found=int(bool(image_id)))
+
+
+def bench_delete_images(ctx):
+    count = max(10, len(ctx.ec2.images) // 10)
+    image_ids = list(ctx.ec2.images)[:count]
+    report = delete_images.delete_images(REGION, image_ids,
+                                         concurrency=ctx.args.concurrency)
+    return dict(deleted=len(report.deleted), failed=len(report.failed))
+
+
+def bench_delete_old_images(ctx):
+    report = delete_images.delete_old_images(REGION, ctx.appliance(),
+                                             MAX_VERSIONS)
+    return dict(deleted=len(report.deleted), failed=len(report.failed))
+
+
+def bench_volume_lifecycle(ctx):
+    with ec2_pool.connection(REGION) as conn:
+        volume_id = volumes.create_volume(conn, 10, ctx.ec2.zone,
+                                          dict(slave='slave'))
+        _wait_volume(conn, volume_id, 'available')
+        volumes.attach_volume(conn, volume_id, INSTANCE_ID)
+        _wait_volume(conn, volume_id, 'in-use', 'attached')
+        volumes.detach_volume(conn, volume_id)
+        _wait_volume(conn, volume_id, 'available')
+        volumes.delete_volume(conn, volume_id)
+    return dict(volumes=1)
+
+
+class _Reactor(object):
+
+    """
+    Twisted reactor running in a thread, for the buildstep benchmarks.
+    """
+
+    _thread = None
+
+    def call(self, func, *args):
+        """
+        Call func(*args) in the reactor, wait for its Deferred.
+        """
+        from twisted.internet import reactor, threads
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=reactor.run, kwargs=dict(installSignalHandlers=False))
+            self._thread.daemon = True
+            self._thread.start()
+        return threads.blockingCallFromThread(reactor, func, *args)
+
+    def stop(self):
+        if self._thread is not None:
+            from twisted.internet import reactor
+            reactor.callFromThread(reactor.stop)
+            self._thread.join()
+
+
+_reactor = _Reactor()
+
+
+def _buildsteps():
+    try:
+        # The ec2buildslave shim of buildbot 0.8.12 deprecates its
+        # attribute in buildbot.libvirtbuildslave, which must be imported
+        # first.
+        import buildbot.libvirtbuildslave
+        from outscale_factory_buildbot.buildbot import buildsteps
+    except ImportError as error:
+        raise Skip('buildsteps not importable: {}'.format(error))
+    buildsteps.POLL_INTERVAL_SECONDS = POLL_INTERVAL_SECONDS
+    return buildsteps
+
+
+def _step(cls, properties, **kw):
+    """
+    Return a step of a build with properties.
+    """
+    from buildbot.process.properties import Properties
+    step = cls(region=REGION, location=REGION + 'a', **kw)
+    # The properties of a step are those of its build.
+    step.build = Properties(**properties)
+    return step
+
+
+def bench_step_destroy_old_images(ctx):
+    buildsteps = _buildsteps()
+    step = _step(buildsteps.DestroyOldImages, {},
+                 appliance=ctx.appliance(),
+                 maxApplianceVersions=MAX_VERSIONS)
+    ok, error = step._destroy_old_images()
+    if not ok:
+        raise RuntimeError(error)
+    return dict(remaining=len(ctx.ec2.images))
+
+
+def bench_step_volume(ctx):
+    buildsteps = _buildsteps()
+    step = _step(buildsteps.AttachNewVolume,
+                 dict(instance_id=INSTANCE_ID, appliance=ctx.appliance()))
+    _reactor.call(step._provision, INSTANCE_ID)
+    _reactor.call(buildsteps._destroy_volume,
+                  dict(region=REGION,
+                       volume_id=step.getProperty('volume_id')))
+    return dict(volumes=1)
+
+
+BENCHMARKS = [
+    ('find_images_cold', bench_find_images_cold),
+    ('find_images_warm', bench_find_images_warm),
+    ('list_all_images', bench_list_all_images),
+    ('get_image_id', bench_get_image_id),
+    ('delete_images', bench_delete_images),
+    ('delete_old_images', bench_delete_old_images),
+    ('volume_lifecycle', bench_volume_lifecycle),
+    ('step_destroy_old_images', bench_step_destroy_old_images),
+    ('step_volume', bench_step_volume),
+]
+
+
+def _median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def run_benchmark(ctx, name, func, images, repeat):
+    """
+    Run a benchmark repeat times on a fresh state, return its result.
+    """
+    seconds = []
+    requests = {}
+    throttled = 0
+    counts = {}
+    for _ in range(repeat):
+        ctx.seed(images)
+        before = dict(ctx.ec2.requests)
+        throttled_before = ctx.ec2.throttled
+        start = time.time()
+        try:
+            counts = func(ctx)
+        except Skip as error:
+            return dict(name=name, images=images, status='skipped',
+                        reason=str(error))
+        except Exception as error:
+            logging.exception('Benchmark {} failed'.format(name))
+            return dict(name=name, images=images, status='failed',
+                        reason=repr(error))
+        seconds.append(time.time() - start)
+        for action, count in ctx.ec2.requests.items():
+            requests[action] = (requests.get(action, 0)
+                                + count - before.get(action, 0))
+        throttled += ctx.ec2.throttled - throttled_before
+    return dict(
+        name=name,
+        images=images,
+        status='ok',
+        repeat=repeat,
+        seconds=seconds,
+        min_seconds=min(seconds),
+        median_seconds=_median(seconds),
+        max_seconds=max(seconds),
+        requests=dict((action, float(count) / repeat)
+                      for action, count in requests.items() if count),
+        throttled=float(throttled) / repeat,
+        counts=counts,
+    )
+
+
+def _git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.STDOUT).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, previous, max_regression=None):
+    """
+    Print the ratio of median durations to a previous run.
+
+    Return the benchmarks slower than 1 + max_regression times.
+    """
+    old = dict(((each['name'], each['images']), each)
+               for each in previous['results'] if each['status'] == 'ok')
+    regressions = []
+    sys.stdout.write('{:<26} {:>6} {:>10} {:>10} {:>7}\n'.format(
+        'benchmark', 'images', 'before', 'after', 'ratio'))
+    for each in results:
+        before = old.get((each['name'], each['images']))
+        if each['status'] != 'ok' or before is None:
+            continue
+        ratio = each['median_seconds'] / max(before['median_seconds'], 1e-9)
+        flag = ''
+        if max_regression is not None and ratio > 1 + max_regression:
+            regressions.append(each)
+            flag = '  REGRESSION'
+        sys.stdout.write('{:<26} {:>6} {:>9.4f}s {:>9.4f}s {:>6.2f}x{}\n'
+                         .format(each['name'], each['images'],
+                                 before['median_seconds'],
+                                 each['median_seconds'], ratio, flag))
+    return regressions
+
+
+def main():
+    """
+    Main function.
+    """
+    parser = ArgumentParser(description='Benchmark the package against a '
+                                        'local fake EC2.')
+    parser.add_argument('--sizes', default='100,1000,10000',
+                        help='image counts, comma separated')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--only', action='append',
+                        help='benchmark to run, can be repeated')
+    parser.add_argument('--appliances', type=int, default=0,
+                        help='appliances the images belong to '
+                             '(default: images / 10)')
+    parser.add_argument('--extra-tags', type=int, default=2,
+                        help='tags added to every image')
+    parser.add_argument('--volumes', type=int, default=10,
+                        help='build volumes in the fake cloud')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='seconds added to every request')
+    parser.add_argument('--throttle-rate', type=float, default=0,
+                        help='requests per second accepted by the fake '
+                             'cloud, 0 for no limit')
+    parser.add_argument('--throttle-burst', type=int, default=None)
+    parser.add_argument('--throttle-probability', type=float, default=0,
+                        help='fraction of requests throttled at random')
+    parser.add_argument('--state-delay', type=float, default=0,
+                        help='seconds before volumes change state')
+    parser.add_argument('--client-rate', type=float, default=1000,
+                        help='initial rate of the EC2 rate limiter')
+    parser.add_argument('--concurrency', type=int,
+                        default=delete_images.DEFAULT_CONCURRENCY)
+    parser.add_argument('--page-size', type=int, default=1000)
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--compare', help='results of a previous run')
+    parser.add_argument('--max-regression', type=float, default=None,
+                        help='exit with an error when a median is this '
+                             'fraction slower than in --compare')
+    args = parser.parse_args()
+
+    # Read before the results are written: --output must not replace the
+    # run compared with.
+    previous = None
+    if args.compare:
+        if os.path.realpath(args.compare) == os.path.realpath(args.output):
+            parser.error('--compare and --output are the same file, give '
+                         'another --output')
+        with open(args.compare) as file_handle:
+            previous = json.load(file_handle)
+
+    logging.basicConfig(format='%(levelname)s: %(message)s',
+                        level=logging.WARNING)
+    sizes = [int(each) for each in args.sizes.split(',') if each]
+    benchmarks = [(name, func) for name, func in BENCHMARKS
+                  if not args.only or name in args.only]
+
+    ec2 = fake_ec2.FakeEC2(region=REGION,
+                           latency=args.latency,
+                           throttle_rate=args.throttle_rate,
+                           throttle_burst=args.throttle_burst,
+                           throttle_probability=args.throttle_probability,
+                           state_delay=args.state_delay)
+    server = fake_ec2.FakeEC2Server(ec2).start()
+    ec2_pool.configure(connect=server.connect)
+    burst = max(1, int(args.client_rate))
+    ratelimit.configure(describe_rate=args.client_rate, describe_burst=burst,
+                        mutate_rate=args.client_rate, mutate_burst=burst)
+    ctx = Context(ec2, args)
+
+    results = []
+    try:
+        for images in sizes:
+            for name, func in benchmarks:
+                result = run_benchmark(ctx, name, func, images, args.repeat)
+                results.append(result)
+                if result['status'] == 'ok':
+                    sys.stderr.write('{:<26} {:>6} images {:>9.4f}s\n'.format(
+                        name, images, result['median_seconds']))
+                else:
+                    sys.stderr.write('{:<26} {:>6} images {}: {}\n'.format(
+                        name, images, result['status'], result['reason']))
+    finally:
+        _reactor.stop()
+        server.stop()
+
+    output = dict(
+        created_at=time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        git_revision=_git_revision(),
+        python=platform.python_version(),
+        boto=boto.__version__,
+        options=vars(args),
+        rate_limiter=ratelimit.stats(),
+        results=results,
+    )
+    with open(args.output, 'w') as file_handle:
+        json.dump(output, file_handle, indent=2, sort_keys=True)
+        file_handle.write('\n')
+
+    if previous is not None:
+        if compare(results, previous, args.max_regression):
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+"""
+Cache-locality-aware slave selection.
+
+A slave which built an appliance recently still has its Git checkout and
+fab cache, so rebuilding the appliance there is faster. The selector
+remembers which slave last built each builder, and prefers that slave
+among equally available ones.
+
+A latent slave which was stopped since has lost its disk, it is not
+considered warm.
+"""
+import time
+
+from twisted.internet import reactor
+
+from buildbot.process import slavebuilder
+
+
+# Slave builder states, from least to most preferred.
+PREFERRED_STATES = [
+    slavebuilder.PINGING, # build about to start, making sure it is still alive
+    slavebuilder.ATTACHING, # slave attached, still checking hostinfo/etc
+    slavebuilder.SUBSTANTIATING,
+    slavebuilder.BUILDING, # build is running
+    slavebuilder.LATENT, # latent slave is not substantiated; similar to idle
+    slavebuilder.IDLE, # idle, available for use
+]
+
+STATE_RANK = dict((state, rank) for rank, state in enumerate(PREFERRED_STATES))
+
+
+class SlaveSelector(object):
+
+    """
+    Pick slaves by state, then by warm workdir.
+
+    max_wait: seconds a request may wait for a busy warm slave while
+        another slave is free, 0 to never wait.
+    max_age: seconds after which a workdir is considered cold.
+    """
+
+    def __init__(self, max_wait=0, max_age=24 * 3600):
+        self.max_wait = max_wait
+        self.max_age = max_age
+        self._last_built = {}
+        self._waiting_since = {}
+        self._wakeups = {}
+
+    def _warm_since(self, sb, buildername, now):
+        """
+        Return when the slave last built buildername if its workdir is
+        still warm, else 0.
+        """
+        built = self._last_built.get((sb.slave.slavename, buildername))
+        if built is None or now - built > self.max_age:
+            return 0
+        if sb.state == slavebuilder.LATENT:
+            return 0
+        return built
+
+    def choose(self, builder, slave_builders, now=None):
+        """
+        Return the slave builder to use, or None to wait.
+        """
+        now = time.time() if now is None else now
+        name = builder.name
+        best = max(slave_builders,
+                   key=lambda sb: (STATE_RANK[sb.state],
+                                   self._warm_since(sb, name, now)))
+
+        if self.max_wait > 0 and not self._warm_since(best, name, now):
+            # A warm slave may be busy and absent from slave_builders.
+            busy_warm = [sb for sb in getattr(builder, 'slaves', [])
+                         if sb not in slave_builders
+                         and self._warm_since(sb, name, now)]
+            if busy_warm:
+                since = self._waiting_since.setdefault(name, now)
+                if now - since < self.max_wait:
+                    self._wake_up_later(builder, since + self.max_wait - now)
+                    return None
+
+        self._waiting_since.pop(name, None)
+        self._last_built[(best.slave.slavename, name)] = now
+        return best
+
+    def _wake_up_later(self, builder, delay):
+        """
+        Make buildbot retry the builder once the wait cap is reached.
+        """
+        call = self._wakeups.get(builder.name)
+        if call is not None and call.active():
+            return
+        self._wakeups[builder.name] = reactor.callLater(
+            delay,
+            builder.master.botmaster.maybeStartBuildsForBuilder,
+            builder.name)
@@ -0,0 +1,211 @@
+"""
+Capacity controller for EC2 latent buildslaves.
+
+Buildbot substantiates a latent slave for every build it can start, and
+stops it build_wait_timeout seconds after its last build. The controller
+watches pending build requests and slave states, and decides:
+    - how many slaves may be substantiated at the same time (the target),
+    - how long each slave is kept warm after a build.
+
+Below scale_up_backlog pending builds, the target only grows up to the
+slaves already running, or to one slave when none runs. It grows to the
+demand as soon as the backlog reaches scale_up_backlog, and only shrinks
+after demand stayed lower for scale_down_delay seconds.
+"""
+import logging
+import time
+
+from twisted.internet import defer, task
+
+
+class CapacityController(object):
+
+    """
+    Decide how many latent slaves to run, between min_slaves and max_slaves.
+    """
+
+    def __init__(self,
+                 min_slaves=0,
+                 max_slaves=1,
+                 scale_up_backlog=1,
+                 scale_down_delay=600,
+                 idle_timeout=60,
+                 busy_timeout=600,
+                 interval=30):
+        self.min_slaves = min_slaves
+        self.max_slaves = max_slaves
+        self.scale_up_backlog = scale_up_backlog
+        self.scale_down_delay = scale_down_delay
+        self.idle_timeout = idle_timeout
+        self.busy_timeout = busy_timeout
+        self.interval = interval
+        self.target = min_slaves
+        self.pending = 0
+        self.slavenames = []
+        self._low_since = None
+        self._master = None
+        self._loop = None
+
+    def register(self, slave):
+        """
+        Put a latent slave under control.
+
+        Slaves are tracked by name: on reconfig, buildbot keeps the running
+        slave objects and drops the new ones.
+        """
+        self.slavenames.append(slave.slavename)
+        slave.build_wait_timeout = self.idle_timeout
+
+    def _slaves(self):
+        """
+        Return the running slave objects, in registration order.
+        """
+        if self._master is None:
+            return []
+        slaves = self._master.botmaster.slaves
+        return [slaves[name] for name in self.slavenames if name in slaves]
+
+    def _active(self, slave):
+        return bool(slave.substantiated
+                    or slave.substantiation_deferred is not None)
+
+    def active_count(self):
+        """
+        Return the number of substantiated or substantiating slaves.
+        """
+        return len([slave for slave in self._slaves() if self._active(slave)])
+
+    def may_substantiate(self, slave):
+        """
+        Return True if a build may start on slave.
+        """
+        if slave.slavename not in self.slavenames or self._active(slave):
+            return True
+        # A build is waiting: never leave it without any slave.
+        active = self.active_count()
+        return active == 0 or active < self.target
+
+    def update(self, pending, now=None):
+        """
+        Update the target from the number of pending build requests.
+
+        Return True if the target grew.
+        """
+        now = time.time() if now is None else now
+        self.pending = pending
+        slaves = self._slaves()
+        busy = len([slave for slave in slaves if slave.building])
+        wanted = max(self.min_slaves, min(self.max_slaves, busy + pending))
+        grew = False
+
+        if wanted > self.target:
+            target = wanted
+            if pending < self.scale_up_backlog:
+                # The backlog threshold only applies above the running
+                # slaves, and a pending build always gets one slave.
+                running = len([slave for slave in slaves
+                               if self._active(slave)])
+                target = min(wanted, max(running, 1 if pending else 0))
+            if target > self.target:
+                logging.info('Scaling up slaves from {} to {}'
+                             .format(self.target, target))
+                self.target = target
+                grew = True
+            self._low_since = None
+        elif wanted < self.target:
+            if self._low_since is None:
+                self._low_since = now
+            elif now - self._low_since >= self.scale_down_delay:
+                logging.info('Scaling down slaves from {} to {}'
+                             .format(self.target, wanted))
+                self.target = wanted
+                self._low_since = None
+        else:
+            self._low_since = None
+
+        # Slaves within the target are kept warm between builds.
+        for index, slave in enumerate(slaves):
+            if index < self.target and pending:
+                slave.build_wait_timeout = self.busy_timeout
+            else:
+                slave.build_wait_timeout = self.idle_timeout
+        return grew
+
+    def watch(self, master):
+        """
+        Start polling the build request backlog of master.
+        """
+        if self._master is master:
+            return
+        self.stop()
+        self._master = master
+        self._loop = task.LoopingCall(self._poll)
+        d = self._loop.start(self.interval, now=True)
+        d.addErrback(lambda f: logging.error('Slave autoscaling stopped: {}'
+                                             .format(f.getErrorMessage())))
+
+    def stop(self):
+        """
+        Stop polling.
+        """
+        if self._loop is not None and self._loop.running:
+            self._loop.stop()
+        self._loop = None
+        self._master = None
+
+    @defer.inlineCallbacks
+    def _poll(self):
+        try:
+            requests = yield self._master.db.buildrequests.getBuildRequests(
+                claimed=False, complete=False)
+        except Exception as error:
+            logging.error('Could not count pending builds: {}'.format(error))
+            return
+        if self.update(len(requests)):
+            self._master.botmaster.maybeStartBuildsForAllBuilders()
+
+    def stats(self):
+        """
+        Return controller state.
+        """
+        return dict(
+            target=self.target,
+            active=self.active_count(),
+            pending=self.pending,
+            min_slaves=self.min_slaves,
+            max_slaves=self.max_slaves,
+        )
+
+
+_controller = None
+
+
+def configure(controller):
+    """
+    Install the controller used by builders._choose_slave, or None.
+    """
+    global _controller
+    if _controller is not None:
+        _controller.stop()
+    _controller = controller
+
+
+def get_controller():
+    return _controller
+
+
+def may_substantiate(slave):
+    """
+    Return True if a build may start on slave.
+    """
+    if _controller is None:
+        return True
+    return _controller.may_substantiate(slave)
+
+
+def watch(master):
+    """
+    Make the controller follow the backlog of master.
+    """
+    if _controller is not None:
+        _controller.watch(master)
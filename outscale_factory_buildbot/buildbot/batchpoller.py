@@ -0,0 +1,232 @@
+"""
+Single change source polling all appliance repositories.
+
+One GitPoller per appliance starts N git fetch processes at the same time
+every interval. BatchGitPoller polls each repository URL once, however many
+appliances use it, with a bounded number of concurrent polls spread evenly
+over the interval. Heads are checked with git ls-remote; a repository is
+only fetched when one of its polled branches moved.
+"""
+import logging
+import os
+import random
+
+from twisted.internet import defer, reactor, task
+
+from buildbot.changes import base
+from buildbot.util import epoch2datetime
+from buildbot.util.state import StateMixin
+
+from outscale_factory_buildbot.buildbot.gitmirror import run_git
+
+
+class BatchGitPoller(base.ChangeSource, StateMixin):
+
+    """
+    Poll a list of (appliance, repourl, branch) entries.
+
+    Changes are reported with the appliance as project, as GitPoller did.
+    """
+
+    compare_attrs = ['repos', 'pollInterval', 'maxConcurrent', 'jitter',
+                     'workdir']
+
+    def __init__(self, repos, pollInterval=10 * 60, maxConcurrent=4,
+                 jitter=0.5, workdir='gitpollers', mirrors=None,
+                 gitbin='git'):
+        self.name = 'BatchGitPoller'
+        self.repos = sorted(tuple(each) for each in repos)
+        self.pollInterval = pollInterval
+        self.maxConcurrent = maxConcurrent
+        self.jitter = jitter
+        self.workdir = workdir
+        self.mirrors = mirrors
+        self.gitbin = gitbin
+        self.lastRev = {}
+        self.latency = {}
+        self._projects = {}
+        for appliance, repourl, branch in self.repos:
+            self._projects.setdefault(repourl, {}).setdefault(
+                branch, []).append(appliance)
+        self._semaphore = defer.DeferredSemaphore(maxConcurrent)
+        self._calls = []
+        self._loops = []
+
+    def describe(self):
+        return ('BatchGitPoller watching {} repositories for {} appliances'
+                .format(len(self._projects), len(self.repos)))
+
+    @defer.inlineCallbacks
+    def startService(self):
+        if not os.path.isabs(self.workdir):
+            self.workdir = os.path.join(self.master.basedir, self.workdir)
+        self.lastRev = yield self.getState('lastRev', {})
+        base.ChangeSource.startService(self)
+
+        # Spread first polls evenly over the interval, with some jitter.
+        urls = sorted(self._projects)
+        step = float(self.pollInterval) / max(1, len(urls))
+        for index, url in enumerate(urls):
+            delay = index * step + random.uniform(0, step * self.jitter)
+            self._calls.append(reactor.callLater(delay, self._start_loop, url))
+
+    def stopService(self):
+        for call in self._calls:
+            if call.active():
+                call.cancel()
+        for loop in self._loops:
+            if loop.running:
+                loop.stop()
+        self._calls = []
+        self._loops = []
+        return base.ChangeSource.stopService(self)
+
+    def _start_loop(self, url):
+        loop = task.LoopingCall(self._poll_guarded, url)
+        self._loops.append(loop)
+        loop.start(self.pollInterval, now=True)
+
+    def _poll_guarded(self, url):
+        d = self._semaphore.run(self._poll_url, url)
+        d.addErrback(lambda f: logging.error('Could not poll {}: {}'
+                                             .format(url, f.getErrorMessage())))
+        return d
+
+    @defer.inlineCallbacks
+    def _poll_url(self, url):
+        """
+        Poll one repository URL for all its branches.
+        """
+        start = reactor.seconds()
+        ok = False
+        try:
+            heads = yield self._ls_remote(url)
+            last = self.lastRev.setdefault(url, {})
+            moved = [branch for branch in self._projects[url]
+                     if heads.get(branch) and heads[branch] != last.get(branch)]
+            if moved:
+                workdir = yield self._fetch(url, moved)
+                for branch in moved:
+                    yield self._process_branch(url, workdir, branch,
+                                               last.get(branch), heads[branch])
+                yield self.setState('lastRev', self.lastRev)
+            ok = True
+        finally:
+            self._record_latency(url, reactor.seconds() - start, ok)
+
+    def _record_latency(self, url, seconds, ok):
+        stats = self.latency.setdefault(url, dict(
+            polls=0, failures=0, last_seconds=0.0, max_seconds=0.0,
+            total_seconds=0.0))
+        stats['polls'] += 1
+        if not ok:
+            stats['failures'] += 1
+        stats['last_seconds'] = seconds
+        stats['max_seconds'] = max(stats['max_seconds'], seconds)
+        stats['total_seconds'] += seconds
+        logging.debug('Polled {} in {:.2f}s'.format(url, seconds))
+
+    @defer.inlineCallbacks
+    def _ls_remote(self, url):
+        """
+        Return a dictionary of branch name -> head revision.
+        """
+        output = yield run_git(['ls-remote', '--heads', url], None,
+                               self.gitbin)
+        heads = {}
+        for line in output.splitlines():
+            if '\t' not in line:
+                continue
+            sha, ref = line.split('\t', 1)
+            if ref.startswith('refs/heads/'):
+                heads[ref[len('refs/heads/'):]] = sha
+        defer.returnValue(heads)
+
+    @defer.inlineCallbacks
+    def _fetch(self, url, branches):
+        """
+        Fetch branches of url, return the local repository holding them.
+        """
+        if self.mirrors is not None:
+            yield self.mirrors.update(url)
+            defer.returnValue(self.mirrors.path(url))
+
+        workdir = os.path.join(self.workdir, self._dirname(url))
+        if not os.path.isdir(workdir):
+            yield run_git(['init', '--bare', workdir], None, self.gitbin)
+        refspecs = ['+refs/heads/{0}:refs/heads/{0}'.format(branch)
+                    for branch in branches]
+        yield run_git(['fetch', url] + refspecs, workdir, self.gitbin)
+        defer.returnValue(workdir)
+
+    def _dirname(self, url):
+        return ''.join(char if char.isalnum() or char in '._-' else '_'
+                       for char in url.split('://')[-1])
+
+    @defer.inlineCallbacks
+    def _process_branch(self, url, workdir, branch, old_rev, new_rev):
+        """
+        Report the commits between old_rev and new_rev on branch.
+        """
+        has_new_rev = yield self._has_rev(workdir, new_rev)
+        if not has_new_rev:
+            # Not fetched yet, retry at next poll.
+            logging.info('{} not yet fetched from {}'.format(new_rev, url))
+            return
+
+        # On the first poll of a branch, or when the previous head is gone,
+        # record the head without reporting history.
+        has_old_rev = old_rev is not None
+        if has_old_rev:
+            has_old_rev = yield self._has_rev(workdir, old_rev)
+        if has_old_rev:
+            output = yield run_git(['log', '--format=%H', new_rev,
+                                    '^' + old_rev, '--'],
+                                   workdir, self.gitbin)
+            revs = output.split()
+            revs.reverse()
+            logging.info('Processing {} changes on {} {}'
+                         .format(len(revs), url, branch))
+            for rev in revs:
+                yield self._add_change(url, workdir, branch, rev)
+
+        self.lastRev[url][branch] = new_rev
+
+    @defer.inlineCallbacks
+    def _has_rev(self, workdir, rev):
+        try:
+            yield run_git(['cat-file', '-e', rev], workdir, self.gitbin)
+        except Exception:
+            defer.returnValue(False)
+        defer.returnValue(True)
+
+    @defer.inlineCallbacks
+    def _add_change(self, url, workdir, branch, rev):
+        header = yield run_git(['log', '--no-walk', '--format=%ct%n%aN <%aE>%n%B',
+                                rev, '--'], workdir, self.gitbin)
+        timestamp, author, comments = header.split('\n', 2)
+        files = yield run_git(['log', '--no-walk', '--name-only', '--format=',
+                               rev, '--'], workdir, self.gitbin)
+        files = [name for name in files.splitlines() if name]
+        for appliance in self._projects[url][branch]:
+            yield self.master.addChange(
+                author=author,
+                revision=rev,
+                files=files,
+                comments=comments.strip(),
+                when_timestamp=epoch2datetime(float(timestamp)),
+                branch=branch,
+                project=appliance,
+                repository=url,
+                src='git')
+
+    def stats(self):
+        """
+        Return poll latency per appliance.
+
+        Appliances sharing a repository share its latency. URLs are not
+        exported, they may hold credentials.
+        """
+        return dict((appliance, dict(self.latency[url]))
+                    for appliance, url, _ in self.repos
+                    if url in self.latency)
@@ -6,35 +6,48 @@ import shlex
 from buildbot.process.factory import BuildFactory
 from buildbot.steps.source.git import Git
 from buildbot.steps.shell import ShellCommand, SetProperty
-from buildbot.process.properties import Property
+from buildbot.process.properties import Interpolate, Property
 from buildbot.process import slavebuilder
 from buildbot.config import BuilderConfig
 
+from outscale_factory_buildbot.buildbot import affinity
+from outscale_factory_buildbot.buildbot import autoscale
 from outscale_factory_buildbot.buildbot import buildsteps
+from outscale_factory_buildbot.buildbot import durations
+from outscale_factory_buildbot.buildbot import ec2threads
+from outscale_factory_buildbot.buildbot import gitmirror
+from outscale_factory_buildbot.buildbot import metrics
+from outscale_factory_buildbot.buildbot import reaper
+from outscale_factory_buildbot.buildbot import reconfig
+from outscale_factory_buildbot.buildbot import retention
+from outscale_factory_buildbot.buildbot import volumepool
+from outscale_factory_buildbot.buildbot import workqueue
+from outscale_factory_buildbot.tools import ec2_pool
+from outscale_factory_buildbot.tools import image_cache
+from outscale_factory_buildbot.tools import ratelimit
+
+
+_selector = affinity.SlaveSelector()
+
+# Builders of the repository entries, reused on reconfig.
+_builders = reconfig.ObjectCache('builders')
 
 
 def _choose_slave(builder, slave_builders):
     # Pick the slave_builder to use for a build, based on its state.
     # Prefer idle, then latent then building slaves.
+    # Among slaves in the same state, prefer the one which built the
+    # appliance last, its workdir and fab cache are still warm.
+    # Latent slaves are skipped when the autoscaling controller does not
+    # allow more slaves to run; the build then waits for a running slave.
 
-    preferred_states = [
-        slavebuilder.PINGING, # build about to start, making sure it is still alive
-        slavebuilder.ATTACHING, # slave attached, still checking hostinfo/etc
-        slavebuilder.SUBSTANTIATING,
-        slavebuilder.BUILDING, # build is running
-        slavebuilder.LATENT, # latent slave is not substantiated; similar to idle
-        slavebuilder.IDLE, # idle, available for use
-        ]
-
-    best = None
-    best_score = -1
-    for sb in slave_builders:
-        sb_score = preferred_states.index(sb.state)
-        if sb_score > best_score:
-            best = sb
-            best_score = sb_score
-    assert best
-    return best
+    autoscale.watch(builder.master)
+    slave_builders = [sb for sb in slave_builders
+                      if sb.state != slavebuilder.LATENT
+                      or autoscale.may_substantiate(sb.slave)]
+    if not slave_builders:
+        return None
+    return _selector.choose(builder, slave_builders)
 
 
 def configure_builders(c, fc, repos, meta):
@@ -49,6 +62,22 @@ def configure_builders(c, fc, repos, meta):
         volume_gib=fc.get('build_volume_gib', 10),
         object_tags=fc.get('slave_objects_tags', {'slave': 'slave'})
     )
+    ec2_pool.configure(
+        max_size=fc.get('ec2_pool_max_size'),
+        max_idle_seconds=fc.get('ec2_pool_max_idle_seconds'),
+        check_after_seconds=fc.get('ec2_pool_check_after_seconds'))
+    image_cache.configure(
+        ttl_seconds=fc.get('image_cache_ttl_seconds'))
+    ec2threads.configure(
+        max_threads=fc.get('ec2_thread_pool_size'))
+    ratelimit.configure(
+        describe_rate=fc.get('ec2_describe_rate'),
+        describe_burst=fc.get('ec2_describe_burst'),
+        mutate_rate=fc.get('ec2_mutate_rate'),
+        mutate_burst=fc.get('ec2_mutate_burst'))
+    _selector.max_wait = fc.get('slave_affinity_max_wait_seconds', 0)
+    _selector.max_age = fc.get('slave_affinity_max_age_seconds', 24 * 3600)
+
     masterAddr = 'http://' + meta['public-ipv4']
     aptProxyPort = fc.get('master_apt_proxy_port', 3142)
     httpProxyPort = fc.get('master_http_proxy_port', 8124)
@@ -57,91 +86,260 @@ def configure_builders(c, fc, repos, meta):
         FAB_HTTP_PROXY='{}:{}'.format(masterAddr, httpProxyPort)
     )
 
+    warmPoolSize = fc.get('warm_volume_pool_size', 0)
+    volumepool.configure_pool(ec2Args['region'],
+                              ec2Args['location'],
+                              ec2Args['volume_gib'],
+                              ec2Args['object_tags'],
+                              warmPoolSize)
+
+    seedFromSnapshot = fc.get('seed_build_volume_from_snapshot', False)
+
+    # The build volume is provisioned while the appliance builds.
+    overlapVolume = fc.get('overlap_volume_provisioning', False)
+
+    # Volume and image deletions run on the master after the build.
+    if fc.get('background_cleanup', False):
+        workqueue.configure(
+            fc.get('work_queue_file'),
+            concurrency=fc.get('work_queue_concurrency'),
+            max_attempts=fc.get('work_queue_max_attempts'))
+    else:
+        workqueue.disable()
+
+    # Build volumes left behind by dead builds are deleted by the reaper.
+    if fc.get('volume_reaper', False):
+        reaper.configure(reaper.VolumeReaper(
+            ec2Args['region'],
+            ec2Args['object_tags'],
+            grace_seconds=fc.get('volume_reaper_grace_seconds', 3 * 3600),
+            interval=fc.get('volume_reaper_interval_seconds', 1800),
+            concurrency=fc.get('volume_reaper_concurrency', 4)))
+    else:
+        reaper.configure(None)
+
+    # Slaves clone the master's Git mirrors over the private network,
+    # bypassing the HTTP proxy so that refs are never served from a cache.
+    mirrors = None
+    gitEnv = None
+    if fc.get('git_mirror', False):
+        mirrors = gitmirror.configure(fc.get('git_mirror_dir', 'gitmirrors'))
+        mirrorAddr, mirrorPort = gitmirror.listen_address(fc, meta)
+        mirrorBaseUrl = 'http://{}:{}'.format(mirrorAddr, mirrorPort)
+        gitEnv = dict(no_proxy=mirrorAddr, NO_PROXY=mirrorAddr)
+
+    # Skip the build when an image of the same revision exists.
+    skipExisting = fc.get('skip_existing_images', True)
+
     mergeRequests = fc.get('merge_build_requests', False)
     maxApplianceVersions = fc.get('max_appliance_versions', 2)
 
+    # Old images are deleted in bulk by a retention service, builds only
+    # hint it.
+    if fc.get('image_retention_service', False):
+        retention.configure(retention.RetentionService(
+            ec2Args['region'],
+            maxApplianceVersions,
+            appliances=[appliance for appliance, repourl, branch in repos],
+            interval=fc.get('image_retention_interval_seconds', 3600),
+            hint_delay=fc.get('image_retention_hint_delay_seconds', 300),
+            concurrency=fc.get('image_retention_concurrency', 4)))
+    else:
+        retention.configure(None)
+
+    # Regions the new images are copied to.
+    replicateRegions = fc.get('replicate_regions', [])
+
     slavenames = [slave.slavename for slave in c['slaves']]
 
+    # Start the longest builds first, from the recorded build durations.
+    durations.configure(fc.get('build_durations_file'))
+    c['prioritizeBuilders'] = durations.prioritize_builders
+
+    settings = dict(
+        ec2Args=ec2Args,
+        buildEnv=buildEnv,
+        warmPoolSize=warmPoolSize,
+        seedFromSnapshot=seedFromSnapshot,
+        overlapVolume=overlapVolume,
+        skipExisting=skipExisting,
+        mergeRequests=mergeRequests,
+        maxApplianceVersions=maxApplianceVersions,
+        replicateRegions=replicateRegions,
+        slavenames=slavenames,
+    )
+
+    settingsFp = reconfig.fingerprint(settings, gitEnv)
+
+    # All builders share a single factory, the steps read the appliance,
+    # repository and branch from the builder properties.
+    _builders.start()
+    factory = _builders.get(
+        'factory', settingsFp,
+        lambda: _make_factory(gitEnv, settings))
+
     c['builders'] = []
     for appliance, repourl, branch in repos:
-        factory = BuildFactory()
-        srcdir = '/turnkey/fab/products/{}'.format(appliance)
+        if mirrors is not None:
+            gitRepourl = mirrors.url(repourl, mirrorBaseUrl)
+        else:
+            gitRepourl = repourl
+        properties = dict(
+            appliance=appliance,
+            repourl=repourl,
+            repo_branch=branch,
+            git_repourl=gitRepourl,
+        )
+        fp = reconfig.fingerprint(properties, settingsFp)
+        c['builders'].append(_builders.get(
+            (appliance, repourl, branch), fp,
+            lambda: BuilderConfig(name='{}-{}'.format(appliance, branch),
+                                  slavenames=settings['slavenames'],
+                                  factory=factory,
+                                  properties=properties,
+                                  mergeRequests=settings['mergeRequests'],
+                                  nextSlave=_choose_slave)))
+    _builders.prune()
+
 
-        factory.addStep(Git(
-            name='Cloning repository',
+def _make_factory(gitEnv, settings):
+    """
+    Return the BuildFactory of all builders.
+
+    The builder properties give the appliance, repourl, repo_branch and
+    git_repourl, the URL the slave clones from.
+
+    gitEnv: environment of the Git step, None for the default.
+    settings: values of configure_builders.
+    """
+    ec2Args = settings['ec2Args']
+    buildEnv = settings['buildEnv']
+    skipExisting = settings['skipExisting']
+    buildIf = buildsteps.image_missing if skipExisting else True
+    appliance = Property('appliance')
+    repourl = Property('repourl')
+
+    factory = BuildFactory()
+    # Builds time their wait for a slave, see metrics.
+    factory.buildClass = metrics.MeteredBuild
+    srcdir = Interpolate('/turnkey/fab/products/%(prop:appliance)s')
+
+    gitArgs = {}
+    if gitEnv is not None:
+        gitArgs['env'] = gitEnv
+    cloneSteps = [Git(
+        name='Cloning repository',
+        haltOnFailure=True,
+        workdir=srcdir,
+        mode='incremental',
+        repourl=Property('git_repourl'),
+        branch=Property('repo_branch'),
+        submodules=True,
+        **gitArgs)]
+
+    if skipExisting:
+        cloneSteps.append(buildsteps.FindExistingImage(
+            name='Looking for existing image',
             haltOnFailure=True,
             repourl=repourl,
-            workdir=srcdir,
-            mode='incremental',
-            branch=branch,
-            submodules=True))
+            appliance=appliance,
+            **ec2Args))
 
-        factory.addStep(SetProperty(
+    volumeSteps = [
+        SetProperty(
             name='Retrieving instance id',
             haltOnFailure=True,
             command=['curl', '--silent', 'http://169.254.169.254/latest/meta-data/instance-id'],
-            property='instance_id'))
-
-        factory.addStep(buildsteps.AttachNewVolume(
+            property='instance_id'),
+        buildsteps.AttachNewVolume(
             name='Creating build volume',
             haltOnFailure=True,
-            **ec2Args))
+            doStepIf=buildIf,
+            warm_pool_size=settings['warmPoolSize'],
+            seed_from_snapshot=settings['seedFromSnapshot'],
+            appliance=appliance,
+            background=settings['overlapVolume'],
+            **ec2Args),
+    ]
 
-        # ShellCommand fails if `description` is not set: it tries to
-        # generate it from `command` but fails because `command`
-        # contains a Property. To avoid this, set `description` to the
-        # same value as `name`.
-        name = 'Building appliance'
-        factory.addStep(ShellCommand(
-            name=name,
-            description=name,
-            descriptionDone='Appliance built',
-            haltOnFailure=True,
-            command=['omi-factory', 'tkl-build', appliance],
-            env=buildEnv))
-
-        name = 'Installing appliance'
-        factory.addStep(ShellCommand(
-            name=name,
-            description=name,
-            descriptionDone='Appliance installed',
-            haltOnFailure=True,
-            command=['omi-factory', 'tkl-install-iso', '--device', Property('device'),
-                     appliance],
-            env=buildEnv))
+    if settings['overlapVolume'] and not skipExisting:
+        # The volume is provisioned during the clone and the build.
+        steps = volumeSteps + cloneSteps
+    else:
+        # With skipExisting, a volume is only provisioned once the build
+        # is known to be needed: a background one overlaps the build only.
+        steps = cloneSteps + volumeSteps
+    for step in steps:
+        factory.addStep(step)
+
+    # ShellCommand fails if `description` is not set: it tries to
+    # generate it from `command` but fails because `command`
+    # contains a Property. To avoid this, set `description` to the
+    # same value as `name`.
+    name = 'Building appliance'
+    factory.addStep(ShellCommand(
+        name=name,
+        description=name,
+        descriptionDone='Appliance built',
+        haltOnFailure=True,
+        doStepIf=buildIf,
+        command=['omi-factory', 'tkl-build', appliance],
+        env=buildEnv))
 
-        factory.addStep(buildsteps.CreateImage(
-            name='Creating image',
+    if settings['overlapVolume']:
+        factory.addStep(buildsteps.WaitForVolume(
+            name='Waiting for build volume',
             haltOnFailure=True,
-            repourl=repourl,
-            appliance=appliance,
-            **ec2Args))
+            doStepIf=buildIf))
 
-        factory.addStep(buildsteps.DestroyVolume(
-            name='Cleaning up volume',
-            alwaysRun=True,
-            **ec2Args))
+    name = 'Installing appliance'
+    factory.addStep(ShellCommand(
+        name=name,
+        description=name,
+        descriptionDone='Appliance installed',
+        haltOnFailure=True,
+        doStepIf=buildIf,
+        command=['omi-factory', 'tkl-install-iso', '--device', Property('device'),
+                 appliance],
+        env=buildEnv))
 
-        factory.addStep(buildsteps.DestroyOldImages(
-            name='Destroy old images',
+    factory.addStep(buildsteps.CreateImage(
+        name='Creating image',
+        haltOnFailure=True,
+        doStepIf=buildIf,
+        repourl=repourl,
+        appliance=appliance,
+        **ec2Args))
+
+    factory.addStep(buildsteps.DestroyVolume(
+        name='Cleaning up volume',
+        alwaysRun=True,
+        **ec2Args))
+
+    factory.addStep(buildsteps.DestroyOldImages(
+        name='Destroy old images',
+        appliance=appliance,
+        maxApplianceVersions=settings['maxApplianceVersions'],
+        doStepIf=buildIf,
+        **ec2Args))
+
+    # Copies run after the volume is destroyed, they can take long.
+    if settings['replicateRegions']:
+        factory.addStep(buildsteps.ReplicateImage(
+            name='Replicating image',
+            doStepIf=buildIf,
             appliance=appliance,
-            maxApplianceVersions=maxApplianceVersions,
+            regions=settings['replicateRegions'],
+            maxApplianceVersions=settings['maxApplianceVersions'],
             **ec2Args))
 
-        name = 'Cleaning up build dirs'
-        factory.addStep(ShellCommand(
-            name=name,
-            description=name,
-            descriptionDone='Build dirs cleaned',
-            alwaysRun=True,
-            command=['omi-factory', 'tkl-clean', appliance],
-            env=buildEnv))
-
-        buildername = '{}-{}'.format(appliance, branch)
-        c['builders'].append(
-            BuilderConfig(name=buildername,
-                        slavenames=slavenames,
-                        factory=factory,
-                        mergeRequests=mergeRequests,
-                        nextSlave=_choose_slave)
-        )
+    name = 'Cleaning up build dirs'
+    factory.addStep(ShellCommand(
+        name=name,
+        description=name,
+        descriptionDone='Build dirs cleaned',
+        alwaysRun=True,
+        command=['omi-factory', 'tkl-clean', appliance],
+        env=buildEnv))
+
+    return factory
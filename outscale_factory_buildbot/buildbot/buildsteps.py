@@ -1,26 +1,115 @@
 """
 Custom build steps used to create a TurnKey appliance.
 
-The module is an asynchronous wrapper over create_ami, which does
-volume management and image creation operations synchronously with Boto.
+The module is an asynchronous wrapper over the volume and image operations
+of tools.volumes and tools.images. Blocking calls run in the ec2threads
+pool, waits for volume, snapshot and image state changes are polled on
+reactor timers.
 """
 
 import logging
+import time
+import weakref
 from datetime import datetime
 
 import boto.ec2
 
 from twisted.python import failure
-from twisted.internet import threads, defer
+from twisted.internet import defer
 
 from buildbot.status import results
 from buildbot.process.buildstep import BuildStep
 # from buildbot.buildslave.ec2 import EC2LatentBuildSlave
 from buildbot.ec2buildslave import EC2LatentBuildSlave
 
-from outscale_factory_buildbot.tools.delete_images import delete_images
+from outscale_factory_buildbot.buildbot import ec2threads
+from outscale_factory_buildbot.buildbot import metrics
+from outscale_factory_buildbot.buildbot import retention
+from outscale_factory_buildbot.buildbot import volumepool
+from outscale_factory_buildbot.buildbot import workqueue
+from outscale_factory_buildbot.tools import ec2_pool
+from outscale_factory_buildbot.tools import image_cache
+from outscale_factory_buildbot.tools import images
+from outscale_factory_buildbot.tools import replicate_image
+from outscale_factory_buildbot.tools import volumes
+from outscale_factory_buildbot.tools.delete_images import delete_old_images
+from outscale_factory_buildbot.tools.delete_images import DeleteImagesError
 from outscale_factory_buildbot.tools.find_images import find_images
-from outscale_image_factory import create_ami
+
+
+# Seconds between two volume state checks.
+POLL_INTERVAL_SECONDS = 5
+
+# Seconds to wait for a volume state change.
+VOLUME_TIMEOUT_SECONDS = 600
+
+# Seconds between two snapshot or image state checks, and to wait for
+# the snapshot and then the image.
+IMAGE_POLL_INTERVAL_SECONDS = 15
+IMAGE_TIMEOUT_SECONDS = 3600
+
+# Seconds between two checks of the image copies, and to wait for them.
+COPY_POLL_INTERVAL_SECONDS = 30
+COPY_TIMEOUT_SECONDS = 2 * 3600
+
+
+class VolumeError(Exception):
+
+    """
+    Error raised when a volume is missing or in the error state.
+    """
+
+
+class ImageError(Exception):
+
+    """
+    Error raised when a snapshot or image creation fails.
+    """
+
+
+class _Provisioning(object):
+
+    """
+    Outcome of a volume provisioning running in the background.
+
+    Any number of steps can wait for it; its error is only reported to
+    them.
+    """
+
+    def __init__(self, d):
+        self.started = time.time()
+        self.done = False
+        self.result = None
+        self._waiters = []
+        d.addBoth(self._finished)
+
+    def _finished(self, result):
+        self.done = True
+        self.result = result
+        waiters, self._waiters = self._waiters, []
+        for d in waiters:
+            self._fire(d)
+
+    def _fire(self, d):
+        if isinstance(self.result, failure.Failure):
+            d.errback(self.result)
+        else:
+            d.callback(self.result)
+
+    def wait(self):
+        """
+        Return a Deferred firing with the outcome of the provisioning.
+        """
+        d = defer.Deferred()
+        if self.done:
+            self._fire(d)
+        else:
+            self._waiters.append(d)
+        return d
+
+
+# Volume provisionings running in the background, by build.
+_provisioning = weakref.WeakKeyDictionary()
 
 
 class _EC2BuildStep(BuildStep):
@@ -51,11 +140,66 @@ class _EC2BuildStep(BuildStep):
             object_tags=dict(object_tags),
             image_arch=image_arch)
 
-    def _connect(self):
+    def _with_connection(self, func, *args):
+        """
+        Call func(conn, *args) with a pooled connection to the cloud.
+
+        Blocking, meant to be run in a thread.
+        """
+        with ec2_pool.connection(self.region) as conn:
+            result = func(conn, *args)
+        logging.debug('EC2 connection pool: {}'.format(ec2_pool.stats()))
+        return result
+
+    def _metric_labels(self):
+        return dict(appliance=self.getProperty('appliance', default=''),
+                    step=self.name)
+
+    def _run(self, func, *args):
         """
-        Connect to the cloud.
+        Call func(conn, *args) in the EC2 thread pool, return a Deferred.
+
+        The duration of the call is recorded in the metrics.
+        """
+        labels = self._metric_labels()
+
+        def call():
+            start = time.time()
+            result = 'failure'
+            try:
+                value = self._with_connection(func, *args)
+                result = 'success'
+                return value
+            finally:
+                metrics.observe('factory_ec2_call_seconds',
+                                time.time() - start,
+                                call=func.__name__, result=result, **labels)
+        return ec2threads.run(call)
+
+    def _wait_volume(self, volume_id, status, attachment=None):
+        """
+        Return a Deferred firing when the volume reaches a status and,
+        if given, an attachment status.
         """
-        return boto.ec2.connect_to_region(self.region)
+        def check():
+            current, current_attachment = self._with_connection(
+                volumes.volume_status, volume_id)
+            if current is None or current == 'error':
+                raise VolumeError('Volume {} is {}'.format(
+                    volume_id, current or 'missing'))
+            return (current == status
+                    and (attachment is None
+                         or current_attachment == attachment))
+
+        description = 'volume {} to be {}'.format(volume_id,
+                                                  attachment or status)
+        d = ec2threads.poll(check,
+                            POLL_INTERVAL_SECONDS,
+                            VOLUME_TIMEOUT_SECONDS,
+                            description)
+        return metrics.time_deferred(d, 'factory_ec2_wait_seconds',
+                                     state=attachment or status,
+                                     **self._metric_labels())
 
     def _timestamp(self):
         """
@@ -64,16 +208,238 @@ class _EC2BuildStep(BuildStep):
         return datetime.now().strftime('%y%m%d_%H%M')
 
 
+def image_missing(step):
+    """
+    doStepIf predicate: False if FindExistingImage found an image of the
+    revision being built.
+    """
+    return not step.getProperty('existing_image', False)
+
+
+class FindExistingImage(_EC2BuildStep):
+
+    """
+    Look for an image of the same appliance, repository and revision.
+
+    If one exists, its id and name are stored in the image_id and
+    image_name properties and the existing_image property is set: the
+    steps using image_missing as doStepIf are skipped. Setting the
+    force_rebuild property disables the check.
+    """
+
+    renderables = ['appliance', 'repourl']
+
+    def __init__(self, appliance=None, repourl=None, **kw):
+        _EC2BuildStep.__init__(self, **kw)
+        if appliance is None:
+            raise TypeError('appliance argument is required')
+        if repourl is None:
+            raise TypeError('repourl argument is required')
+        self.appliance = appliance
+        self.repourl = repourl
+        self.addFactoryArguments(
+            appliance=appliance,
+            repourl=repourl)
+
+    def _find_image(self, revision):
+        """
+        Return the latest image built from revision, or None.
+        """
+        images = find_images(self.region,
+                             tags=dict(appliance=self.appliance,
+                                       repourl=self.repourl,
+                                       revision=revision),
+                             owners=['self'])
+        if not images:
+            return None
+        return images[0]
+
+    @defer.inlineCallbacks
+    def start(self):
+        """
+        Start the buildstep.
+        """
+        self.setProperty('existing_image', False)
+        revision = self.getProperty('got_revision', default=None)
+        if self.getProperty('force_rebuild', default=False) or not revision:
+            self.finished(results.SKIPPED)
+            return
+
+        try:
+            image = yield ec2threads.run(self._find_image, revision)
+        except Exception:
+            self.failed(failure.Failure())
+            return
+
+        if image is not None:
+            self.setProperty('existing_image', True)
+            self.setProperty('image_id', image.id)
+            self.setProperty('image_name', image.name)
+            self.addCompleteLog(
+                'existing image',
+                'Image {} ({}) was built from revision {}, not rebuilding\n'
+                .format(image.id, image.name, revision))
+        self.finished(results.SUCCESS)
+
+
 class AttachNewVolume(_EC2BuildStep):
 
     """
     Attach a new volume to the buildslave instance.
+
+    With warm_pool_size > 0, the volume is claimed from a warm pool of
+    pre-created volumes kept by the master, and a new volume is only
+    created when the pool is empty.
+
+    With seed_from_snapshot, the volume is created from the root snapshot
+    of the appliance's most recent image, so that the install step only
+    rewrites what changed. The snapshot used is stored in the
+    seed_snapshot_id property, None for an empty volume.
+
+    With background, the step finishes at once and the volume is
+    provisioned while the next steps run. WaitForVolume waits for it
+    before the volume is used, and reports its errors.
     """
 
-    def __init__(self, **kw):
+    renderables = ['appliance']
+
+    def __init__(self, warm_pool_size=0, seed_from_snapshot=False,
+                 appliance=None, background=False, **kw):
         _EC2BuildStep.__init__(self, **kw)
+        if seed_from_snapshot and appliance is None:
+            raise TypeError('appliance argument is required '
+                            'with seed_from_snapshot')
+        self.warm_pool_size = warm_pool_size
+        self.seed_from_snapshot = seed_from_snapshot
+        self.appliance = appliance
+        self.background = background
+        self.addFactoryArguments(
+            warm_pool_size=warm_pool_size,
+            seed_from_snapshot=seed_from_snapshot,
+            appliance=appliance,
+            background=background)
+
+    def _find_seed_snapshot(self, conn):
+        """
+        Return (snapshot id, image) to seed the volume from, or
+        (None, None) if there is no previous image of the same size.
+        """
+        images = find_images(self.region,
+                             tags=dict(appliance=self.appliance),
+                             owners=['self'])
+        images = [each for each in images if 'timestamp' in each.tags]
+        if not images:
+            return None, None
+        image = max(images, key=lambda x: x.tags['timestamp'])
+        snapshot_id, size = volumes.image_root_snapshot(conn, image)
+        if snapshot_id is None or size != self.volume_gib:
+            return None, None
+        return snapshot_id, image
+
+    def _claim_warm_volume(self, conn, pool, volume_tags):
+        """
+        Claim a warm volume and give it the build's tags.
+
+        Return (volume id or None, number of volumes left).
+        """
+        volume_id, left = pool.claim()
+        if volume_id:
+            conn.create_tags([volume_id], volume_tags)
+        return volume_id, left
 
     @defer.inlineCallbacks
+    def _new_volume(self, volume_tags):
+        """
+        Seed, claim or create a volume, return its id.
+        """
+        volume_id = None
+        snapshot_id = None
+        if self.seed_from_snapshot:
+            # Seeding only saves time: without a seed, the build starts
+            # from an empty volume.
+            try:
+                snapshot_id, image = yield self._run(self._find_seed_snapshot)
+            except Exception as error:
+                logging.warning('Could not find a seed snapshot for {}: {}'
+                                .format(self.appliance, error))
+                self.addCompleteLog('seed',
+                                    'No seed, lookup failed: {}\n'
+                                    .format(error))
+                snapshot_id = None
+        if snapshot_id:
+            try:
+                volume_id = yield self._run(volumes.create_volume,
+                                            self.volume_gib,
+                                            self.location,
+                                            volume_tags,
+                                            snapshot_id)
+            except boto.exception.EC2ResponseError as error:
+                # The snapshot may have been deleted since the lookup.
+                if not (error.error_code or '').startswith('InvalidSnapshot'):
+                    raise
+                logging.warning('Could not seed a volume from {}: {}'
+                                .format(snapshot_id, error))
+                self.addCompleteLog('seed',
+                                    'No seed, volume creation from {} '
+                                    'failed: {}\n'.format(snapshot_id, error))
+                snapshot_id = None
+            else:
+                self.setProperty('seed_image_id', image.id)
+                self.setProperty('seed_revision', image.tags.get('revision'))
+                self.addCompleteLog(
+                    'seed',
+                    'Seeding volume from {} of image {} (revision {})\n'
+                    .format(snapshot_id, image.id,
+                            image.tags.get('revision')))
+        self.setProperty('seed_snapshot_id', snapshot_id)
+
+        if not volume_id and self.warm_pool_size > 0:
+            pool = volumepool.get_pool(self.region,
+                                       self.location,
+                                       self.volume_gib,
+                                       self.object_tags,
+                                       self.warm_pool_size)
+            claim_start = time.time()
+            volume_id, left = yield self._run(self._claim_warm_volume,
+                                              pool,
+                                              volume_tags)
+            volumepool.refill_in_background(pool)
+            if volume_id:
+                self.addCompleteLog(
+                    'warm pool',
+                    'Claimed {} in {:.2f}s, {} warm volumes left\n'
+                    .format(volume_id, time.time() - claim_start, left))
+            else:
+                self.addCompleteLog('warm pool',
+                                    'Warm pool empty, creating a volume\n')
+
+        if not volume_id:
+            volume_id = yield self._run(volumes.create_volume,
+                                        self.volume_gib,
+                                        self.location,
+                                        volume_tags)
+        defer.returnValue(volume_id)
+
+    @defer.inlineCallbacks
+    def _provision(self, instance_id):
+        """
+        Create the volume and attach it to the instance.
+        """
+        volume_tags = dict(self.object_tags)
+        volume_tags['timestamp'] = self._timestamp()
+        self.setProperty('volume_tags', volume_tags)
+
+        volume_id = yield self._new_volume(volume_tags)
+        # Set early so that DestroyVolume cleans up after a failure.
+        self.setProperty('volume_id', volume_id)
+        yield self._wait_volume(volume_id, 'available')
+
+        device = yield self._run(volumes.attach_volume,
+                                 volume_id,
+                                 instance_id)
+        self.setProperty('device', device)
+        yield self._wait_volume(volume_id, 'in-use', 'attached')
+
     def start(self):
         """
         Start the buildstep.
@@ -81,26 +447,55 @@ class AttachNewVolume(_EC2BuildStep):
         instance_id = self.getProperty('instance_id')
         assert instance_id
 
-        volume_tags = dict(self.object_tags)
-        volume_tags['timestamp'] = self._timestamp()
+        d = self._provision(instance_id)
+        if not self.background:
+            d.addCallbacks(lambda _: self.finished(results.SUCCESS),
+                           self.failed)
+            return
+        _provisioning[self.build] = _Provisioning(d)
+        self.addCompleteLog('background',
+                            'Provisioning the volume while the next steps '
+                            'run\n')
+        self.finished(results.SUCCESS)
 
-        conn = yield threads.deferToThread(self._connect)
-        volume_id, device, error = yield threads.deferToThread(
-            create_ami.create_volume,
-            conn,
-            instance_id,
-            self.volume_gib,
-            self.location,
-            volume_tags)
 
-        self.setProperty('volume_id', volume_id)
-        self.setProperty('device', device)
-        self.setProperty('volume_tags', volume_tags)
+class WaitForVolume(BuildStep):
 
-        if volume_id and not error:
-            self.finished(results.SUCCESS)
-        else:
-            self.failed(failure.Failure(error))
+    """
+    Wait for the volume provisioned in the background by AttachNewVolume.
+
+    Fail if the provisioning failed, skip if the build has no
+    provisioning in the background.
+    """
+
+    def __init__(self, **kw):
+        BuildStep.__init__(self, **kw)
+
+    @defer.inlineCallbacks
+    def start(self):
+        """
+        Start the buildstep.
+        """
+        provisioning = _provisioning.get(self.build)
+        if provisioning is None:
+            self.finished(results.SKIPPED)
+            return
+
+        wait_start = time.time()
+        try:
+            yield provisioning.wait()
+        except Exception:
+            self.failed(failure.Failure())
+            return
+        self.addCompleteLog(
+            'volume',
+            'Volume {} attached as {}, ready {:.0f}s after provisioning '
+            'started, waited {:.0f}s\n'
+            .format(self.getProperty('volume_id'),
+                    self.getProperty('device'),
+                    time.time() - provisioning.started,
+                    time.time() - wait_start))
+        self.finished(results.SUCCESS)
 
 
 class CreateImage(_EC2BuildStep):
@@ -109,6 +504,8 @@ class CreateImage(_EC2BuildStep):
     Create image from the buildslave's build volume.
     """
 
+    renderables = ['appliance', 'repourl']
+
     def __init__(self, appliance=None, repourl=None, **kw):
         _EC2BuildStep.__init__(self, **kw)
         if appliance is None:
@@ -144,29 +541,164 @@ class CreateImage(_EC2BuildStep):
             revision=revision,
         ))
 
-        conn = yield threads.deferToThread(self._connect)
-        image_id, error = yield threads.deferToThread(create_ami.create_image,
-                                                      conn,
-                                                      image_name,
-                                                      volume_id,
-                                                      self.image_arch,
-                                                      image_description,
-                                                      image_tags)
-
-        self.setProperty('image_id', image_id)
+        self.setProperty('image_id', None)
         self.setProperty('image_name', image_name)
         self.setProperty('image_tags', image_tags)
 
-        if not error:
+        try:
+            snapshot_id = yield self._run(images.create_snapshot,
+                                          volume_id,
+                                          image_description or image_name)
+            yield self._wait_state(images.snapshot_status, snapshot_id,
+                                   'snapshot', 'completed')
+            image_id = yield self._run(images.register_image,
+                                       image_name,
+                                       snapshot_id,
+                                       self.image_arch,
+                                       image_description,
+                                       image_tags)
+            self.setProperty('image_id', image_id)
+            image_cache.add_image(
+                self.region,
+                image_cache.ImageRecord(image_id, image_name, image_tags))
+            yield self._wait_state(images.image_state, image_id,
+                                   'image', 'available')
+        except Exception:
+            self.failed(failure.Failure())
+            return
+        self.finished(results.SUCCESS)
+
+    def _wait_state(self, func, object_id, kind, state):
+        """
+        Return a Deferred firing when func(conn, object_id) returns state.
+
+        Any state but pending and the expected one is an error.
+        """
+        def check():
+            current = self._with_connection(func, object_id)
+            if current not in ('pending', state):
+                raise ImageError('{} {} is {}'.format(kind.capitalize(),
+                                                       object_id, current))
+            return current == state
+
+        d = ec2threads.poll(check,
+                            IMAGE_POLL_INTERVAL_SECONDS,
+                            IMAGE_TIMEOUT_SECONDS,
+                            '{} {} to be {}'.format(kind, object_id, state))
+        return metrics.time_deferred(d, 'factory_ec2_wait_seconds',
+                                     state=state, **self._metric_labels())
+
+
+class ReplicateImage(_EC2BuildStep):
+
+    """
+    Copy the new image to other regions.
+
+    Copies to all regions are started and waited for in parallel. Tags are
+    carried over, and only the maxApplianceVersions most recent images of
+    the appliance are kept in each region. The copies are stored in the
+    replicated_images property, a dictionary of region -> image id.
+    """
+
+    renderables = ['appliance']
+
+    def __init__(self, appliance=None, regions=None,
+                 maxApplianceVersions=None, **kw):
+        _EC2BuildStep.__init__(self, **kw)
+        if appliance is None:
+            raise TypeError('appliance argument is required')
+        if maxApplianceVersions is None:
+            raise TypeError('maxApplianceVersions argument is required')
+        self.appliance = appliance
+        self.regions = [region for region in regions or []
+                        if region != self.region]
+        self.maxApplianceVersions = maxApplianceVersions
+        self.addFactoryArguments(
+            appliance=appliance,
+            regions=list(regions or []),
+            maxApplianceVersions=maxApplianceVersions)
+
+    @defer.inlineCallbacks
+    def _replicate(self, region, image_id, name, description, tags):
+        """
+        Copy the image to region, return the id of the copy.
+        """
+        labels = self._metric_labels()
+        copy_id = yield metrics.time_deferred(
+            ec2threads.run(replicate_image.start_copy,
+                           region,
+                           self.region,
+                           image_id,
+                           name,
+                           description,
+                           tags),
+            'factory_ec2_call_seconds', call='start_copy', **labels)
+
+        def check():
+            state = replicate_image.copy_state(region, copy_id)
+            if state not in ('pending', 'available'):
+                raise replicate_image.ReplicationError(
+                    'Copy {} in {} is {}'.format(copy_id, region, state))
+            return state == 'available'
+
+        yield metrics.time_deferred(
+            ec2threads.poll(check,
+                            COPY_POLL_INTERVAL_SECONDS,
+                            COPY_TIMEOUT_SECONDS,
+                            'image {} in {}'.format(copy_id, region)),
+            'factory_ec2_wait_seconds', state='copied', **labels)
+        report = yield ec2threads.run(delete_old_images,
+                                      region,
+                                      self.appliance,
+                                      self.maxApplianceVersions)
+        if report.failed:
+            raise DeleteImagesError(report.summary())
+        defer.returnValue(copy_id)
+
+    @defer.inlineCallbacks
+    def start(self):
+        """
+        Start the buildstep.
+        """
+        image_id = self.getProperty('image_id', default=None)
+        if not image_id or not self.regions:
+            self.finished(results.SKIPPED)
+            return
+
+        name = self.getProperty('image_name')
+        description = self.getProperty('description', default=None)
+        tags = self.getProperty('image_tags', default={})
+        outcomes = yield defer.DeferredList(
+            [self._replicate(region, image_id, name, description, tags)
+             for region in self.regions],
+            consumeErrors=True)
+
+        copies = {}
+        lines = []
+        for region, (ok, result) in zip(self.regions, outcomes):
+            if ok:
+                copies[region] = result
+                lines.append('{}: {}'.format(region, result))
+            else:
+                lines.append('{}: failed: {}'.format(
+                    region, result.getErrorMessage()))
+        self.setProperty('replicated_images', copies)
+        self.addCompleteLog('replication', '\n'.join(lines) + '\n')
+
+        if len(copies) == len(self.regions):
             self.finished(results.SUCCESS)
         else:
-            self.failed(failure.Failure(error))
+            self.finished(results.FAILURE)
 
 
 class DestroyVolume(_EC2BuildStep):
 
     """
     Destroy the build volume.
+
+    With a work queue on the master, only detach the volume and leave its
+    deletion to the queue. A volume still being provisioned in the
+    background is waited for first.
     """
 
     def __init__(self, **kw):
@@ -177,23 +709,57 @@ class DestroyVolume(_EC2BuildStep):
         """
         Start the buildstep.
         """
-        volume_id = self.getProperty('volume_id')
-        conn = yield threads.deferToThread(self._connect)
-        ok, error = yield threads.deferToThread(create_ami.destroy_volume,
-                                                conn,
-                                                volume_id)
-        if ok:
+        provisioning = _provisioning.pop(self.build, None)
+        if provisioning is not None:
+            try:
+                yield provisioning.wait()
+            except Exception as error:
+                # The volume_id property is set if a volume was created.
+                logging.warning('Volume provisioning failed: {}'
+                                .format(error))
+        volume_id = self.getProperty('volume_id', default=None)
+        if not volume_id:
+            self.finished(results.SKIPPED)
+            return
+
+        queue = workqueue.get_queue()
+        if queue is not None:
+            # Detach now, the master waits for the volume and deletes it.
+            try:
+                yield self._run(volumes.detach_volume, volume_id)
+            except Exception as error:
+                logging.warning('Could not detach {}: {}'
+                                .format(volume_id, error))
+            queue.enqueue('destroy_volume',
+                          dict(region=self.region, volume_id=volume_id))
+            self.addCompleteLog('background',
+                                'Deletion of {} queued on the master\n'
+                                .format(volume_id))
             self.finished(results.SUCCESS)
+            return
+
+        try:
+            exists = yield self._run(volumes.detach_volume, volume_id)
+            if exists:
+                yield self._wait_volume(volume_id, 'available')
+                yield self._run(volumes.delete_volume, volume_id)
+        except Exception:
+            self.failed(failure.Failure())
         else:
-            self.failed(failure.Failure(error))
+            self.finished(results.SUCCESS)
 
 
 class DestroyOldImages(_EC2BuildStep):
 
     """
     Destroy old versions of an appliance image
+
+    With a retention service on the master, only hint the service. With
+    a work queue, leave the deletion to the queue.
     """
 
+    renderables = ['appliance']
+
     def __init__(self, appliance=None, maxApplianceVersions=None, **kw):
         _EC2BuildStep.__init__(self, **kw)
         if appliance is None:
@@ -208,7 +774,24 @@ class DestroyOldImages(_EC2BuildStep):
 
     @defer.inlineCallbacks
     def start(self):
-        ok, error = yield threads.deferToThread(self._destroy_old_images)
+        if retention.hint(self.appliance):
+            # The retention service of the master deletes them in bulk.
+            self.addCompleteLog('retention',
+                                'Old images left to the retention service\n')
+            self.finished(results.SUCCESS)
+            return
+        queue = workqueue.get_queue()
+        if queue is not None:
+            queue.enqueue('destroy_old_images',
+                          dict(region=self.region,
+                               appliance=self.appliance,
+                               max_versions=self.maxApplianceVersions))
+            self.addCompleteLog('background',
+                                'Deletion of old images queued on the '
+                                'master\n')
+            self.finished(results.SUCCESS)
+            return
+        ok, error = yield ec2threads.run(self._destroy_old_images)
         if ok:
             self.finished(results.SUCCESS)
         else:
@@ -219,11 +802,12 @@ class DestroyOldImages(_EC2BuildStep):
         error = None
 
         try:
-            images = find_images(self.region, tags=dict(appliance=self.appliance))
-            images.sort(key=lambda x: x.tags['timestamp'])
-            ids = [each.id for each in images[:-self.maxApplianceVersions]]
-            delete_images(self.region, ids)
-            ok = True
+            report = delete_old_images(self.region,
+                                       self.appliance,
+                                       self.maxApplianceVersions)
+            ok = not report.failed
+            if not ok:
+                error = DeleteImagesError(report.summary())
 
         except (boto.exception.BotoClientError,
                 boto.exception.BotoServerError) as error:
@@ -233,3 +817,60 @@ class DestroyOldImages(_EC2BuildStep):
             logging.error('Could not destroy old images: {}'.format(error))
 
         return ok, error
+
+
+def _in_region(region, func, *args):
+    """
+    Call func(conn, *args) with a pooled connection to region. Blocking.
+    """
+    with ec2_pool.connection(region) as conn:
+        return func(conn, *args)
+
+
+@defer.inlineCallbacks
+def _destroy_volume(args):
+    """
+    Work queue handler: detach a volume, wait for it and delete it.
+    """
+    region = args['region']
+    volume_id = args['volume_id']
+    exists = yield ec2threads.run(_in_region, region,
+                                  volumes.detach_volume, volume_id)
+    if not exists:
+        return
+
+    def check():
+        status, _ = _in_region(region, volumes.volume_status, volume_id)
+        if status == 'error':
+            raise VolumeError('Volume {} is error'.format(volume_id))
+        if status is None:
+            return 'deleted'
+        return status == 'available' and status
+
+    status = yield ec2threads.poll(check,
+                                   POLL_INTERVAL_SECONDS,
+                                   VOLUME_TIMEOUT_SECONDS,
+                                   'volume {} to be available'
+                                   .format(volume_id))
+    if status == 'deleted':
+        return
+    # Also succeeds if the volume is deleted meanwhile.
+    yield ec2threads.run(_in_region, region,
+                         volumes.delete_volume, volume_id)
+
+
+def _destroy_old_images(args):
+    """
+    Work queue handler: apply the retention of an appliance.
+    """
+    def destroy():
+        report = delete_old_images(args['region'],
+                                   args['appliance'],
+                                   args['max_versions'])
+        if report.failed:
+            raise DeleteImagesError(report.summary())
+    return ec2threads.run(destroy)
+
+
+workqueue.register('destroy_volume', _destroy_volume)
+workqueue.register('destroy_old_images', _destroy_old_images)
@@ -3,6 +3,14 @@ Changesources configuration
 """
 from buildbot.changes.gitpoller import GitPoller
 
+from outscale_factory_buildbot.buildbot import batchpoller
+from outscale_factory_buildbot.buildbot import gitmirror
+from outscale_factory_buildbot.buildbot import reconfig
+
+
+# Pollers of the repository entries, reused on reconfig.
+_pollers = reconfig.ObjectCache('changesources')
+
 
 def configure_changesources(c, fc, repos, meta):
     # the 'change_source' setting tells the buildmaster how it should find out
@@ -10,12 +18,62 @@ def configure_changesources(c, fc, repos, meta):
     c['change_source'] = []
     pollinterval = fc['git_poll_interval_seconds']
 
+    mirrors = None
+    if fc.get('git_mirror', False):
+        mirrors = gitmirror.configure(fc.get('git_mirror_dir', 'gitmirrors'))
+
+    _pollers.start()
+    if fc.get('git_batch_poller', False):
+        # A single change source polls all repositories.
+        maxConcurrent = fc.get('git_poll_concurrency', 4)
+        jitter = fc.get('git_poll_jitter', 0.5)
+        fp = reconfig.fingerprint(sorted(repos), pollinterval, maxConcurrent,
+                                  jitter, mirrors and mirrors.basedir)
+
+        def make_batch_poller():
+            return batchpoller.BatchGitPoller(
+                repos,
+                pollInterval=pollinterval,
+                maxConcurrent=maxConcurrent,
+                jitter=jitter,
+                mirrors=mirrors,
+            )
+        c['change_source'].append(
+            _pollers.get('batch', fp, make_batch_poller))
+        _pollers.prune()
+        return
+
+    poller_class = GitPoller
+    poller_args = {}
+    if mirrors is not None:
+        # Pollers update the shared mirror, then fetch from it.
+        poller_class = gitmirror.MirroringGitPoller
+        poller_args['mirrors'] = mirrors
+
     for appliance, repourl, branch in repos:
         workdir = 'gitpollers/{}'.format(appliance)
-        c['change_source'].append(GitPoller(
-            repourl=repourl,
-            project=appliance,
-            workdir=workdir,
-            branch=branch,
-            pollinterval=pollinterval
-        ))
+        fp = reconfig.fingerprint(appliance, repourl, branch, pollinterval,
+                                  mirrors and mirrors.basedir)
+
+        def make_poller():
+            return poller_class(
+                repourl=repourl,
+                project=appliance,
+                workdir=workdir,
+                branch=branch,
+                pollinterval=pollinterval,
+                **poller_args
+            )
+        c['change_source'].append(
+            _pollers.get((appliance, repourl, branch), fp, make_poller))
+    _pollers.prune()
+
+
+def batch_poller_stats():
+    """
+    Return the poll latency of the batch poller, None without it.
+    """
+    poller = _pollers.peek('batch')
+    if poller is None:
+        return None
+    return poller.stats()
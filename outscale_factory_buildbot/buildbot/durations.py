@@ -0,0 +1,241 @@
+"""
+Historical build durations.
+
+DurationRecorder is a status target keeping a moving average of the
+duration of successful builds of each builder, and of each of their steps,
+in a JSON file. The schedulers read it on (re)configuration to plan
+nightly builds, prioritize_builders starts the longest builds first, and
+the table is served as JSON next to the web status.
+"""
+import json
+import logging
+import os
+
+from twisted.web import resource
+
+from buildbot.status.base import StatusReceiverMultiService
+from buildbot.status.results import SUCCESS
+
+
+# Default file, relative to the master basedir.
+DURATIONS_FILE = 'build_durations.json'
+
+# Weight of the last build in the moving average.
+SMOOTHING = 0.3
+
+
+class DurationTable(object):
+
+    """
+    Average build and step durations in seconds per builder, stored in path.
+
+    The file holds, per builder name:
+        {"build": seconds, "steps": {step name: seconds}}
+    """
+
+    def __init__(self, path=DURATIONS_FILE):
+        self.path = path
+        self._durations = None
+
+    def _load(self):
+        if self._durations is not None:
+            return self._durations
+        self._durations = {}
+        if os.path.exists(self.path):
+            try:
+                with open(self.path) as file_handle:
+                    self._durations = json.load(file_handle)
+            except ValueError as error:
+                logging.error('Ignoring corrupt duration file {}: {}'
+                              .format(self.path, error))
+        return self._durations
+
+    def get(self, name, default=None):
+        """
+        Return the average build duration of builder name, or default.
+        """
+        return self._load().get(name, {}).get('build', default)
+
+    def get_step(self, name, step, default=None):
+        """
+        Return the average duration of a step of builder name, or default.
+        """
+        return self._load().get(name, {}).get('steps', {}).get(step, default)
+
+    def names(self):
+        return sorted(self._load())
+
+    def to_dict(self):
+        return dict(self._load())
+
+    def expected(self, names, default):
+        """
+        Return a dictionary of builder name -> expected build duration.
+
+        Builders never built are expected to take the median duration of
+        the others, or default.
+        """
+        known = sorted(self.get(name) for name in names if self.get(name))
+        if known:
+            default = known[len(known) // 2]
+        return dict((name, self.get(name) or default) for name in names)
+
+    def record(self, name, seconds, step_seconds=None):
+        """
+        Add a build to the averages of builder name and save.
+
+        step_seconds: dictionary of step name -> duration.
+        """
+        entry = self._load().setdefault(name, {'build': None, 'steps': {}})
+        entry['build'] = _average(entry['build'], seconds)
+        for step, step_duration in (step_seconds or {}).items():
+            entry['steps'][step] = _average(entry['steps'].get(step),
+                                            step_duration)
+        self.save()
+
+    def save(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as file_handle:
+            json.dump(self._load(), file_handle, indent=2, sort_keys=True)
+        os.rename(tmp_path, self.path)
+
+
+def _average(previous, seconds):
+    if previous is None:
+        return float(seconds)
+    return SMOOTHING * seconds + (1 - SMOOTHING) * previous
+
+
+def plan(build_seconds, capacity):
+    """
+    Plan builds over capacity slaves, longest first, each on the slave
+    which becomes free first.
+
+    build_seconds: dictionary of builder name -> expected build duration.
+
+    Return (dictionary of builder name -> start offset, total duration).
+    """
+    free_at = [0] * max(1, capacity)
+    offsets = {}
+    for name in sorted(build_seconds,
+                       key=lambda name: (-build_seconds[name], name)):
+        slave = free_at.index(min(free_at))
+        offsets[name] = free_at[slave]
+        free_at[slave] += build_seconds[name]
+    return offsets, max(free_at)
+
+
+class DurationRecorder(StatusReceiverMultiService):
+
+    """
+    Status target recording the duration of successful builds.
+    """
+
+    compare_attrs = ['path']
+
+    def __init__(self, table):
+        StatusReceiverMultiService.__init__(self)
+        self.table = table
+        self.path = table.path
+        self._status = None
+
+    def startService(self):
+        StatusReceiverMultiService.startService(self)
+        self._status = self.parent.getStatus()
+        self._status.subscribe(self)
+
+    def stopService(self):
+        if self._status is not None:
+            self._status.unsubscribe(self)
+        return StatusReceiverMultiService.stopService(self)
+
+    def builderAdded(self, name, builder):
+        # Subscribe to the builds of all builders.
+        return self
+
+    def buildFinished(self, builderName, build, results):
+        if results != SUCCESS:
+            return
+        if build.getProperty('existing_image', False):
+            # Nothing was built, see buildsteps.FindExistingImage.
+            return
+        start, end = build.getTimes()
+        if start is None or end is None:
+            return
+        step_seconds = {}
+        for step in build.getSteps():
+            step_start, step_end = step.getTimes()
+            if step_start is not None and step_end is not None:
+                step_seconds[step.getName()] = step_end - step_start
+        try:
+            self.table.record(builderName, end - start, step_seconds)
+        except (IOError, OSError) as error:
+            logging.error('Could not save build duration: {}'.format(error))
+
+
+class DurationResource(resource.Resource):
+
+    """
+    Web resource serving the duration table as JSON.
+
+    For each builder: average build and step durations. For 1 to N slaves:
+    the expected duration of a batch building all the builders, to
+    predict the end of the nightly builds and size max_instances.
+    """
+
+    isLeaf = True
+
+    def __init__(self, table, default_seconds=3600):
+        resource.Resource.__init__(self)
+        self.table = table
+        self.default_seconds = default_seconds
+
+    def render_GET(self, request):
+        names = self.table.names()
+        build_seconds = self.table.expected(names, self.default_seconds)
+        batch_seconds = dict(
+            (capacity, plan(build_seconds, capacity)[1])
+            for capacity in range(1, len(names) + 1))
+        body = dict(
+            builders=self.table.to_dict(),
+            batch_seconds_by_slave_count=batch_seconds,
+        )
+        request.setHeader('content-type', 'application/json')
+        return json.dumps(body, indent=2, sort_keys=True).encode('utf-8')
+
+
+def prioritize_builders(master, builders):
+    """
+    Order builders with pending requests longest build first.
+
+    Used as the prioritizeBuilders function of the master: the last builds
+    of a batch are the short ones, so the batch ends sooner.
+    """
+    if _table is None:
+        return builders
+    names = [builder.name for builder in builders]
+    build_seconds = _table.expected(names, 0)
+    return sorted(builders,
+                  key=lambda builder: (-build_seconds[builder.name],
+                                       builder.name))
+
+
+_table = None
+
+
+def configure(path=None):
+    """
+    Return the duration table stored in path.
+    """
+    global _table
+    path = path or DURATIONS_FILE
+    if _table is None or _table.path != path:
+        _table = DurationTable(path)
+    return _table
+
+
+def get_table():
+    """
+    Return the configured duration table, or None.
+    """
+    return _table
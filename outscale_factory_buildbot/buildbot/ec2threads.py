@@ -0,0 +1,118 @@
+"""
+Thread pool for the blocking EC2 calls of the buildsteps.
+
+The buildsteps used to run boto calls with threads.deferToThread, on the
+reactor thread pool which also serves buildbot's database access. They use
+a dedicated pool instead, and wait for EC2 objects to change state with
+reactor timers rather than by blocking a thread.
+"""
+import threading
+import time
+
+from twisted.internet import defer, reactor, task, threads
+from twisted.python import threadpool
+
+
+DEFAULT_MAX_THREADS = 10
+
+
+class PollTimeout(Exception):
+
+    """
+    Error raised when a polled condition is not met in time.
+    """
+
+
+_pool = None
+_lock = threading.Lock()
+_stats = dict(
+    submitted=0,
+    started=0,
+    completed=0,
+    queued=0,
+    running=0,
+    wait_seconds_total=0.0,
+    wait_seconds_max=0.0,
+)
+
+
+def _get_pool():
+    """
+    Return the thread pool, creating it on first use.
+    """
+    global _pool
+    if _pool is None:
+        _pool = threadpool.ThreadPool(0, DEFAULT_MAX_THREADS, 'ec2')
+        reactor.callWhenRunning(_pool.start)
+        reactor.addSystemEventTrigger('during', 'shutdown', _pool.stop)
+    return _pool
+
+
+def configure(max_threads=None):
+    """
+    Resize the thread pool.
+    """
+    if max_threads is not None:
+        _get_pool().adjustPoolsize(0, max_threads)
+
+
+def _call(submitted_at, func, args, kw):
+    """
+    Run func in a pool thread, recording the time it waited in the queue.
+    """
+    wait = time.time() - submitted_at
+    with _lock:
+        _stats['started'] += 1
+        _stats['queued'] -= 1
+        _stats['running'] += 1
+        _stats['wait_seconds_total'] += wait
+        _stats['wait_seconds_max'] = max(_stats['wait_seconds_max'], wait)
+    try:
+        return func(*args, **kw)
+    finally:
+        with _lock:
+            _stats['running'] -= 1
+            _stats['completed'] += 1
+
+
+def run(func, *args, **kw):
+    """
+    Call func(*args, **kw) in the pool, return a Deferred.
+    """
+    with _lock:
+        _stats['submitted'] += 1
+        _stats['queued'] += 1
+    return threads.deferToThreadPool(reactor, _get_pool(), _call,
+                                     time.time(), func, args, kw)
+
+
+@defer.inlineCallbacks
+def poll(check, interval, timeout, description='condition'):
+    """
+    Call check() in the pool every interval seconds until it returns a
+    true value, then fire with that value.
+
+    No thread is held between two calls.
+    """
+    deadline = reactor.seconds() + timeout
+    while True:
+        result = yield run(check)
+        if result:
+            defer.returnValue(result)
+        if reactor.seconds() + interval > deadline:
+            raise PollTimeout('Timed out after {}s waiting for {}'
+                              .format(timeout, description))
+        yield task.deferLater(reactor, interval, lambda: None)
+
+
+def stats():
+    """
+    Return a copy of the pool metrics.
+    """
+    with _lock:
+        result = dict(_stats)
+    result['max_threads'] = _get_pool().max
+    if result['started']:
+        result['wait_seconds_mean'] = (result['wait_seconds_total']
+                                       / result['started'])
+    return result
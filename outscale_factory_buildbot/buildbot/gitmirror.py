@@ -0,0 +1,223 @@
+"""
+Shared Git mirrors on the master.
+
+The master keeps one bare mirror per repository URL. The pollers update
+the mirror, then fetch from it instead of the upstream repository. The
+mirrors are served over Git's dumb HTTP protocol by GitMirrorServer, on
+the master's private address only and without directory listings, so
+slaves clone from the master instead of from the internet. Slaves bypass
+the HTTP proxy for the mirrors, which would cache stale refs.
+"""
+import logging
+import os
+import re
+
+from twisted.application import strports
+from twisted.internet import defer, reactor, utils
+from twisted.python import failure
+from twisted.web import resource, server, static
+
+from buildbot.changes.gitpoller import GitPoller
+from buildbot.status.base import StatusReceiverMultiService
+
+
+# URL path where mirrors are served.
+MIRROR_PATH = 'gitmirrors'
+
+# Port of the mirror server.
+DEFAULT_PORT = 8125
+
+# Seconds during which a fresh mirror is not fetched again.
+MIN_UPDATE_INTERVAL = 10
+
+
+class GitMirrorError(Exception):
+
+    """
+    Error raised when a git command fails.
+    """
+
+
+@defer.inlineCallbacks
+def run_git(args, path, gitbin='git'):
+    """
+    Run git in path, return a Deferred firing with its decoded output.
+    """
+    out, err, code = yield utils.getProcessOutputAndValue(
+        gitbin, args, path=path, env=os.environ)
+    if code != 0:
+        raise GitMirrorError('git {} failed: {}'.format(
+            ' '.join(args), err.strip()))
+    defer.returnValue(out.decode('utf-8', 'replace'))
+
+
+class _MirrorFile(static.File):
+
+    """
+    Static files of the mirrors, without directory listings.
+    """
+
+    def directoryListing(self):
+        return resource.ForbiddenResource()
+
+
+class GitMirrors(object):
+
+    """
+    Bare mirrors of Git repositories, one per URL, under basedir.
+    """
+
+    def __init__(self, basedir, gitbin='git'):
+        self.basedir = os.path.abspath(basedir)
+        self.gitbin = gitbin
+        self._updating = {}
+        self._updated_at = {}
+
+    def name(self, url):
+        """
+        Return the directory name of the mirror of url.
+        """
+        return re.sub(r'[^A-Za-z0-9._-]+', '_', url.split('://')[-1]) + '.git'
+
+    def path(self, url):
+        """
+        Return the path of the mirror of url.
+        """
+        return os.path.join(self.basedir, self.name(url))
+
+    def url(self, url, base_url):
+        """
+        Return the URL slaves use to clone the mirror of url.
+        """
+        return '{}/{}/{}'.format(base_url.rstrip('/'), MIRROR_PATH,
+                                 self.name(url))
+
+    def update(self, url):
+        """
+        Create or update the mirror of url, return a Deferred.
+
+        Concurrent updates of the same URL share a single fetch.
+        """
+        if url in self._updating:
+            d = defer.Deferred()
+            self._updating[url].append(d)
+            return d
+        updated_at = self._updated_at.get(url)
+        if (updated_at is not None
+                and reactor.seconds() - updated_at < MIN_UPDATE_INTERVAL):
+            return defer.succeed(None)
+
+        self._updating[url] = []
+        d = self._update(url)
+
+        def done(result):
+            waiters = self._updating.pop(url)
+            if isinstance(result, failure.Failure):
+                for waiter in waiters:
+                    waiter.errback(result)
+            else:
+                self._updated_at[url] = reactor.seconds()
+                for waiter in waiters:
+                    waiter.callback(None)
+            return result
+        d.addBoth(done)
+        return d
+
+    @defer.inlineCallbacks
+    def _update(self, url):
+        path = self.path(url)
+        if not os.path.isdir(path):
+            if not os.path.isdir(self.basedir):
+                os.makedirs(self.basedir)
+            logging.info('Creating Git mirror of {}'.format(url))
+            yield self._git(['clone', '--mirror', url, path], self.basedir)
+        else:
+            yield self._git(['remote', 'update', '--prune'], path)
+        # Needed to serve the repository over dumb HTTP.
+        yield self._git(['update-server-info'], path)
+
+    def _git(self, args, path):
+        return run_git(args, path, self.gitbin)
+
+    def resource(self):
+        """
+        Return a web resource serving the mirrors.
+        """
+        if not os.path.isdir(self.basedir):
+            os.makedirs(self.basedir)
+        return _MirrorFile(self.basedir)
+
+
+class GitMirrorServer(StatusReceiverMultiService):
+
+    """
+    Status target serving the mirrors over HTTP on address:port.
+
+    Not authenticated: address should be on the master's private network.
+    """
+
+    def __init__(self, mirrors, address, port=DEFAULT_PORT):
+        StatusReceiverMultiService.__init__(self)
+        root = resource.Resource()
+        root.putChild(MIRROR_PATH, mirrors.resource())
+        strports.service('tcp:{}:interface={}'.format(port, address),
+                         server.Site(root)).setServiceParent(self)
+
+
+class MirroringGitPoller(GitPoller):
+
+    """
+    GitPoller updating a shared mirror, then fetching from it.
+    """
+
+    def __init__(self, mirrors, **kw):
+        GitPoller.__init__(self, **kw)
+        self.mirrors = mirrors
+        self._use_mirror = False
+
+    @defer.inlineCallbacks
+    def poll(self):
+        try:
+            yield self.mirrors.update(self.repourl)
+        except GitMirrorError as error:
+            # Fall back to the upstream repository for this poll.
+            logging.error('Could not update mirror: {}'.format(error))
+            self._use_mirror = False
+        else:
+            self._use_mirror = True
+        yield GitPoller.poll(self)
+
+    def _dovccmd(self, command, args, path=None):
+        if (command == 'fetch' and args and args[0] == self.repourl
+                and self._use_mirror):
+            args = [self.mirrors.path(self.repourl)] + list(args[1:])
+        return GitPoller._dovccmd(self, command, args, path)
+
+
+_mirrors = None
+
+
+def configure(basedir):
+    """
+    Enable the mirrors, stored under basedir.
+    """
+    global _mirrors
+    if _mirrors is None or _mirrors.basedir != os.path.abspath(basedir):
+        _mirrors = GitMirrors(basedir)
+    return _mirrors
+
+
+def listen_address(fc, meta):
+    """
+    Return (address, port) of the mirror server, by default on the
+    private address of the master.
+    """
+    return (fc.get('git_mirror_listen_address') or meta['local-ipv4'],
+            fc.get('git_mirror_listen_port', DEFAULT_PORT))
+
+
+def get_mirrors():
+    """
+    Return the configured mirrors, or None.
+    """
+    return _mirrors
@@ -0,0 +1,346 @@
+"""
+Pipeline metrics in the Prometheus text format.
+
+MetricsRecorder is a status target timing every step and build, by
+appliance, and counting their results. MeteredBuild times how long build
+requests wait for a slave and how long the slave takes to be ready; the
+EC2 build steps time their API calls apart from their waits for state
+changes. The stats() of the other services of the master are exported as
+gauges.
+
+MetricsResource serves all of them next to WebStatus.
+"""
+import numbers
+import re
+import threading
+import time
+
+from twisted.python import failure
+from twisted.web import resource
+
+from buildbot.process.build import Build
+from buildbot.status.base import StatusReceiverMultiService
+from buildbot.status.results import Results, SKIPPED
+
+
+# Upper bounds of the histogram buckets, in seconds.
+DEFAULT_BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1200,
+                   1800, 3600, 7200)
+
+METRICS = dict(
+    factory_build_duration_seconds=(
+        'histogram', 'Duration of the builds.'),
+    factory_build_results_total=(
+        'counter', 'Finished builds by result.'),
+    factory_build_queue_wait_seconds=(
+        'histogram', 'Time build requests waited for a slave.'),
+    factory_slave_prepare_seconds=(
+        'histogram', 'Time from slave assignment to build start, '
+                     'substantiation included.'),
+    factory_slave_substantiation_seconds=(
+        'histogram', 'Time to start a latent slave.'),
+    factory_step_duration_seconds=(
+        'histogram', 'Duration of the steps which ran.'),
+    factory_step_results_total=(
+        'counter', 'Finished steps by result.'),
+    factory_ec2_call_seconds=(
+        'histogram', 'EC2 API calls of the build steps.'),
+    factory_ec2_wait_seconds=(
+        'histogram', 'Waits of the build steps for EC2 state changes.'),
+)
+
+
+def _metric_name(name):
+    return re.sub('[^a-zA-Z0-9_]', '_', str(name))
+
+
+def _label_value(value):
+    return (str(value).replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, _label_value(value))
+                          for name, value in labels) + '}'
+
+
+def _format_value(value):
+    return repr(float(value))
+
+
+def _flatten(prefix, stats, labels, out):
+    """
+    Append (name, labels, value) gauges of a stats() dictionary to out.
+
+    Numbers become gauges named after their key; nested dictionaries are
+    labelled by their keys.
+    """
+    for field, value in sorted(stats.items()):
+        name = prefix + '_' + _metric_name(field)
+        if isinstance(value, bool):
+            value = int(value)
+        if isinstance(value, numbers.Number):
+            out.append((name, labels, value))
+        elif isinstance(value, dict):
+            for key, each in sorted(value.items()):
+                each_labels = labels + (('key', key),)
+                if isinstance(each, dict):
+                    _flatten(name, each, each_labels, out)
+                elif isinstance(each, numbers.Number):
+                    out.append((name, each_labels, each))
+
+
+class Registry(object):
+
+    """
+    Thread-safe counters and histograms, and sources of gauges.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._sources = []
+
+    def inc(self, name, amount=1, **labels):
+        """
+        Add amount to a counter.
+        """
+        key = name, tuple(sorted(labels.items()))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        """
+        Add a value to a histogram.
+        """
+        key = name, tuple(sorted(labels.items()))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = dict(
+                    buckets=[0] * len(self.buckets), count=0, sum=0.0)
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram['buckets'][index] += 1
+                    break
+            histogram['count'] += 1
+            histogram['sum'] += value
+
+    def add_source(self, name, stats, label=None):
+        """
+        Export the result of stats() as gauges prefixed with factory_name.
+
+        With label, the keys of the result are values of that label. stats
+        may return None when the service is not configured.
+        """
+        self._sources = [each for each in self._sources if each[0] != name]
+        self._sources.append((name, stats, label))
+
+    def _gauges(self):
+        gauges = []
+        for name, stats, label in self._sources:
+            values = stats()
+            if not values:
+                continue
+            prefix = 'factory_' + _metric_name(name)
+            if label is None:
+                _flatten(prefix, values, (), gauges)
+                continue
+            for key, each in sorted(values.items()):
+                if isinstance(each, dict):
+                    _flatten(prefix, each, ((label, key),), gauges)
+        return gauges
+
+    def render(self):
+        """
+        Return all metrics in the Prometheus text format.
+        """
+        lines = []
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted((key, dict(value, buckets=list(
+                value['buckets']))) for key, value in self._histograms.items())
+
+        seen = set()
+
+        def header(name, kind):
+            if name in seen:
+                return
+            seen.add(name)
+            kind, text = METRICS.get(name, (kind, None))
+            if text:
+                lines.append('# HELP {} {}'.format(name, text))
+            lines.append('# TYPE {} {}'.format(name, kind))
+
+        for (name, labels), value in counters:
+            header(name, 'counter')
+            lines.append('{}{} {}'.format(name, _format_labels(labels),
+                                          _format_value(value)))
+        for (name, labels), histogram in histograms:
+            header(name, 'histogram')
+            cumulative = 0
+            for bound, count in zip(self.buckets, histogram['buckets']):
+                cumulative += count
+                bucket_labels = labels + (('le', _format_value(bound)),)
+                lines.append('{}_bucket{} {}'.format(
+                    name, _format_labels(bucket_labels), cumulative))
+            bucket_labels = labels + (('le', '+Inf'),)
+            lines.append('{}_bucket{} {}'.format(
+                name, _format_labels(bucket_labels), histogram['count']))
+            lines.append('{}_sum{} {}'.format(name, _format_labels(labels),
+                                              _format_value(histogram['sum'])))
+            lines.append('{}_count{} {}'.format(name, _format_labels(labels),
+                                                histogram['count']))
+        for name, labels, value in sorted(self._gauges()):
+            header(name, 'gauge')
+            lines.append('{}{} {}'.format(name, _format_labels(labels),
+                                          _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+_registry = Registry()
+
+
+def inc(name, amount=1, **labels):
+    _registry.inc(name, amount, **labels)
+
+
+def observe(name, value, **labels):
+    _registry.observe(name, value, **labels)
+
+
+def add_source(name, stats, label=None):
+    _registry.add_source(name, stats, label)
+
+
+def render():
+    return _registry.render()
+
+
+def time_deferred(d, name, **labels):
+    """
+    Observe the seconds until d fires, labelled with its result.
+
+    Return d.
+    """
+    start = time.time()
+
+    def record(result):
+        ok = result is not False and not isinstance(result, failure.Failure)
+        observe(name, time.time() - start,
+                result='success' if ok else 'failure', **labels)
+        return result
+    d.addBoth(record)
+    return d
+
+
+def _result_name(result):
+    if isinstance(result, (tuple, list)):
+        result = result[0]
+    try:
+        return Results[result]
+    except (IndexError, TypeError):
+        return str(result)
+
+
+def _builder_appliance(builder):
+    config = getattr(builder, 'config', None)
+    properties = getattr(config, 'properties', None) or {}
+    return properties.get('appliance', builder.name)
+
+
+class MeteredBuild(Build):
+
+    """
+    Build timing the wait of its requests and the preparation of its slave.
+    """
+
+    _assigned = None
+
+    def setBuilder(self, builder):
+        Build.setBuilder(self, builder)
+        # The builder creates the build once a slave is chosen.
+        self._assigned = time.time()
+        self._appliance = _builder_appliance(builder)
+        submitted = [request.submittedAt for request in self.requests
+                     if request.submittedAt]
+        if submitted:
+            observe('factory_build_queue_wait_seconds',
+                    self._assigned - min(submitted),
+                    appliance=self._appliance)
+
+    def startBuild(self, build_status, expectations, slavebuilder):
+        if self._assigned is not None:
+            observe('factory_slave_prepare_seconds',
+                    time.time() - self._assigned,
+                    appliance=self._appliance)
+        return Build.startBuild(self, build_status, expectations,
+                                slavebuilder)
+
+
+class MetricsRecorder(StatusReceiverMultiService):
+
+    """
+    Status target recording the duration and result of steps and builds.
+    """
+
+    def __init__(self):
+        StatusReceiverMultiService.__init__(self)
+        self._status = None
+
+    def startService(self):
+        StatusReceiverMultiService.startService(self)
+        self._status = self.parent.getStatus()
+        self._status.subscribe(self)
+
+    def stopService(self):
+        if self._status is not None:
+            self._status.unsubscribe(self)
+        return StatusReceiverMultiService.stopService(self)
+
+    def builderAdded(self, name, builder):
+        # Subscribe to the builds of all builders.
+        return self
+
+    def buildStarted(self, builderName, build):
+        # Subscribe to the steps of the build.
+        return self
+
+    def stepStarted(self, build, step):
+        return None
+
+    def stepFinished(self, build, step, results):
+        appliance = build.getProperty('appliance', build.getBuilder().getName())
+        result = results[0] if isinstance(results, (tuple, list)) else results
+        inc('factory_step_results_total', appliance=appliance,
+            step=step.getName(), result=_result_name(result))
+        start, end = step.getTimes()
+        if result != SKIPPED and start is not None and end is not None:
+            observe('factory_step_duration_seconds', end - start,
+                    appliance=appliance, step=step.getName())
+
+    def buildFinished(self, builderName, build, results):
+        appliance = build.getProperty('appliance', builderName)
+        inc('factory_build_results_total', appliance=appliance,
+            result=_result_name(results))
+        start, end = build.getTimes()
+        if start is not None and end is not None:
+            observe('factory_build_duration_seconds', end - start,
+                    appliance=appliance)
+
+
+class MetricsResource(resource.Resource):
+
+    """
+    Web resource serving the metrics in the Prometheus text format.
+    """
+
+    isLeaf = True
+
+    def render_GET(self, request):
+        request.setHeader('content-type', 'text/plain; version=0.0.4')
+        return render().encode('utf-8')
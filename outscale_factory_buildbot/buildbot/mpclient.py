@@ -1,34 +1,137 @@
 #!/usr/bin/env python
+"""
+Client of the Marketplace appliance API.
+
+The appliance list is fetched page by page over a persistent session.
+With a cache directory, each page is stored on disk with its ETag and
+Last-Modified headers, and requested again conditionally: an unchanged
+page costs a 304 response instead of a download.
+"""
+import hashlib
 import json
+import os
 
 import requests
+from requests.compat import urljoin
 
-GET_APPLIANCE_PATH = '/api/v1/appliances/?limit=0'
+GET_APPLIANCE_PATH = '/api/v1/appliances/'
+
+# Appliances per page.
+DEFAULT_PAGE_SIZE = 100
+
+# Seconds to wait for the server to connect or send data.
+DEFAULT_TIMEOUT = 30
+
+
+class MarketplaceError(Exception):
+
+    """
+    Error raised when the Marketplace returns an error or a bad page.
+    """
 
 
 class MarketplaceClient(object):
-    def __init__(self, baseurl, username, password):
+    def __init__(self, baseurl, username, password,
+                 page_size=DEFAULT_PAGE_SIZE,
+                 timeout=DEFAULT_TIMEOUT,
+                 cache_dir=None):
         self.baseurl = baseurl
         self.auth = (username, password)
-
-    def get_appliance_list(self):
+        self.page_size = page_size
+        self.timeout = timeout
+        self.cache_dir = cache_dir
+        self.session = requests.Session()
+        self.session.auth = self.auth
+        self.session.headers['accept'] = 'application/json'
+        self.downloaded = 0
+        self.not_modified = 0
+
+    def close(self):
+        self.session.close()
+
+    def _cache_path(self, url):
+        return os.path.join(self.cache_dir,
+                            hashlib.sha1(url.encode('utf-8')).hexdigest()
+                            + '.json')
+
+    def _read_cache(self, url):
+        if self.cache_dir is None:
+            return None
+        try:
+            with open(self._cache_path(url)) as file_handle:
+                return json.load(file_handle)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def _write_cache(self, url, response, page):
+        if self.cache_dir is None:
+            return
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        entry = dict(
+            etag=response.headers.get('etag'),
+            last_modified=response.headers.get('last-modified'),
+            page=page,
+        )
+        path = self._cache_path(url)
+        with open(path + '.tmp', 'w') as file_handle:
+            json.dump(entry, file_handle)
+        os.rename(path + '.tmp', path)
+
+    def _get_page(self, url):
         """
-        Fetch a list of Turn Key Linux appliances from a Marketplace host
+        Return a page of the API as a dictionary, from the cache if the
+        server says it did not change.
         """
-        url = self.baseurl + GET_APPLIANCE_PATH
-        headers = {'content-type': 'application/json'}
-        response = requests.get(url, auth=self.auth, headers=headers)
+        cached = self._read_cache(url)
+        headers = {}
+        if cached is not None:
+            if cached.get('etag'):
+                headers['if-none-match'] = cached['etag']
+            if cached.get('last_modified'):
+                headers['if-modified-since'] = cached['last_modified']
+
+        response = self.session.get(url, headers=headers,
+                                    timeout=self.timeout)
+        if response.status_code == 304 and cached is not None:
+            self.not_modified += 1
+            return cached['page']
         if response.status_code != 200:
-            raise Exception(
+            raise MarketplaceError(
                 'Fetching appliance list failed with HTTP error code {}. {}'
                 .format(response.status_code, response.text))
 
-        dct = json.loads(response.text)
-
-        if not 'objects' in dct:
-            raise Exception('Missing "objects" item in JSON appliance list')
+        try:
+            page = response.json()
+        except ValueError as error:
+            raise MarketplaceError('Invalid JSON appliance list: {}'
+                                   .format(error))
+        if not 'objects' in page:
+            raise MarketplaceError(
+                'Missing "objects" item in JSON appliance list')
+        self.downloaded += 1
+        self._write_cache(url, response, page)
+        return page
+
+    def iter_appliances(self):
+        """
+        Yield Turn Key Linux appliances from a Marketplace host, as pages
+        arrive.
+        """
+        url = '{}{}?limit={}'.format(self.baseurl, GET_APPLIANCE_PATH,
+                                     self.page_size)
+        while url:
+            page = self._get_page(url)
+            for appliance in page['objects']:
+                yield appliance
+            next_path = (page.get('meta') or {}).get('next')
+            url = urljoin(self.baseurl, next_path) if next_path else None
 
-        return dct['objects']
+    def get_appliance_list(self):
+        """
+        Fetch a list of Turn Key Linux appliances from a Marketplace host
+        """
+        return list(self.iter_appliances())
 
 
 def main():
@@ -40,6 +143,10 @@ def main():
     parser.add_argument('username')
     parser.add_argument('marketplace_baseurl')
     parser.add_argument('-p', '--password')
+    parser.add_argument('--cache-dir',
+                        help='keep pages in this directory and only '
+                        'download the ones which changed')
+    parser.add_argument('--page-size', type=int, default=DEFAULT_PAGE_SIZE)
 
     args = parser.parse_args()
     if not args.password:
@@ -47,8 +154,13 @@ def main():
 
     mpclient = MarketplaceClient(args.marketplace_baseurl,
                                  args.username,
-                                 args.password)
-    print(mpclient.get_appliance_list())
+                                 args.password,
+                                 page_size=args.page_size,
+                                 cache_dir=args.cache_dir)
+    try:
+        print(mpclient.get_appliance_list())
+    finally:
+        mpclient.close()
     return 0
 
 
@@ -0,0 +1,233 @@
+"""
+Reaper of orphan build volumes.
+
+A build which dies between AttachNewVolume and DestroyVolume leaves its
+volume behind. The reaper periodically lists the volumes carrying the
+object tags, and deletes the ones older than a grace period which are
+detached, or attached to an instance which no longer exists. Volumes of
+the warm pool are left alone.
+
+It also reports, without deleting them, the snapshots which no image
+references.
+"""
+import logging
+import time
+from datetime import datetime
+
+from twisted.internet import defer, reactor, task
+
+from outscale_factory_buildbot.buildbot import ec2threads
+from outscale_factory_buildbot.buildbot.volumepool import WARM_TAG
+from outscale_factory_buildbot.tools import ec2_pool
+from outscale_factory_buildbot.tools import volumes
+
+
+# Instance states in which attached volumes are still in use.
+LIVE_INSTANCE_STATES = ('pending', 'running', 'stopping', 'stopped')
+
+
+def _age_seconds(volume, now):
+    """
+    Return the age of a volume, from its timestamp tag if any, else from
+    its creation time.
+
+    The timestamp tag is set by AttachNewVolume when a build takes the
+    volume, warm pool volumes may be much older.
+    """
+    try:
+        created = time.mktime(datetime.strptime(
+            volume.tags['timestamp'], '%y%m%d_%H%M').timetuple())
+    except (KeyError, ValueError):
+        created = (datetime.strptime(volume.create_time[:19],
+                                     '%Y-%m-%dT%H:%M:%S')
+                   - datetime(1970, 1, 1)).total_seconds()
+    return now - created
+
+
+def find_orphan_volumes(conn, tags, grace_seconds, now=None):
+    """
+    Return (ids of detached orphan volumes, ids of orphan volumes still
+    attached to a dead instance).
+    """
+    now = time.time() if now is None else now
+    filters = dict(('tag:' + k, v) for k, v in tags.items())
+    candidates = [volume for volume in conn.get_all_volumes(filters=filters)
+                  if WARM_TAG not in volume.tags
+                  and _age_seconds(volume, now) > grace_seconds]
+
+    instance_ids = set(volume.attach_data.instance_id
+                       for volume in candidates
+                       if volume.status == 'in-use'
+                       and volume.attach_data.instance_id)
+    live = set()
+    if instance_ids:
+        instances = conn.get_only_instances(filters={
+            'instance-id': sorted(instance_ids),
+            'instance-state-name': list(LIVE_INSTANCE_STATES)})
+        live = set(instance.id for instance in instances)
+
+    detached = []
+    attached = []
+    for volume in candidates:
+        if volume.status == 'available':
+            detached.append(volume.id)
+        elif (volume.status == 'in-use'
+              and volume.attach_data.instance_id not in live):
+            attached.append(volume.id)
+    return sorted(detached), sorted(attached)
+
+
+def find_unreferenced_snapshots(conn, grace_seconds, now=None):
+    """
+    Return ids of completed snapshots owned by the account which no image
+    of the account references, older than grace_seconds.
+    """
+    now = time.time() if now is None else now
+    referenced = set()
+    for image in conn.get_all_images(owners=['self']):
+        for device in (image.block_device_mapping or {}).values():
+            if device.snapshot_id:
+                referenced.add(device.snapshot_id)
+    unreferenced = []
+    for snapshot in conn.get_all_snapshots(owner='self'):
+        if snapshot.id in referenced or snapshot.status != 'completed':
+            continue
+        started = (datetime.strptime(snapshot.start_time[:19],
+                                     '%Y-%m-%dT%H:%M:%S')
+                   - datetime(1970, 1, 1)).total_seconds()
+        if now - started > grace_seconds:
+            unreferenced.append(snapshot.id)
+    return sorted(unreferenced)
+
+
+class VolumeReaper(object):
+
+    """
+    Periodically delete orphan volumes carrying tags in a region.
+    """
+
+    def __init__(self,
+                 region,
+                 tags,
+                 grace_seconds=3 * 3600,
+                 interval=1800,
+                 concurrency=4,
+                 report_snapshots=True):
+        self.region = region
+        self.tags = dict(tags)
+        self.grace_seconds = grace_seconds
+        self.interval = interval
+        self.concurrency = concurrency
+        self.report_snapshots = report_snapshots
+        self.unreferenced_snapshots = []
+        self._loop = None
+        self._running = False
+        self._stats = dict(runs=0, failed_runs=0, volumes_deleted=0,
+                           volumes_detached=0, delete_errors=0,
+                           unreferenced_snapshots=0)
+
+    def start(self):
+        if self._loop is not None:
+            return
+        self._loop = task.LoopingCall(self.run)
+        d = self._loop.start(self.interval, now=False)
+        d.addErrback(lambda f: logging.error('Volume reaper stopped: {}'
+                                             .format(f.getErrorMessage())))
+
+    def stop(self):
+        if self._loop is not None and self._loop.running:
+            self._loop.stop()
+        self._loop = None
+
+    def _call(self, func, *args):
+        """
+        Call func(conn, *args) in the EC2 thread pool, return a Deferred.
+        """
+        def call():
+            with ec2_pool.connection(self.region) as conn:
+                return func(conn, *args)
+        return ec2threads.run(call)
+
+    @defer.inlineCallbacks
+    def run(self):
+        """
+        Reap orphan volumes once.
+        """
+        if self._running:
+            return
+        self._running = True
+        try:
+            yield self._reap()
+        except Exception as error:
+            self._stats['failed_runs'] += 1
+            logging.error('Volume reaper failed in {}: {}'
+                          .format(self.region, error))
+        finally:
+            self._running = False
+
+    @defer.inlineCallbacks
+    def _reap(self):
+        detached, attached = yield self._call(find_orphan_volumes,
+                                              self.tags,
+                                              self.grace_seconds)
+
+        # Batches of at most concurrency calls run at the same time.
+        semaphore = defer.DeferredSemaphore(max(1, self.concurrency))
+        deletions = [semaphore.run(self._call, volumes.delete_volume,
+                                   volume_id)
+                     for volume_id in detached]
+        # Volumes of dead instances are deleted by a later run, once
+        # detached.
+        detachments = [semaphore.run(self._call, volumes.detach_volume,
+                                     volume_id, True)
+                       for volume_id in attached]
+        outcomes = yield defer.DeferredList(deletions + detachments,
+                                            consumeErrors=True)
+        errors = [(volume_id, result.getErrorMessage())
+                  for volume_id, (ok, result)
+                  in zip(detached + attached, outcomes) if not ok]
+        for volume_id, message in errors:
+            logging.error('Could not reap volume {}: {}'
+                          .format(volume_id, message))
+        deleted = len(detached) - len([volume_id for volume_id, _ in errors
+                                       if volume_id in detached])
+
+        if self.report_snapshots:
+            self.unreferenced_snapshots = yield self._call(
+                find_unreferenced_snapshots, self.grace_seconds)
+
+        self._stats['runs'] += 1
+        self._stats['volumes_deleted'] += deleted
+        self._stats['volumes_detached'] += len(attached)
+        self._stats['delete_errors'] += len(errors)
+        self._stats['unreferenced_snapshots'] = len(self.unreferenced_snapshots)
+        logging.info('Volume reaper in {}: {} orphan volumes deleted, '
+                     '{} detached from dead instances, {} errors, '
+                     '{} snapshots referenced by no image'
+                     .format(self.region, deleted, len(attached), len(errors),
+                             len(self.unreferenced_snapshots)))
+        if self.unreferenced_snapshots:
+            logging.info('Unreferenced snapshots: {}'
+                         .format(' '.join(self.unreferenced_snapshots)))
+
+    def stats(self):
+        return dict(self._stats)
+
+
+_reaper = None
+
+
+def configure(reaper):
+    """
+    Install the volume reaper, or None. It starts once the reactor runs.
+    """
+    global _reaper
+    if _reaper is not None:
+        _reaper.stop()
+    _reaper = reaper
+    if reaper is not None:
+        reactor.callWhenRunning(reaper.start)
+
+
+def get_reaper():
+    return _reaper
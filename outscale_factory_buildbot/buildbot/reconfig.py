@@ -0,0 +1,83 @@
+"""
+Reuse of config objects across reconfigs.
+
+Modules of this subpackage stay loaded when the master re-reads its
+config. The configure_* functions keep the objects they build for each
+repository entry in an ObjectCache, keyed by the entry and fingerprinted
+with the settings they depend on. On reconfig, objects of unchanged
+entries are returned as is: they are not built again, and buildbot finds
+them equal to the running ones and leaves them alone.
+"""
+import hashlib
+import json
+
+
+def fingerprint(*parts):
+    """
+    Return a digest of JSON-like parts.
+    """
+    data = json.dumps(parts, sort_keys=True, default=repr)
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+
+# Named caches, for stats().
+_caches = {}
+
+
+class ObjectCache(object):
+
+    """
+    Config objects by key, with the fingerprint they were built for.
+
+    Call start() before a configuration pass and prune() after it: objects
+    not requested during the pass are dropped.
+    """
+
+    def __init__(self, name=None):
+        self.name = name
+        self._objects = {}
+        self._used = set()
+        self.hits = 0
+        self.misses = 0
+        if name is not None:
+            _caches[name] = self
+
+    def start(self):
+        self._used = set()
+
+    def get(self, key, fp, make):
+        """
+        Return the object cached for key if it was built for fp, else
+        the result of make(), cached.
+        """
+        self._used.add(key)
+        entry = self._objects.get(key)
+        if entry is not None and entry[0] == fp:
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        obj = make()
+        self._objects[key] = (fp, obj)
+        return obj
+
+    def peek(self, key):
+        """
+        Return the object cached for key, or None.
+        """
+        entry = self._objects.get(key)
+        return entry[1] if entry is not None else None
+
+    def prune(self):
+        for key in set(self._objects) - self._used:
+            del self._objects[key]
+
+    def stats(self):
+        return dict(size=len(self._objects), hits=self.hits,
+                    misses=self.misses)
+
+
+def stats():
+    """
+    Return the counters of the named caches.
+    """
+    return dict((name, cache.stats()) for name, cache in _caches.items())
@@ -0,0 +1,195 @@
+"""
+Region-wide image retention.
+
+DestroyOldImages used to list the region's images at the end of every
+build to delete the old versions of one appliance. The retention service
+lists the images once, groups them by appliance tag and deletes the old
+versions of all appliances in one bulk deletion. It runs periodically,
+and shortly after builds hint that an appliance has a new image: hints
+received within hint_delay seconds are served by a single run.
+"""
+import logging
+
+from twisted.internet import defer, reactor, task
+
+from outscale_factory_buildbot.buildbot import ec2threads
+from outscale_factory_buildbot.tools.delete_images import delete_images
+from outscale_factory_buildbot.tools.find_images import iter_images
+
+
+def plan_retention(images, max_versions, appliances=None):
+    """
+    Return (ids of images to delete, dictionary of appliance -> number of
+    images kept).
+
+    Images are grouped by appliance tag and sorted by timestamp tag; the
+    max_versions most recent of each appliance are kept. With appliances,
+    other appliances are left alone. Images missing either tag are kept.
+    """
+    groups = {}
+    for image in images:
+        appliance = image.tags.get('appliance')
+        if not appliance or 'timestamp' not in image.tags:
+            continue
+        if appliances is not None and appliance not in appliances:
+            continue
+        groups.setdefault(appliance, []).append(image)
+
+    delete = []
+    kept = {}
+    for appliance, group in groups.items():
+        group.sort(key=lambda x: x.tags['timestamp'])
+        old = group[:-max_versions] if max_versions > 0 else []
+        delete.extend(each.id for each in old)
+        kept[appliance] = len(group) - len(old)
+    return sorted(delete), kept
+
+
+class RetentionService(object):
+
+    """
+    Keep max_versions images of each appliance in a region.
+    """
+
+    def __init__(self,
+                 region,
+                 max_versions,
+                 appliances=None,
+                 interval=3600,
+                 hint_delay=300,
+                 concurrency=4):
+        self.region = region
+        self.max_versions = max_versions
+        self.appliances = set(appliances) if appliances is not None else None
+        self.interval = interval
+        self.hint_delay = hint_delay
+        self.concurrency = concurrency
+        self._loop = None
+        self._call = None
+        self._running = None
+        self._stats = dict(hints=0, runs=0, failed_runs=0, images_deleted=0,
+                           snapshots_deleted=0, delete_errors=0)
+
+    def start(self):
+        """
+        Start the periodic runs.
+        """
+        if self._loop is not None:
+            return
+        self._loop = task.LoopingCall(self.run)
+        d = self._loop.start(self.interval, now=False)
+        d.addErrback(lambda f: logging.error('Image retention stopped: {}'
+                                             .format(f.getErrorMessage())))
+
+    def stop(self):
+        if self._loop is not None and self._loop.running:
+            self._loop.stop()
+        self._loop = None
+        if self._call is not None and self._call.active():
+            self._call.cancel()
+        self._call = None
+
+    def hint(self, appliance):
+        """
+        Note that appliance has a new image, and schedule a run.
+        """
+        self._stats['hints'] += 1
+        logging.debug('Image retention hint for {}'.format(appliance))
+        if self._call is None or not self._call.active():
+            self._call = reactor.callLater(self.hint_delay, self.run)
+
+    def run(self):
+        """
+        Run the retention once, return a Deferred.
+
+        A run requested while another is running shares its result.
+        """
+        if self._running is not None:
+            d = defer.Deferred()
+
+            def chain(result):
+                d.callback(None)
+                return result
+            self._running.addBoth(chain)
+            return d
+        if self._call is not None and self._call.active():
+            self._call.cancel()
+        d = ec2threads.run(self._collect)
+        d.addCallbacks(self._collected, self._failed)
+
+        def done(result):
+            self._running = None
+            return result
+        d.addBoth(done)
+        self._running = d
+        return d
+
+    def _collected(self, report):
+        # On the reactor thread, which also reads the counters.
+        self._stats['runs'] += 1
+        self._stats['images_deleted'] += len(report.deleted)
+        self._stats['snapshots_deleted'] += len(report.snapshots_deleted)
+        self._stats['delete_errors'] += len(report.failed)
+        return report
+
+    def _failed(self, f):
+        self._stats['failed_runs'] += 1
+        logging.error('Image retention failed in {}: {}'
+                      .format(self.region, f.getErrorMessage()))
+
+    def _collect(self):
+        """
+        List the images once and delete the old versions. Blocking.
+
+        Return the deletion report, counted by _collected.
+        """
+        images = list(iter_images(self.region, owners=['self']))
+        delete, kept = plan_retention(images, self.max_versions,
+                                      self.appliances)
+
+        report = delete_images(self.region, delete,
+                               concurrency=self.concurrency)
+        # Only the root snapshots are deleted with the images.
+        snapshot_count = len(report.snapshots_deleted)
+        logging.info('Image retention in {}: {} images of {} appliances '
+                     'listed, {} images and {} snapshots reclaimed, '
+                     '{} failures'.format(self.region, len(images), len(kept),
+                                          len(report.deleted), snapshot_count,
+                                          len(report.failed)))
+        return report
+
+    def stats(self):
+        return dict(self._stats)
+
+
+_service = None
+
+
+def configure(service):
+    """
+    Install the retention service used by DestroyOldImages, or None.
+
+    The service starts once the reactor runs.
+    """
+    global _service
+    if _service is not None:
+        _service.stop()
+    _service = service
+    if service is not None:
+        reactor.callWhenRunning(service.start)
+
+
+def get_service():
+    return _service
+
+
+def hint(appliance):
+    """
+    Schedule a retention run for appliance.
+
+    Return False if there is no retention service.
+    """
+    if _service is None:
+        return False
+    _service.hint(appliance)
+    return True
@@ -1,12 +1,21 @@
 """
 Scheduler configuration
 """
+import logging
 
 from buildbot.schedulers.basic import SingleBranchScheduler
 from buildbot.schedulers.forcesched import ForceScheduler, FixedParameter
+from buildbot.schedulers.forcesched import BooleanParameter
 from buildbot.schedulers import timed
 from buildbot.changes import filter
 
+from outscale_factory_buildbot.buildbot import durations
+from outscale_factory_buildbot.buildbot import reconfig
+
+
+# Schedulers of the repository entries, reused on reconfig.
+_schedulers = reconfig.ObjectCache('schedulers')
+
 
 def _parse_crontab_record(crontab):
     """
@@ -27,6 +36,78 @@ def _parse_crontab_record(crontab):
     return parsed
 
 
+def _stagger_offsets(build_seconds, capacity, window):
+    """
+    Plan nightly builds over capacity slaves, see durations.plan.
+
+    If the plan is longer than window seconds, start offsets are compressed
+    to fit in the window and the extra builds wait in the queue.
+
+    Return a dictionary of builder name -> start offset in seconds.
+    """
+    offsets, _ = durations.plan(build_seconds, capacity)
+    last = max(offsets.values()) if offsets else 0
+    if last > window:
+        scale = float(window) / last
+        offsets = dict((name, offset * scale) for name, offset in offsets.items())
+    return offsets
+
+
+def _shift_crontab(crontab, offset):
+    """
+    Return a parsed crontab record starting offset seconds later.
+
+    The minute and hour of crontab must be integers. Past midnight, the
+    day of week is shifted too; records with a fixed day of month or month
+    are kept on the same day, at 23:59 at the latest.
+    """
+    minute, hour, dayOfMonth, month, dayOfWeek = crontab
+    minutes = hour * 60 + minute + int(offset) // 60
+    days, minutes = divmod(minutes, 24 * 60)
+    if days and (dayOfMonth != '*' or month != '*'):
+        days, minutes = 0, 24 * 60 - 1
+    if days and dayOfWeek != '*':
+        dayOfWeek = (dayOfWeek + days) % 7
+    return [minutes % 60, minutes // 60, dayOfMonth, month, dayOfWeek]
+
+
+def _slave_capacity(c, fc, repos):
+    # Number of builds which can run at the same time.
+    if c.get('slaves'):
+        return len(c['slaves'])
+    if fc.get('use_ec2_slaves', True):
+        return min(len(repos), fc['ec2_slaves']['max_instances'])
+    return len(fc.get('plain_slaves') or [])
+
+
+def _nightly_crontabs(c, fc, repos, crontab):
+    """
+    Return a dictionary of builder name -> parsed crontab record.
+
+    With nightly_stagger, start times are spread over nightly_window_seconds
+    from the expected duration of each build and the slave capacity.
+    """
+    names = ['-'.join((appliance, branch)) for appliance, repourl, branch in repos]
+    if not fc.get('nightly_stagger', False):
+        return dict((name, crontab) for name in names)
+    if crontab[0] == '*' or crontab[1] == '*':
+        logging.warning('Nightly builds not staggered: '
+                        'nightly_crontab needs a fixed minute and hour')
+        return dict((name, crontab) for name in names)
+
+    table = durations.configure(fc.get('build_durations_file'))
+    build_seconds = table.expected(
+        names, fc.get('nightly_default_build_seconds', 3600))
+
+    capacity = _slave_capacity(c, fc, repos)
+    window = fc.get('nightly_window_seconds', 6 * 3600)
+    offsets = _stagger_offsets(build_seconds, capacity, window)
+    logging.info('Staggering {} nightly builds over {} slaves in {:.0f}s'
+                 .format(len(names), capacity, max(offsets.values() or [0])))
+    return dict((name, _shift_crontab(crontab, offsets[name]))
+                for name in names)
+
+
 def configure_schedulers(c, fc, repos, meta):
     # Configure the Schedulers, which decide how to react to incoming changes.
 
@@ -36,44 +117,69 @@ def configure_schedulers(c, fc, repos, meta):
     enableNightlyScheduler = fc.get('nightly_scheduler', False)
     if enableNightlyScheduler:
         crontab = _parse_crontab_record(fc['nightly_crontab'])
+        crontabs = _nightly_crontabs(c, fc, repos, crontab)
 
+    _schedulers.start()
     for appliance, repourl, branch in repos:
         name = '-'.join((appliance, branch))
-        builderNames = [name]
-        c['schedulers'].append(ForceScheduler(
-            name='force-{}'.format(name),
-            builderNames=builderNames,
-            revision=FixedParameter(name="revision", default=""),
-            repository=FixedParameter(name="repository", default=""),
-            project=FixedParameter(name="project", default=""),
-            branch=FixedParameter(name="branch", default=branch),
-            properties=[],
-        ))
+        nightly = crontabs[name] if enableNightlyScheduler else None
+        fp = reconfig.fingerprint(appliance, branch, treeStableTimer, nightly)
+        c['schedulers'].extend(_schedulers.get(
+            (appliance, repourl, branch), fp,
+            lambda: _make_schedulers(appliance, branch, treeStableTimer,
+                                     nightly)))
+    _schedulers.prune()
+
+
+def _make_schedulers(appliance, branch, treeStableTimer, crontab):
+    """
+    Return the schedulers of a repository entry.
 
-        change_filter = filter.ChangeFilter(
-            project=appliance,
-            branch=branch
-        )
+    crontab: parsed nightly crontab record, None without nightly builds.
+    """
+    schedulers = []
+    name = '-'.join((appliance, branch))
+    builderNames = [name]
+    schedulers.append(ForceScheduler(
+        name='force-{}'.format(name),
+        builderNames=builderNames,
+        revision=FixedParameter(name="revision", default=""),
+        repository=FixedParameter(name="repository", default=""),
+        project=FixedParameter(name="project", default=""),
+        branch=FixedParameter(name="branch", default=branch),
+        properties=[
+            # Rebuild even if an image of the revision exists.
+            BooleanParameter(name='force_rebuild',
+                             label='Rebuild existing image',
+                             default=False),
+        ],
+    ))
+
+    change_filter = filter.ChangeFilter(
+        project=appliance,
+        branch=branch
+    )
 
-        c['schedulers'].append(SingleBranchScheduler(
-            name='onchanges-{}'.format(name),
+    schedulers.append(SingleBranchScheduler(
+        name='onchanges-{}'.format(name),
+        builderNames=builderNames,
+        change_filter=change_filter,
+        treeStableTimer=treeStableTimer,
+    ))
+
+    if crontab is not None:
+        schedulers.append(timed.Nightly(
+            name='nightly-{}'.format(name),
             builderNames=builderNames,
+            branch=branch, # Nightly requires a 'branch' argument
             change_filter=change_filter,
-            treeStableTimer=treeStableTimer,
+            minute=crontab[0],
+            hour=crontab[1],
+            dayOfMonth=crontab[2],
+            month=crontab[3],
+            dayOfWeek=crontab[4],
+            onlyIfChanged=False,
+            onlyImportant=False,
+            fileIsImportant=None,
         ))
-
-        if enableNightlyScheduler:
-            c['schedulers'].append(timed.Nightly(
-                name='nightly-{}'.format(name),
-                builderNames=builderNames,
-                branch=branch, # Nightly requires a 'branch' argument
-                change_filter=change_filter,
-                minute=crontab[0],
-                hour=crontab[1],
-                dayOfMonth=crontab[2],
-                month=crontab[3],
-                dayOfWeek=crontab[4],
-                onlyIfChanged=False,
-                onlyImportant=False,
-                fileIsImportant=None,
-            ))
+    return schedulers
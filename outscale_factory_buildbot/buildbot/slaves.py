@@ -6,10 +6,17 @@ import boto
 from buildbot.buildslave import BuildSlave
 from buildbot.ec2buildslave import EC2LatentBuildSlave
 
+from outscale_factory_buildbot.buildbot import autoscale
+from outscale_factory_buildbot.buildbot import metrics
+from outscale_factory_buildbot.buildbot import reconfig
+from outscale_factory_buildbot.tools import ratelimit
 from outscale_factory_buildbot.tools.gen_password import generate_password
 from outscale_factory_buildbot.tools.get_image import get_image_id
 
 
+# EC2 slaves, reused on reconfig with their password.
+_ec2_slaves = reconfig.ObjectCache('slaves')
+
 BOTO_ERROR_MSG = """
 AWS credentials missing from Boto config file!
 Run turnkey-init or see
@@ -17,6 +24,22 @@ http://boto.readthedocs.org/en/latest/boto_config_tut.html
 """
 
 
+class MeteredEC2LatentBuildSlave(EC2LatentBuildSlave):
+
+    """
+    EC2 latent slave recording how long it takes to substantiate.
+    """
+
+    def substantiate(self, sb, build):
+        starting = (not self.substantiated
+                    and self.substantiation_deferred is None)
+        d = EC2LatentBuildSlave.substantiate(self, sb, build)
+        if starting:
+            metrics.time_deferred(d, 'factory_slave_substantiation_seconds',
+                                  slave=self.slavename)
+        return d
+
+
 def _configure_plain_buildslaves(c, fc, repos, meta):
     # 'plain_slaves' is a list of dictionaries
     slave_info_list = fc.get('plain_slaves')
@@ -33,6 +56,25 @@ def _configure_plain_buildslaves(c, fc, repos, meta):
             ))
 
 
+def _configure_autoscale(fc, slave_instance_count):
+    # Optional capacity controller, see autoscale.py.
+    # Settings are read from the 'ec2_slaves' section of slave.json.
+    settings = fc['ec2_slaves']
+    if not settings.get('autoscale', False):
+        autoscale.configure(None)
+        return None
+    controller = autoscale.CapacityController(
+        min_slaves=min(settings.get('min_instances', 0), slave_instance_count),
+        max_slaves=slave_instance_count,
+        scale_up_backlog=settings.get('scale_up_backlog', 1),
+        scale_down_delay=settings.get('scale_down_delay_seconds', 600),
+        idle_timeout=settings.get('build_wait_timeout_idle_seconds', 60),
+        busy_timeout=settings.get('build_wait_timeout_busy_seconds', 600),
+        interval=settings.get('autoscale_interval_seconds', 30))
+    autoscale.configure(controller)
+    return controller
+
+
 def _configure_ec2_buildslaves(c, fc, repos, meta):
     # Buildmaster address
     master_address = meta['public-ipv4']
@@ -51,37 +93,63 @@ def _configure_ec2_buildslaves(c, fc, repos, meta):
     repo_count = len(repos)
     max_instances = fc['ec2_slaves']['max_instances']
     slave_instance_count = min(repo_count, max_instances)
+    controller = _configure_autoscale(fc, slave_instance_count)
 
     # Slave instance settings
     slave_size = fc['slave_instance_size']
     slave_image = get_image_id(
         region,
         fc['slave_instance_ami_pattern'],
-        fc['slave_instance_ami_tags'])
-
+        fc['slave_instance_ami_tags'],
+        fc.get('slave_instance_ami_owners'))
+
+    settings = dict(
+        master_address=master_address,
+        aws_id=aws_id,
+        region=region,
+        keypair=keypair,
+        security_group=security_group,
+        slave_size=slave_size,
+        slave_image=slave_image,
+    )
+    fp = reconfig.fingerprint(settings, aws_key)
+
+    _ec2_slaves.start()
     for slave_id in range(0, slave_instance_count):
         slave_name = 'buildslave_{:03d}'.format(slave_id)
-        slave_password = generate_password()
-
-        slave_user_data = '\n'.join((
-            master_address,
-            slave_name,
-            slave_password))
-
-        c['slaves'].append(
-            EC2LatentBuildSlave(
-                slave_name,
-                slave_password,
-                slave_size,
-                ami=slave_image,
-                identifier=aws_id,
-                secret_identifier=aws_key,
-                region=region,
-                keypair_name=keypair,
-                security_name=security_group,
-                user_data=slave_user_data,
-                max_builds=1,
-            ))
+        slave = _ec2_slaves.get(
+            slave_name, fp,
+            lambda: _make_ec2_buildslave(slave_name, aws_key, settings))
+        if controller is not None:
+            controller.register(slave)
+        c['slaves'].append(slave)
+    _ec2_slaves.prune()
+
+
+def _make_ec2_buildslave(slave_name, aws_key, settings):
+    slave_password = generate_password()
+
+    slave_user_data = '\n'.join((
+        settings['master_address'],
+        slave_name,
+        slave_password))
+
+    slave = MeteredEC2LatentBuildSlave(
+        slave_name,
+        slave_password,
+        settings['slave_size'],
+        ami=settings['slave_image'],
+        identifier=settings['aws_id'],
+        secret_identifier=aws_key,
+        region=settings['region'],
+        keypair_name=settings['keypair'],
+        security_name=settings['security_group'],
+        user_data=slave_user_data,
+        max_builds=1,
+    )
+    # Instances are started and stopped within the shared EC2 rate limits.
+    ratelimit.install(slave.conn)
+    return slave
 
 
 def configure_buildslaves(c, fc, repos, meta):
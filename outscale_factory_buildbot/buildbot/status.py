@@ -1,10 +1,105 @@
 """
 Status targets config
 """
+import json
+
+from twisted.application import strports
+from twisted.web import resource, server
+
 from buildbot.status import html
+from buildbot.status.base import StatusReceiverMultiService
 from buildbot.status.web.authz import Authz
 from buildbot.status.web.auth import HTPasswdAuth
 
+from outscale_factory_buildbot.buildbot import autoscale
+from outscale_factory_buildbot.buildbot import changesources
+from outscale_factory_buildbot.buildbot import durations
+from outscale_factory_buildbot.buildbot import ec2threads
+from outscale_factory_buildbot.buildbot import gitmirror
+from outscale_factory_buildbot.buildbot import metrics
+from outscale_factory_buildbot.buildbot import reaper
+from outscale_factory_buildbot.buildbot import reconfig
+from outscale_factory_buildbot.buildbot import retention
+from outscale_factory_buildbot.buildbot import volumepool
+from outscale_factory_buildbot.buildbot import workqueue
+from outscale_factory_buildbot.tools import ec2_pool
+from outscale_factory_buildbot.tools import image_cache
+from outscale_factory_buildbot.tools import ratelimit
+
+
+# Port of the operational resources, on the private network.
+DEFAULT_OPS_PORT = 8126
+
+
+class OpsServer(StatusReceiverMultiService):
+
+    """
+    Status target serving operational resources over HTTP on address:port.
+
+    Not authenticated: address should be on the master's private network.
+    """
+
+    def __init__(self, children, address, port=DEFAULT_OPS_PORT):
+        StatusReceiverMultiService.__init__(self)
+        root = resource.Resource()
+        for path, child in sorted(children.items()):
+            root.putChild(path, child)
+        strports.service('tcp:{}:interface={}'.format(port, address),
+                         server.Site(root)).setServiceParent(self)
+
+
+class _StatsResource(resource.Resource):
+
+    """
+    Web resource serving the dictionary returned by stats() as JSON.
+    """
+
+    isLeaf = True
+
+    def __init__(self, stats):
+        resource.Resource.__init__(self)
+        self.stats = stats
+
+    def render_GET(self, request):
+        request.setHeader('content-type', 'application/json')
+        return json.dumps(self.stats(), indent=2, sort_keys=True).encode('utf-8')
+
+
+def _work_queue_stats():
+    queue = workqueue.get_queue()
+    if queue is None:
+        return {}
+    return queue.stats()
+
+
+def _service_stats(get_service):
+    """
+    Return a function returning the stats() of the configured service.
+    """
+    def stats():
+        service = get_service()
+        if service is None:
+            return None
+        return service.stats()
+    return stats
+
+
+def _configure_metrics():
+    # Services whose stats() are exported as gauges.
+    metrics.add_source('ec2_pool', ec2_pool.stats)
+    metrics.add_source('ec2_rate', ratelimit.stats, label='action_class')
+    metrics.add_source('ec2threads', ec2threads.stats)
+    metrics.add_source('image_cache', image_cache.stats)
+    metrics.add_source('autoscale', _service_stats(autoscale.get_controller))
+    metrics.add_source('volumepool', volumepool.stats, label='pool')
+    metrics.add_source('retention', _service_stats(retention.get_service))
+    metrics.add_source('reaper', _service_stats(reaper.get_reaper))
+    metrics.add_source('workqueue', _service_stats(workqueue.get_queue))
+    metrics.add_source('batchpoller', changesources.batch_poller_stats,
+                       label='appliance')
+    metrics.add_source('reconfig', reconfig.stats, label='cache')
+
+
 def configure_status(c, fc, repos, meta):
     # STATUS TARGETS
     # 'status' is a list of Status Targets. The results of each build will be
@@ -23,11 +118,41 @@ def configure_status(c, fc, repos, meta):
         stopAllBuilds='auth',
         cancelPendingBuild='auth',
     )
-    c['status'].append(html.WebStatus(
+    web_status = html.WebStatus(
         http_port=http_port,
         authz=authz_cfg,
         change_hook_dialects=dict(base=True),
-    ))
+    )
+    c['status'].append(web_status)
+
+    # Operational resources are served on the private network only, not
+    # next to the public web status.
+    ops = {}
+    if fc.get('background_cleanup', False):
+        # Backlog and latency of the background work queue.
+        ops['workqueue'] = _StatsResource(_work_queue_stats)
+
+    # Record build durations, used to plan and order builds, and serve
+    # them as JSON.
+    table = durations.configure(fc.get('build_durations_file'))
+    ops['durations'] = durations.DurationResource(
+        table, fc.get('nightly_default_build_seconds', 3600))
+
+    # Step, build and service metrics for Prometheus.
+    _configure_metrics()
+    ops['metrics'] = metrics.MetricsResource()
+    c['status'].append(OpsServer(
+        ops,
+        fc.get('ops_listen_address') or meta['local-ipv4'],
+        fc.get('ops_listen_port', DEFAULT_OPS_PORT)))
+    if fc.get('git_mirror', False):
+        # Serve the shared Git mirrors to the slaves, on the private
+        # network only.
+        mirrors = gitmirror.configure(fc.get('git_mirror_dir', 'gitmirrors'))
+        address, port = gitmirror.listen_address(fc, meta)
+        c['status'].append(gitmirror.GitMirrorServer(mirrors, address, port))
+    c['status'].append(durations.DurationRecorder(table))
+    c['status'].append(metrics.MetricsRecorder())
 
     # PROJECT IDENTITY
 
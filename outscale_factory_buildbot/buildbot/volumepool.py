@@ -0,0 +1,188 @@
+"""
+Warm pool of pre-created build volumes.
+
+The master keeps a number of unattached volumes ready in an availability
+zone, so that AttachNewVolume does not wait for a volume to be created.
+Warm volumes carry the object tags plus a WARM_TAG tag holding the zone
+name. Claiming a volume removes that tag; the master serializes claims so
+that two builds never get the same volume.
+"""
+import logging
+import threading
+from datetime import datetime
+
+from twisted.internet import defer, reactor
+
+from outscale_factory_buildbot.buildbot import ec2threads
+from outscale_factory_buildbot.tools import ec2_pool
+from outscale_factory_buildbot.tools import volumes
+
+
+# Tag marking volumes waiting in a warm pool.
+WARM_TAG = 'warm_pool'
+
+
+class WarmVolumePool(object):
+
+    """
+    Warm volumes of a given size and tags in one availability zone.
+    """
+
+    def __init__(self, region, location, size_gib, tags, target_size):
+        self.region = region
+        self.location = location
+        self.size_gib = size_gib
+        self.tags = dict(tags)
+        self.target_size = target_size
+        self._lock = threading.Lock()
+        self._claimed = set()
+        self._creating = 0
+        self._refilling = False
+        self._stats = dict(claims=0, misses=0, created=0, create_errors=0)
+
+    def _filters(self):
+        filters = dict(('tag:' + k, v) for k, v in self.tags.items())
+        filters['tag:' + WARM_TAG] = self.location
+        filters['availability-zone'] = self.location
+        filters['size'] = str(self.size_gib)
+        return filters
+
+    def _list(self, conn):
+        """
+        Return warm volumes which are available or being created.
+        """
+        return [volume for volume in
+                conn.get_all_volumes(filters=self._filters())
+                if volume.status in ('creating', 'available')]
+
+    def claim(self):
+        """
+        Take an available volume out of the pool.
+
+        Return (volume id or None, number of volumes left). Blocking.
+        """
+        with ec2_pool.connection(self.region) as conn:
+            listed = self._list(conn)
+            available = [volume.id for volume in listed
+                         if volume.status == 'available']
+            with self._lock:
+                # Tag removal may take time to show up in listings.
+                self._claimed &= set(volume.id for volume in listed)
+                candidates = [volume_id for volume_id in available
+                              if volume_id not in self._claimed]
+                if not candidates:
+                    self._stats['misses'] += 1
+                    return None, 0
+                volume_id = candidates[0]
+                self._claimed.add(volume_id)
+                self._stats['claims'] += 1
+            conn.delete_tags([volume_id], {WARM_TAG: None})
+        return volume_id, len(candidates) - 1
+
+    def size(self):
+        """
+        Return the number of warm volumes, including those being created.
+        Blocking.
+        """
+        with ec2_pool.connection(self.region) as conn:
+            listed = self._list(conn)
+        with self._lock:
+            return len([volume for volume in listed
+                        if volume.id not in self._claimed]) + self._creating
+
+    def _create(self):
+        """
+        Create one warm volume. Blocking.
+        """
+        tags = dict(self.tags)
+        tags[WARM_TAG] = self.location
+        tags['timestamp'] = datetime.now().strftime('%y%m%d_%H%M')
+        try:
+            with ec2_pool.connection(self.region) as conn:
+                volume_id = volumes.create_volume(conn, self.size_gib,
+                                                  self.location, tags)
+            logging.info('Created warm volume {}'.format(volume_id))
+            with self._lock:
+                self._stats['created'] += 1
+        except Exception as error:
+            logging.error('Could not create warm volume: {}'.format(error))
+            with self._lock:
+                self._stats['create_errors'] += 1
+        finally:
+            with self._lock:
+                self._creating -= 1
+
+    @defer.inlineCallbacks
+    def refill(self):
+        """
+        Create volumes until the pool reaches its target size.
+
+        Does nothing if a refill is already running.
+        """
+        if self._refilling:
+            return
+        self._refilling = True
+        try:
+            current = yield ec2threads.run(self.size)
+            missing = self.target_size - current
+            if missing > 0:
+                with self._lock:
+                    self._creating += missing
+                yield defer.DeferredList([ec2threads.run(self._create)
+                                          for _ in range(missing)])
+        finally:
+            self._refilling = False
+
+    def stats(self):
+        """
+        Return a copy of the pool counters.
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats['creating'] = self._creating
+            stats['target_size'] = self.target_size
+        return stats
+
+
+_pools = {}
+
+
+def get_pool(region, location, size_gib, tags, target_size):
+    """
+    Return the warm pool for a region, zone, size and tags.
+    """
+    key = region, location, size_gib, frozenset(tags.items())
+    pool = _pools.get(key)
+    if pool is None:
+        pool = _pools[key] = WarmVolumePool(region, location, size_gib, tags,
+                                            target_size)
+    pool.target_size = target_size
+    return pool
+
+
+def stats():
+    """
+    Return the counters of the warm pools, by region, zone and size.
+    """
+    return dict(('{}/{}/{}'.format(region, location, size_gib), pool.stats())
+                for (region, location, size_gib, _), pool in _pools.items())
+
+
+def refill_in_background(pool):
+    """
+    Start refilling a pool, logging errors.
+    """
+    d = pool.refill()
+    d.addErrback(lambda f: logging.error('Could not refill warm volume pool: {}'
+                                         .format(f.getErrorMessage())))
+    return d
+
+
+def configure_pool(region, location, size_gib, tags, target_size):
+    """
+    Declare a warm pool and fill it once the reactor runs.
+    """
+    if target_size <= 0:
+        return
+    pool = get_pool(region, location, size_gib, tags, target_size)
+    reactor.callWhenRunning(refill_in_background, pool)
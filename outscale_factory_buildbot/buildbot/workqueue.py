@@ -0,0 +1,234 @@
+"""
+Durable background work queue of the master.
+
+Builds hand cleanup work over to the queue, DestroyVolume and
+DestroyOldImages, so that they finish and release their slave without
+waiting for the cloud. Items are stored in a JSON file, rewritten on every
+change, so that they survive master restarts. Failed items are retried
+with exponential backoff, items failing max_attempts times are kept aside
+as dead.
+
+Handlers are registered per kind of item with register(); a handler
+takes the item arguments and returns a Deferred.
+"""
+import json
+import logging
+import os
+import random
+import time
+import uuid
+
+from twisted.internet import defer, reactor, task
+
+
+# Default file, relative to the master basedir.
+QUEUE_FILE = 'workqueue.json'
+
+_handlers = {}
+
+
+def register(kind, handler):
+    """
+    Declare the handler of items of a kind.
+    """
+    _handlers[kind] = handler
+
+
+class WorkQueue(object):
+
+    """
+    Queue of work items stored in path, run concurrency at a time.
+    """
+
+    def __init__(self,
+                 path=QUEUE_FILE,
+                 concurrency=4,
+                 max_attempts=10,
+                 interval=10,
+                 backoff_base=30,
+                 backoff_cap=3600):
+        self.path = path
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self.interval = interval
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self._items = []
+        self._dead = []
+        self._running = set()
+        self._loop = None
+        self._latency = {}
+        self._stats = dict(enqueued=0, completed=0, failures=0)
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path) as file_handle:
+                state = json.load(file_handle)
+        except ValueError as error:
+            logging.error('Ignoring corrupt work queue {}: {}'
+                          .format(self.path, error))
+            return
+        self._items = state.get('items', [])
+        self._dead = state.get('dead', [])
+        if self._items:
+            logging.info('Resuming {} background work items'
+                         .format(len(self._items)))
+
+    def _save(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as file_handle:
+            json.dump(dict(items=self._items, dead=self._dead), file_handle,
+                      indent=2, sort_keys=True)
+        os.rename(tmp_path, self.path)
+
+    def start(self):
+        if self._loop is not None:
+            return
+        self._loop = task.LoopingCall(self._run_due)
+        self._loop.start(self.interval, now=True)
+
+    def stop(self):
+        if self._loop is not None and self._loop.running:
+            self._loop.stop()
+        self._loop = None
+
+    def enqueue(self, kind, args):
+        """
+        Add an item, return its id.
+        """
+        if kind not in _handlers:
+            raise KeyError('No handler for work items of kind {}'.format(kind))
+        now = time.time()
+        item = dict(
+            id=uuid.uuid4().hex,
+            kind=kind,
+            args=args,
+            attempts=0,
+            enqueued_at=now,
+            next_attempt_at=now,
+            last_error=None,
+        )
+        self._items.append(item)
+        self._stats['enqueued'] += 1
+        self._save()
+        reactor.callLater(0, self._run_due)
+        return item['id']
+
+    def _run_due(self):
+        now = time.time()
+        for item in list(self._items):
+            if len(self._running) >= self.concurrency:
+                return
+            if item['id'] in self._running or item['next_attempt_at'] > now:
+                continue
+            self._run(item)
+
+    def _run(self, item):
+        self._running.add(item['id'])
+        handler = _handlers.get(item['kind'])
+        if handler is None:
+            d = defer.fail(KeyError('No handler for {}'.format(item['kind'])))
+        else:
+            d = defer.maybeDeferred(handler, item['args'])
+        d.addCallbacks(self._succeeded, self._failed,
+                       callbackArgs=(item,), errbackArgs=(item,))
+        d.addBoth(self._done, item)
+
+    def _succeeded(self, result, item):
+        self._items.remove(item)
+        self._stats['completed'] += 1
+        latency = self._latency.setdefault(
+            item['kind'], dict(count=0, total_seconds=0.0, max_seconds=0.0))
+        seconds = time.time() - item['enqueued_at']
+        latency['count'] += 1
+        latency['total_seconds'] += seconds
+        latency['max_seconds'] = max(latency['max_seconds'], seconds)
+        logging.info('Background {} done in {:.0f}s'
+                     .format(item['kind'], seconds))
+
+    def _failed(self, f, item):
+        self._stats['failures'] += 1
+        item['attempts'] += 1
+        item['last_error'] = f.getErrorMessage()
+        if item['attempts'] >= self.max_attempts:
+            logging.error('Giving up background {} {} after {} attempts: {}'
+                          .format(item['kind'], item['args'],
+                                  item['attempts'], item['last_error']))
+            self._items.remove(item)
+            self._dead.append(item)
+            return
+        delay = random.uniform(0, min(self.backoff_cap,
+                                      self.backoff_base * 2 ** item['attempts']))
+        item['next_attempt_at'] = time.time() + delay
+        logging.warning('Background {} failed, retrying in {:.0f}s: {}'
+                        .format(item['kind'], delay, item['last_error']))
+
+    def _done(self, result, item):
+        self._running.discard(item['id'])
+        try:
+            self._save()
+        except (IOError, OSError) as error:
+            logging.error('Could not save work queue: {}'.format(error))
+
+    def stats(self):
+        """
+        Return backlog, counters and latency per kind of item.
+        """
+        backlog = {}
+        for item in self._items:
+            backlog[item['kind']] = backlog.get(item['kind'], 0) + 1
+        result = dict(self._stats)
+        result.update(
+            backlog=len(self._items),
+            backlog_by_kind=backlog,
+            running=len(self._running),
+            dead=len(self._dead),
+            oldest_seconds=(time.time() - min(item['enqueued_at']
+                                              for item in self._items)
+                            if self._items else 0),
+            latency=dict((kind, dict(latency))
+                         for kind, latency in self._latency.items()),
+        )
+        return result
+
+
+_queue = None
+
+
+def configure(path=None, **kw):
+    """
+    Enable the queue stored in path, started once the reactor runs.
+
+    Other arguments set WorkQueue settings.
+    """
+    global _queue
+    path = path or QUEUE_FILE
+    if _queue is None or _queue.path != path:
+        if _queue is not None:
+            _queue.stop()
+        _queue = WorkQueue(path)
+        reactor.callWhenRunning(_queue.start)
+    for name, value in kw.items():
+        if value is not None:
+            setattr(_queue, name, value)
+    return _queue
+
+
+def disable():
+    """
+    Stop handing work over to the queue. Pending items are kept on disk.
+    """
+    global _queue
+    if _queue is not None:
+        _queue.stop()
+    _queue = None
+
+
+def get_queue():
+    """
+    Return the configured queue, or None.
+    """
+    return _queue
@@ -0,0 +1,109 @@
+"""
+Tests of autoscale.
+"""
+import unittest
+
+# The ec2buildslave shim of buildbot 0.8.12, imported by the buildbot
+# subpackage, deprecates its attribute in buildbot.libvirtbuildslave,
+# which must be imported first.
+import buildbot.libvirtbuildslave
+
+from outscale_factory_buildbot.buildbot import autoscale
+
+
+class FakeSlave(object):
+
+    def __init__(self, slavename, active=False, building=False):
+        self.slavename = slavename
+        self.substantiated = active
+        self.substantiation_deferred = None
+        self.building = building
+        self.build_wait_timeout = None
+
+
+class FakeBotmaster(object):
+
+    def __init__(self, slaves):
+        self.slaves = dict((slave.slavename, slave) for slave in slaves)
+
+
+class FakeMaster(object):
+
+    def __init__(self, slaves):
+        self.botmaster = FakeBotmaster(slaves)
+
+
+class CapacityControllerTest(unittest.TestCase):
+
+    def controller(self, slaves, **kw):
+        controller = autoscale.CapacityController(**kw)
+        for slave in slaves:
+            controller.register(slave)
+        controller._master = FakeMaster(slaves)
+        return controller
+
+    def test_first_slave_below_backlog(self):
+        slaves = [FakeSlave('slave-0'), FakeSlave('slave-1')]
+        controller = self.controller(slaves, max_slaves=2,
+                                     scale_up_backlog=5)
+        self.assertTrue(controller.update(1, now=0))
+        self.assertEqual(controller.target, 1)
+        self.assertTrue(controller.may_substantiate(slaves[0]))
+
+    def test_no_slave_without_pending_builds(self):
+        slaves = [FakeSlave('slave-0')]
+        controller = self.controller(slaves, max_slaves=1,
+                                     scale_up_backlog=5)
+        self.assertFalse(controller.update(0, now=0))
+        self.assertEqual(controller.target, 0)
+
+    def test_may_substantiate_first_slave(self):
+        slaves = [FakeSlave('slave-0'), FakeSlave('slave-1')]
+        controller = self.controller(slaves, max_slaves=2,
+                                     scale_up_backlog=5)
+        # Not polled yet, a build is waiting for a slave.
+        self.assertTrue(controller.may_substantiate(slaves[0]))
+        slaves[0].substantiated = True
+        self.assertFalse(controller.may_substantiate(slaves[1]))
+
+    def test_grow_to_running_slaves_below_backlog(self):
+        slaves = [FakeSlave('slave-0', active=True),
+                  FakeSlave('slave-1', active=True),
+                  FakeSlave('slave-2')]
+        controller = self.controller(slaves, max_slaves=3,
+                                     scale_up_backlog=5)
+        self.assertTrue(controller.update(3, now=0))
+        self.assertEqual(controller.target, 2)
+        self.assertFalse(controller.may_substantiate(slaves[2]))
+
+    def test_grow_to_demand_at_backlog(self):
+        slaves = [FakeSlave('slave-{}'.format(index)) for index in range(4)]
+        controller = self.controller(slaves, max_slaves=3,
+                                     scale_up_backlog=2)
+        self.assertTrue(controller.update(5, now=0))
+        self.assertEqual(controller.target, 3)
+
+    def test_scale_down_after_delay(self):
+        slaves = [FakeSlave('slave-0'), FakeSlave('slave-1')]
+        controller = self.controller(slaves, max_slaves=2,
+                                     scale_down_delay=600)
+        controller.update(2, now=0)
+        self.assertEqual(controller.target, 2)
+        controller.update(0, now=10)
+        controller.update(0, now=500)
+        self.assertEqual(controller.target, 2)
+        controller.update(0, now=610)
+        self.assertEqual(controller.target, 0)
+
+    def test_warm_slaves_within_target(self):
+        slaves = [FakeSlave('slave-0'), FakeSlave('slave-1')]
+        controller = self.controller(slaves, max_slaves=2,
+                                     scale_up_backlog=5,
+                                     idle_timeout=60, busy_timeout=600)
+        controller.update(1, now=0)
+        self.assertEqual([slave.build_wait_timeout for slave in slaves],
+                         [600, 60])
+
+
+if __name__ == '__main__':
+    unittest.main()
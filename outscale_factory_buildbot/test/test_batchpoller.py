@@ -0,0 +1,233 @@
+"""
+Tests of batchpoller.
+"""
+import json
+import shutil
+import tempfile
+import unittest
+
+from twisted.internet import defer
+
+# The ec2buildslave shim of buildbot 0.8.12, imported by the buildbot
+# subpackage, deprecates its attribute in buildbot.libvirtbuildslave,
+# which must be imported first.
+import buildbot.libvirtbuildslave
+
+from outscale_factory_buildbot.buildbot import batchpoller
+
+
+URL = 'https://git.example.com/core.git'
+OTHER_URL = 'https://git.example.com/lamp.git'
+
+
+class FakeGit(object):
+
+    """
+    run_git() over remote heads and a commit graph.
+
+    Commits are fetched into the local repository by fetch. ls-remote
+    returns Deferreds fired by the test when hold is set.
+    """
+
+    def __init__(self):
+        self.heads = {URL: {'master': 'a'}, OTHER_URL: {'master': 'x'}}
+        self.parents = {'a': None, 'b': 'a', 'c': 'b', 'x': None}
+        self.fetched = set()
+        self.calls = []
+        self.hold = False
+        self.held = []
+        self.fail_urls = set()
+
+    def commands(self, name):
+        return [args for args in self.calls if args[0] == name]
+
+    def _ancestors(self, rev):
+        while rev is not None:
+            yield rev
+            rev = self.parents[rev]
+
+    def __call__(self, args, cwd=None, gitbin='git'):
+        self.calls.append(args)
+        command = args[0]
+        if command == 'ls-remote':
+            url = args[-1]
+            if url in self.fail_urls:
+                return defer.fail(RuntimeError('fatal: unable to access'))
+            output = ''.join('{}\trefs/heads/{}\n'.format(sha, branch)
+                             for branch, sha in self.heads[url].items())
+            if self.hold:
+                d = defer.Deferred()
+                self.held.append((d, output))
+                return d
+            return defer.succeed(output)
+        if command == 'fetch':
+            for sha in self.heads[args[1]].values():
+                self.fetched.update(self._ancestors(sha))
+            return defer.succeed('')
+        if command == 'cat-file':
+            if args[-1] in self.fetched:
+                return defer.succeed('')
+            return defer.fail(RuntimeError('fatal: not a valid object'))
+        if command == 'log' and '--no-walk' not in args:
+            new_rev, old_rev = args[2], args[3][1:]
+            revs = []
+            for rev in self._ancestors(new_rev):
+                if rev == old_rev:
+                    break
+                revs.append(rev)
+            return defer.succeed('\n'.join(revs) + '\n')
+        if command == 'log' and '--name-only' in args:
+            return defer.succeed('\nREADME\n')
+        if command == 'log':
+            return defer.succeed('1400000000\nDev <dev@example.com>\n'
+                                 'Commit {}\n'.format(args[-2]))
+        return defer.succeed('')
+
+
+class FakeStateDB(object):
+
+    """
+    State table, storing values as JSON as buildbot does.
+    """
+
+    def __init__(self):
+        self.values = {}
+
+    def getObjectId(self, name, class_name):
+        return defer.succeed((name, class_name))
+
+    def getState(self, objectid, name, default):
+        if (objectid, name) not in self.values:
+            return defer.succeed(default)
+        return defer.succeed(json.loads(self.values[objectid, name]))
+
+    def setState(self, objectid, name, value):
+        self.values[objectid, name] = json.dumps(value)
+        return defer.succeed(None)
+
+
+class FakeDB(object):
+
+    def __init__(self):
+        self.state = FakeStateDB()
+
+
+class FakeMaster(object):
+
+    def __init__(self, basedir):
+        self.basedir = basedir
+        self.db = FakeDB()
+        self.changes = []
+
+    def addChange(self, **kw):
+        self.changes.append(kw)
+        return defer.succeed(None)
+
+
+class BatchGitPollerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.git = FakeGit()
+        self._run_git = batchpoller.run_git
+        batchpoller.run_git = self.git
+        self.basedir = tempfile.mkdtemp()
+        self.master = FakeMaster(self.basedir)
+
+    def tearDown(self):
+        batchpoller.run_git = self._run_git
+        shutil.rmtree(self.basedir)
+
+    def poller(self, maxConcurrent=4):
+        poller = batchpoller.BatchGitPoller(
+            [('core', URL, 'master'),
+             ('core-dev', URL, 'master'),
+             ('lamp', OTHER_URL, 'master')],
+            maxConcurrent=maxConcurrent)
+        poller.master = self.master
+        poller.startService()
+        # Only poll when told to.
+        poller.stopService()
+        return poller
+
+    def poll(self, poller, url=URL):
+        poller._poll_guarded(url)
+
+    def test_first_poll_records_head(self):
+        poller = self.poller()
+        self.poll(poller)
+        self.assertEqual(len(self.git.commands('fetch')), 1)
+        self.assertEqual(poller.lastRev, {URL: {'master': 'a'}})
+        self.assertEqual(self.master.changes, [])
+
+    def test_no_fetch_when_head_did_not_move(self):
+        poller = self.poller()
+        self.poll(poller)
+        self.poll(poller)
+        self.assertEqual(len(self.git.commands('ls-remote')), 2)
+        self.assertEqual(len(self.git.commands('fetch')), 1)
+
+    def test_no_fetch_when_other_branch_moved(self):
+        poller = self.poller()
+        self.poll(poller)
+        self.git.heads[URL]['feature'] = 'b'
+        self.poll(poller)
+        self.assertEqual(len(self.git.commands('fetch')), 1)
+
+    def test_moved_head_is_fetched_and_reported(self):
+        poller = self.poller()
+        self.poll(poller)
+        self.git.heads[URL]['master'] = 'c'
+        self.poll(poller)
+        self.assertEqual(len(self.git.commands('fetch')), 2)
+        self.assertEqual(
+            [(change['revision'], change['project'])
+             for change in self.master.changes],
+            [('b', 'core'), ('b', 'core-dev'),
+             ('c', 'core'), ('c', 'core-dev')])
+        self.assertEqual(self.master.changes[0]['files'], ['README'])
+        self.assertEqual(self.master.changes[0]['comments'], 'Commit b')
+        self.assertEqual(poller.lastRev[URL], {'master': 'c'})
+
+    def test_last_revisions_are_persisted(self):
+        poller = self.poller()
+        self.poll(poller)
+        self.git.heads[URL]['master'] = 'b'
+        self.poll(poller)
+
+        # After a restart, the heads are not reported nor fetched again.
+        restarted = self.poller()
+        self.assertEqual(restarted.lastRev, {URL: {'master': 'b'}})
+        self.poll(restarted)
+        self.assertEqual(len(self.git.commands('fetch')), 2)
+        self.git.heads[URL]['master'] = 'c'
+        self.poll(restarted)
+        self.assertEqual([change['revision']
+                          for change in self.master.changes],
+                         ['b', 'b', 'c', 'c'])
+
+    def test_concurrent_polls_are_limited(self):
+        poller = self.poller(maxConcurrent=1)
+        self.git.hold = True
+        self.poll(poller, URL)
+        self.poll(poller, OTHER_URL)
+        self.assertEqual(len(self.git.held), 1)
+        d, output = self.git.held.pop(0)
+        d.callback(output)
+        self.assertEqual(len(self.git.held), 1)
+        d, output = self.git.held.pop(0)
+        d.callback(output)
+        self.assertEqual(sorted(poller.lastRev), [URL, OTHER_URL])
+
+    def test_failed_poll_is_counted(self):
+        poller = self.poller()
+        self.git.fail_urls.add(URL)
+        self.poll(poller)
+        stats = poller.stats()
+        self.assertEqual(sorted(stats), ['core', 'core-dev'])
+        self.assertEqual((stats['core']['polls'], stats['core']['failures']),
+                         (1, 1))
+        self.assertEqual(self.git.commands('fetch'), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,125 @@
+"""
+Tests of buildsteps.
+"""
+import unittest
+
+from twisted.internet import defer
+
+# The ec2buildslave shim of buildbot 0.8.12, imported by the buildbot
+# subpackage, deprecates its attribute in buildbot.libvirtbuildslave,
+# which must be imported first.
+import buildbot.libvirtbuildslave
+
+import boto.ec2
+
+from outscale_factory_buildbot.buildbot import buildsteps
+from outscale_factory_buildbot.tools import ec2_pool
+from outscale_factory_buildbot.test.test_delete_images import ec2_error
+
+
+class FakeVolume(object):
+
+    def __init__(self, volume_id, status, attachment):
+        self.id = volume_id
+        self.status = status
+        self.attachment = attachment
+
+    def attachment_state(self):
+        return self.attachment
+
+
+class FakeConnection(object):
+
+    """
+    Connection to a cloud of volumes, detaching them at once.
+    """
+
+    def __init__(self, volumes):
+        self.volumes = dict((volume.id, volume) for volume in volumes)
+        self.deleted = []
+
+    def get_all_volumes(self, filters=None):
+        volume = self.volumes.get(filters['volume-id'])
+        return [volume] if volume is not None else []
+
+    def detach_volume(self, volume_id, force=False):
+        volume = self.volumes[volume_id]
+        volume.status, volume.attachment = 'available', None
+
+    def delete_volume(self, volume_id):
+        if self.volumes.pop(volume_id, None) is None:
+            raise ec2_error('InvalidVolume.NotFound')
+        self.deleted.append(volume_id)
+        return True
+
+    def close(self):
+        pass
+
+
+def run(func, *args):
+    return defer.maybeDeferred(func, *args)
+
+
+@defer.inlineCallbacks
+def poll(check, interval, timeout, description='condition'):
+    for _ in range(10):
+        result = yield run(check)
+        if result:
+            defer.returnValue(result)
+    raise AssertionError('Gave up waiting for {}'.format(description))
+
+
+class DestroyVolumeHandlerTest(unittest.TestCase):
+
+    def setUp(self):
+        self._run = buildsteps.ec2threads.run
+        self._poll = buildsteps.ec2threads.poll
+        buildsteps.ec2threads.run = run
+        buildsteps.ec2threads.poll = poll
+
+    def tearDown(self):
+        buildsteps.ec2threads.run = self._run
+        buildsteps.ec2threads.poll = self._poll
+        ec2_pool.configure(connect=boto.ec2.connect_to_region)
+
+    def destroy(self, conn):
+        ec2_pool.configure(connect=lambda region: conn)
+        outcome = []
+        d = buildsteps._destroy_volume(dict(region='eu-west-2',
+                                            volume_id='vol-1'))
+        d.addBoth(outcome.append)
+        return outcome[0]
+
+    def test_detach_and_delete(self):
+        conn = FakeConnection([FakeVolume('vol-1', 'in-use', 'attached')])
+        self.assertEqual(self.destroy(conn), None)
+        self.assertEqual(conn.deleted, ['vol-1'])
+
+    def test_volume_vanishes_after_detach(self):
+        conn = FakeConnection([FakeVolume('vol-1', 'in-use', 'attached')])
+        # Deleted by someone else once detached.
+        conn.detach_volume = lambda volume_id, force=False: (
+            conn.volumes.pop(volume_id))
+        self.assertEqual(self.destroy(conn), None)
+        self.assertEqual(conn.deleted, [])
+
+    def test_volume_vanishes_before_delete(self):
+        conn = FakeConnection([FakeVolume('vol-1', 'available', None)])
+        delete_volume = conn.delete_volume
+
+        # Deleted by someone else once seen available.
+        def delete_after_other(volume_id):
+            conn.volumes.pop(volume_id)
+            return delete_volume(volume_id)
+        conn.delete_volume = delete_after_other
+        self.assertEqual(self.destroy(conn), None)
+        self.assertEqual(conn.deleted, [])
+
+    def test_volume_error(self):
+        conn = FakeConnection([FakeVolume('vol-1', 'error', None)])
+        outcome = self.destroy(conn)
+        self.assertTrue(outcome.check(buildsteps.VolumeError))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+"""
+Tests of delete_images.
+"""
+import unittest
+
+import boto.ec2
+import boto.exception
+from boto.ec2.blockdevicemapping import BlockDeviceType
+
+from outscale_factory_buildbot.tools import delete_images
+from outscale_factory_buildbot.tools import ec2_pool
+
+
+ERROR_BODY = ('<Response><Errors><Error><Code>{}</Code><Message>{}</Message>'
+              '</Error></Errors><RequestID>r-1</RequestID></Response>')
+
+
+def ec2_error(code):
+    return boto.exception.EC2ResponseError(400, 'Bad Request',
+                                           ERROR_BODY.format(code, code))
+
+
+class FakeImage(object):
+
+    def __init__(self, image_id, snapshot_id):
+        self.id = image_id
+        self.root_device_name = '/dev/sda1'
+        self.block_device_mapping = {
+            '/dev/sda1': BlockDeviceType(snapshot_id=snapshot_id, size=10),
+        }
+
+
+class FakeConnection(object):
+
+    """
+    Connection to a cloud of images, failing snapshot deletions with the
+    errors of snapshot_errors.
+    """
+
+    def __init__(self, images, snapshot_errors=()):
+        self.images = images
+        self.snapshots = set(image.block_device_mapping['/dev/sda1']
+                             .snapshot_id for image in images.values())
+        self.snapshot_errors = list(snapshot_errors)
+        self.deregistered = []
+
+    def get_image(self, image_id):
+        return self.images.get(image_id)
+
+    def deregister_image(self, image_id, delete_snapshot=False):
+        assert not delete_snapshot
+        if self.images.pop(image_id, None) is None:
+            raise ec2_error('InvalidAMIID.NotFound')
+        self.deregistered.append(image_id)
+        return True
+
+    def delete_snapshot(self, snapshot_id):
+        if self.snapshot_errors:
+            raise ec2_error(self.snapshot_errors.pop(0))
+        if snapshot_id not in self.snapshots:
+            raise ec2_error('InvalidSnapshot.NotFound')
+        self.snapshots.remove(snapshot_id)
+        return True
+
+    def close(self):
+        pass
+
+
+class DeleteImagesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = FakeConnection(dict(
+            ('ami-{}'.format(index), FakeImage('ami-{}'.format(index),
+                                               'snap-{}'.format(index)))
+            for index in range(3)))
+        ec2_pool.configure(connect=lambda region: self.conn)
+
+    def tearDown(self):
+        ec2_pool.configure(connect=boto.ec2.connect_to_region)
+
+    def delete(self, image_ids):
+        return delete_images.delete_images('test-1', image_ids,
+                                           concurrency=1,
+                                           max_attempts=3,
+                                           backoff_base=0)
+
+    def test_deletes_image_and_root_snapshot(self):
+        report = self.delete(['ami-0', 'ami-1'])
+        self.assertEqual(sorted(report.deleted), ['ami-0', 'ami-1'])
+        self.assertEqual(sorted(report.snapshots_deleted),
+                         ['snap-0', 'snap-1'])
+        self.assertEqual(self.conn.snapshots, set(['snap-2']))
+
+    def test_missing_image_is_skipped(self):
+        report = self.delete(['ami-9'])
+        self.assertEqual(report.deleted, [])
+        self.assertEqual(report.skipped, {'ami-9': 'not found'})
+
+    def test_snapshot_in_use_is_retried_without_deregistering_again(self):
+        self.conn.snapshot_errors = ['InvalidSnapshot.InUse']
+        report = self.delete(['ami-0'])
+        self.assertEqual(report.deleted, ['ami-0'])
+        self.assertEqual(report.snapshots_deleted, ['snap-0'])
+        self.assertEqual(self.conn.deregistered, ['ami-0'])
+
+    def test_snapshot_still_in_use_is_reported_failed(self):
+        self.conn.snapshot_errors = ['InvalidSnapshot.InUse'] * 3
+        report = self.delete(['ami-0'])
+        self.assertEqual(report.deleted, [])
+        self.assertEqual(report.skipped, {})
+        self.assertIn('snap-0', report.failed['ami-0'])
+        self.assertEqual(self.conn.deregistered, ['ami-0'])
+        self.assertIn('snap-0', self.conn.snapshots)
+
+    def test_snapshot_already_gone_is_not_counted(self):
+        self.conn.snapshots.remove('snap-0')
+        report = self.delete(['ami-0'])
+        self.assertEqual(report.deleted, ['ami-0'])
+        self.assertEqual(report.snapshots_deleted, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
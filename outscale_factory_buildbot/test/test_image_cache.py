@@ -0,0 +1,204 @@
+"""
+Tests of image_cache.
+"""
+import unittest
+
+from outscale_factory_buildbot.tools import image_cache
+from outscale_factory_buildbot.tools.image_cache import ImageRecord
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+def image(image_id, name, **tags):
+    return ImageRecord(image_id, name, tags)
+
+
+IMAGES = [
+    image('ami-1', 'core_141001_0100', appliance='core', timestamp='1'),
+    image('ami-2', 'core_141002_0100', appliance='core', timestamp='2'),
+    image('ami-3', 'lamp_141001_0100', appliance='lamp', timestamp='1'),
+]
+
+
+class Fetcher(object):
+
+    """
+    fetch() of a query, counting calls.
+    """
+
+    def __init__(self, images):
+        self.images = images
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        return list(self.images)
+
+
+def ids(images):
+    return sorted(each.id for each in images)
+
+
+class ImageCatalogTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self._time = image_cache.time
+        image_cache.time = self.clock
+        self.catalog = image_cache.ImageCatalog(ttl_seconds=300)
+
+    def tearDown(self):
+        image_cache.time = self._time
+
+    def find(self, fetch, region='eu-west-2', pattern='', filters={},
+             owners=('self',)):
+        return self.catalog.find(region, fetch, pattern, filters,
+                                 list(owners) if owners else None)
+
+    def test_hit_within_ttl(self):
+        fetch = Fetcher(IMAGES)
+        self.assertEqual(ids(self.find(fetch)), ['ami-1', 'ami-2', 'ami-3'])
+        self.clock.now += 299
+        self.assertEqual(ids(self.find(fetch)), ['ami-1', 'ami-2', 'ami-3'])
+        self.assertEqual(fetch.calls, 1)
+        self.assertEqual(self.catalog.stats()['hits'], 1)
+
+    def test_expired_listing_is_fetched_again(self):
+        fetch = Fetcher(IMAGES)
+        self.find(fetch)
+        self.clock.now += 301
+        self.find(fetch)
+        self.assertEqual(fetch.calls, 2)
+        self.assertEqual(self.catalog.stats()['listings'], 1)
+
+    def test_no_cache_without_ttl(self):
+        self.catalog.ttl_seconds = 0
+        fetch = Fetcher(IMAGES)
+        self.find(fetch)
+        self.find(fetch)
+        self.assertEqual(fetch.calls, 2)
+
+    def test_listings_are_keyed_by_region(self):
+        fetch = Fetcher(IMAGES)
+        self.find(fetch, region='eu-west-2')
+        self.find(fetch, region='us-east-2')
+        self.assertEqual(fetch.calls, 2)
+
+    def test_listings_are_keyed_by_owners(self):
+        fetch = Fetcher(IMAGES)
+        self.find(fetch, owners=['self'])
+        self.find(fetch, owners=None)
+        self.find(fetch, owners=['123456'])
+        self.assertEqual(fetch.calls, 3)
+        # Owners are a set.
+        self.find(fetch, owners=['b', 'a'])
+        self.find(fetch, owners=['a', 'b'])
+        self.assertEqual(fetch.calls, 4)
+
+    def test_wider_listing_answers_narrower_query(self):
+        fetch = Fetcher(IMAGES)
+        self.find(fetch)
+        core = self.find(Fetcher([]), filters={'tag:appliance': 'core'})
+        self.assertEqual(ids(core), ['ami-1', 'ami-2'])
+        named = self.find(Fetcher([]), pattern='core_1410[0]1_*',
+                          filters={'name': 'core_1410*'})
+        self.assertEqual(ids(named), ['ami-1'])
+
+    def test_narrower_listing_does_not_answer_wider_query(self):
+        self.find(Fetcher(IMAGES[:2]), filters={'tag:appliance': 'core'})
+        fetch = Fetcher(IMAGES)
+        self.assertEqual(len(self.find(fetch)), 3)
+        self.assertEqual(fetch.calls, 1)
+
+    def test_add_image_updates_indexes(self):
+        self.find(Fetcher(IMAGES[:2]), filters={'tag:appliance': 'core'})
+        self.find(Fetcher(IMAGES[2:]), filters={'tag:appliance': 'lamp'})
+        self.find(Fetcher(IMAGES))
+        new = image('ami-4', 'core_141003_0100', appliance='core',
+                    timestamp='3')
+        self.catalog.add_image('eu-west-2', new)
+
+        none = Fetcher([])
+        self.assertIn('ami-4', ids(self.find(
+            none, filters={'tag:appliance': 'core'})))
+        self.assertIn('ami-4', ids(self.find(
+            none, filters={'tag:timestamp': '3'})))
+        self.assertEqual(ids(self.find(none, pattern='core_141003*',
+                                       filters={'name': 'core_141003*'})),
+                         ['ami-4'])
+        self.assertNotIn('ami-4', ids(self.find(
+            none, filters={'tag:appliance': 'lamp'})))
+        self.assertEqual(none.calls, 0)
+        self.assertEqual(self.catalog.stats()['images'], 3 + 1 + 4)
+
+    def test_add_image_replaces_tags(self):
+        self.find(Fetcher(IMAGES))
+        retagged = image('ami-1', 'core_141001_0100', appliance='other')
+        self.catalog.add_image('eu-west-2', retagged)
+        none = Fetcher([])
+        self.assertEqual(ids(self.find(
+            none, filters={'tag:appliance': 'core'})), ['ami-2'])
+        self.assertEqual(ids(self.find(
+            none, filters={'tag:appliance': 'other'})), ['ami-1'])
+        self.assertEqual(ids(self.find(none, pattern='core_141001*',
+                                       filters={'name': 'core_141001*'})),
+                         ['ami-1'])
+
+    def test_add_image_drops_listings_of_other_owners(self):
+        self.find(Fetcher(IMAGES), owners=['123456'])
+        self.catalog.add_image('eu-west-2', image('ami-4', 'core_4'))
+        self.assertEqual(self.catalog.stats()['listings'], 0)
+
+    def test_add_image_leaves_other_regions(self):
+        self.find(Fetcher(IMAGES), region='us-east-2')
+        self.catalog.add_image('eu-west-2', image('ami-4', 'core_4',
+                                                  appliance='core'))
+        self.assertEqual(len(self.find(Fetcher([]), region='us-east-2')), 3)
+
+    def test_discard_images_updates_indexes(self):
+        self.find(Fetcher(IMAGES[:2]), filters={'tag:appliance': 'core'})
+        self.find(Fetcher(IMAGES))
+        self.catalog.discard_images('eu-west-2', ['ami-1', 'ami-9'])
+        none = Fetcher([])
+        self.assertEqual(ids(self.find(
+            none, filters={'tag:appliance': 'core'})), ['ami-2'])
+        self.assertEqual(ids(self.find(
+            none, filters={'tag:timestamp': '1'})), ['ami-3'])
+        self.assertEqual(self.find(none, pattern='core_141001*',
+                                   filters={'name': 'core_141001*'}), [])
+        self.assertEqual(none.calls, 0)
+        self.assertEqual(self.catalog.stats()['images'], 1 + 2)
+
+    def test_discard_images_leaves_other_regions(self):
+        self.find(Fetcher(IMAGES), region='us-east-2')
+        self.catalog.discard_images('eu-west-2', ['ami-1'])
+        self.assertEqual(len(self.find(Fetcher([]), region='us-east-2')), 3)
+
+    def test_invalidate_region(self):
+        self.find(Fetcher(IMAGES), region='eu-west-2')
+        self.find(Fetcher(IMAGES), region='us-east-2')
+        self.catalog.invalidate('eu-west-2')
+        fetch = Fetcher(IMAGES)
+        self.find(fetch, region='eu-west-2')
+        self.find(fetch, region='us-east-2')
+        self.assertEqual(fetch.calls, 1)
+
+
+class LiteralPrefixTest(unittest.TestCase):
+
+    def test_literal_prefix(self):
+        self.assertEqual(image_cache.literal_prefix('core_14*'), 'core_14')
+        self.assertEqual(image_cache.literal_prefix('co?e'), 'co')
+        self.assertEqual(image_cache.literal_prefix('[a-z]*'), '')
+        self.assertEqual(image_cache.literal_prefix('core'), 'core')
+
+
+if __name__ == '__main__':
+    unittest.main()
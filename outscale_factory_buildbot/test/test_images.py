@@ -0,0 +1,96 @@
+"""
+Tests of images.
+"""
+import unittest
+
+from outscale_factory_buildbot.tools import images
+from outscale_factory_buildbot.test.test_delete_images import ec2_error
+
+
+class Resource(object):
+
+    def __init__(self, id, status=None, state=None):
+        self.id = id
+        self.status = status
+        self.state = state
+
+
+class Connection(object):
+
+    def __init__(self, snapshots=(), images=(), error=None):
+        self.snapshots = list(snapshots)
+        self.images = list(images)
+        self.error = error
+        self.registered = []
+        self.tags = {}
+
+    def get_all_snapshots(self, snapshot_ids=None):
+        if self.error:
+            raise ec2_error(self.error)
+        return [each for each in self.snapshots if each.id in snapshot_ids]
+
+    def get_all_images(self, image_ids=None):
+        if self.error:
+            raise ec2_error(self.error)
+        return [each for each in self.images if each.id in image_ids]
+
+    def create_snapshot(self, volume_id, description=None):
+        return Resource('snap-1', status='pending')
+
+    def register_image(self, **kw):
+        self.registered.append(kw)
+        return 'ami-1'
+
+    def create_tags(self, resource_ids, tags):
+        for resource_id in resource_ids:
+            self.tags[resource_id] = dict(tags)
+
+
+class SnapshotStatusTest(unittest.TestCase):
+
+    def test_status(self):
+        conn = Connection(snapshots=[Resource('snap-1', status='completed')])
+        self.assertEqual(images.snapshot_status(conn, 'snap-1'), 'completed')
+
+    def test_not_visible_yet(self):
+        self.assertEqual(images.snapshot_status(Connection(), 'snap-1'),
+                         'pending')
+        conn = Connection(error='InvalidSnapshot.NotFound')
+        self.assertEqual(images.snapshot_status(conn, 'snap-1'), 'pending')
+
+    def test_other_errors_are_raised(self):
+        conn = Connection(error='UnauthorizedOperation')
+        self.assertRaises(Exception, images.snapshot_status, conn, 'snap-1')
+
+
+class ImageStateTest(unittest.TestCase):
+
+    def test_state(self):
+        conn = Connection(images=[Resource('ami-1', state='failed')])
+        self.assertEqual(images.image_state(conn, 'ami-1'), 'failed')
+
+    def test_not_visible_yet(self):
+        conn = Connection(error='InvalidAMIID.NotFound')
+        self.assertEqual(images.image_state(conn, 'ami-1'), 'pending')
+
+
+class RegisterImageTest(unittest.TestCase):
+
+    def test_register_image(self):
+        conn = Connection()
+        image_id = images.register_image(conn, 'core_141001_0100', 'snap-1',
+                                         'x86_64', 'Core', {'a': 'b'})
+        self.assertEqual(image_id, 'ami-1')
+        registered, = conn.registered
+        self.assertEqual(registered['name'], 'core_141001_0100')
+        self.assertEqual(registered['architecture'], 'x86_64')
+        self.assertEqual(registered['root_device_name'],
+                         images.ROOT_DEVICE_NAME)
+        root = registered['block_device_map'][images.ROOT_DEVICE_NAME]
+        self.assertEqual(root.snapshot_id, 'snap-1')
+        self.assertTrue(root.delete_on_termination)
+        self.assertEqual(conn.tags, {'ami-1': {'a': 'b'}})
+
+
+if __name__ == '__main__':
+    unittest.main()
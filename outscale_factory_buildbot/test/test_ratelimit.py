@@ -0,0 +1,232 @@
+"""
+Tests of ratelimit.
+"""
+import unittest
+
+import boto.exception
+
+from outscale_factory_buildbot.tools import ratelimit
+
+
+THROTTLE_BODY = ('<Response><Errors><Error><Code>RequestLimitExceeded</Code>'
+                 '<Message>Request limit exceeded.</Message></Error></Errors>'
+                 '<RequestID>r-1</RequestID></Response>')
+
+
+class FakeClock(object):
+
+    """
+    Replacement of the time module, sleeping advances the clock.
+    """
+
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+
+class ClockTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self._time = ratelimit.time
+        ratelimit.time = self.clock
+
+    def tearDown(self):
+        ratelimit.time = self._time
+
+
+class TokenBucketTest(ClockTest):
+
+    def test_burst_then_rate(self):
+        bucket = ratelimit.TokenBucket(10.0, 2)
+        self.assertEqual(bucket.acquire(), 0)
+        self.assertEqual(bucket.acquire(), 0)
+        self.assertAlmostEqual(bucket.acquire(), 0.1)
+        self.assertEqual(self.clock.slept, [bucket.stats()['max_wait_seconds']])
+
+    def test_waiting_callers_are_spaced(self):
+        bucket = ratelimit.TokenBucket(10.0, 1)
+        bucket.acquire()
+        # Without sleeping, as concurrent callers would.
+        self.clock.sleep = lambda seconds: None
+        waits = [bucket.acquire() for _ in range(3)]
+        for wait, expected in zip(waits, [0.1, 0.2, 0.3]):
+            self.assertAlmostEqual(wait, expected)
+
+    def test_refill_up_to_burst(self):
+        bucket = ratelimit.TokenBucket(10.0, 2)
+        bucket.acquire()
+        bucket.acquire()
+        self.clock.now += 60
+        self.assertEqual(bucket.acquire(), 0)
+        self.assertEqual(bucket.acquire(), 0)
+        self.assertGreater(bucket.acquire(), 0)
+
+    def test_throttled_halves_rate_once_per_interval(self):
+        bucket = ratelimit.TokenBucket(8.0, 10)
+        bucket.throttled('DescribeImages')
+        self.assertEqual(bucket.rate, 4.0)
+        bucket.throttled('DescribeImages')
+        self.assertEqual(bucket.rate, 4.0)
+        self.clock.now += bucket.decrease_interval
+        bucket.throttled('DeleteSnapshot')
+        self.assertEqual(bucket.rate, 2.0)
+        stats = bucket.stats()
+        self.assertEqual(stats['throttles'], 3)
+        self.assertEqual(stats['decreases'], 2)
+        self.assertEqual(stats['throttles_by_action'],
+                         {'DescribeImages': 2, 'DeleteSnapshot': 1})
+
+    def test_throttled_drops_burst(self):
+        bucket = ratelimit.TokenBucket(8.0, 10)
+        bucket.throttled()
+        self.assertAlmostEqual(bucket.acquire(), 1 / 4.0)
+
+    def test_rate_stays_above_min_rate(self):
+        bucket = ratelimit.TokenBucket(1.0, 1, min_rate=0.5)
+        for _ in range(5):
+            bucket.throttled()
+            self.clock.now += bucket.decrease_interval
+        self.assertEqual(bucket.rate, 0.5)
+
+    def test_succeeded_grows_rate_up_to_max_rate(self):
+        bucket = ratelimit.TokenBucket(4.0, 1)
+        bucket.succeeded()
+        self.assertEqual(bucket.rate, 4.0 + bucket.increase / 4.0)
+        for _ in range(1000):
+            bucket.succeeded()
+        self.assertEqual(bucket.rate, 4.0 * ratelimit.MAX_RATE_FACTOR)
+
+    def test_stats(self):
+        bucket = ratelimit.TokenBucket(10.0, 1)
+        bucket.acquire('DescribeImages')
+        bucket.acquire('DescribeImages')
+        stats = bucket.stats()
+        self.assertEqual(stats['calls'], 2)
+        self.assertEqual(stats['waits'], 1)
+        self.assertEqual(stats['calls_by_action'], {'DescribeImages': 2})
+        self.assertEqual(stats['initial_rate'], 10.0)
+
+
+class ActionClassTest(unittest.TestCase):
+
+    def test_action_class(self):
+        self.assertEqual(ratelimit.action_class('DescribeImages'), 'describe')
+        self.assertEqual(ratelimit.action_class('GetConsoleOutput'),
+                         'describe')
+        self.assertEqual(ratelimit.action_class('DeleteSnapshot'), 'mutate')
+        self.assertEqual(ratelimit.action_class(None), 'mutate')
+
+
+class Response(object):
+
+    def __init__(self, status, body=''):
+        self.status = status
+        self.reason = 'Reason'
+        self.body = body
+
+    def read(self):
+        return self.body
+
+
+class Request(object):
+
+    def __init__(self, action):
+        self.params = dict(Action=action)
+
+
+class FakeConnection(object):
+
+    """
+    Connection replaying responses through the retry loop of boto.
+    """
+
+    ResponseError = boto.exception.EC2ResponseError
+    num_retries = 3
+
+    def __init__(self, clock, responses):
+        self.clock = clock
+        self.responses = list(responses)
+
+    def _mexe(self, request, sender=None, override_num_retries=None,
+              retry_handler=None):
+        attempt = 0
+        while attempt <= override_num_retries:
+            response = self.responses.pop(0)
+            status = retry_handler(response, attempt, 60)
+            if status:
+                _, attempt, next_sleep = status
+                self.clock.sleep(next_sleep)
+                continue
+            return response
+        raise AssertionError('boto would sleep and raise')
+
+
+class InstallTest(ClockTest):
+
+    def setUp(self):
+        ClockTest.setUp(self)
+        self._limiter = ratelimit._limiter
+        ratelimit._limiter = ratelimit.RateLimiter(
+            dict(describe=(100.0, 100), mutate=(100.0, 100)))
+
+    def tearDown(self):
+        ratelimit._limiter = self._limiter
+        ClockTest.tearDown(self)
+
+    def conn(self, *responses):
+        return ratelimit.install(FakeConnection(self.clock, responses))
+
+    def test_throttled_calls_back_off(self):
+        conn = self.conn(Response(503, THROTTLE_BODY),
+                         Response(503, THROTTLE_BODY),
+                         Response(200))
+        response = conn._mexe(Request('DescribeImages'),
+                              override_num_retries=3)
+        self.assertEqual(response.status, 200)
+        backoffs = [each for each in self.clock.slept
+                    if each >= ratelimit.THROTTLE_BACKOFF_BASE_SECONDS / 2]
+        self.assertEqual(len(backoffs), 2)
+        self.assertGreaterEqual(backoffs[1],
+                                ratelimit.THROTTLE_BACKOFF_BASE_SECONDS)
+        stats = ratelimit.stats()['describe']
+        self.assertEqual(stats['throttles'], 2)
+        self.assertEqual(stats['calls'], 3)
+
+    def test_last_throttled_attempt_raises_at_once(self):
+        conn = self.conn(*[Response(503, THROTTLE_BODY)] * 2)
+        with self.assertRaises(boto.exception.EC2ResponseError) as context:
+            conn._mexe(Request('DeleteSnapshot'), override_num_retries=1)
+        self.assertEqual(context.exception.error_code, 'RequestLimitExceeded')
+        # One backoff and token wait before the retry, none after it.
+        self.assertLess(sum(self.clock.slept),
+                        ratelimit.THROTTLE_BACKOFF_BASE_SECONDS + 1)
+
+    def test_other_errors_are_left_to_boto(self):
+        conn = self.conn(Response(400, '<Response><Errors><Error><Code>'
+                                       'InvalidAMIID.NotFound</Code>'
+                                       '</Error></Errors></Response>'))
+        response = conn._mexe(Request('DescribeImages'),
+                              override_num_retries=3)
+        self.assertEqual(response.status, 400)
+        self.assertEqual(ratelimit.stats()['describe']['throttles'], 0)
+
+    def test_backoff_grows_up_to_cap(self):
+        for attempt in range(10):
+            delay = ratelimit._backoff_seconds(attempt)
+            expected = min(ratelimit.THROTTLE_BACKOFF_CAP_SECONDS,
+                           ratelimit.THROTTLE_BACKOFF_BASE_SECONDS
+                           * 2 ** attempt)
+            self.assertGreaterEqual(delay, expected / 2)
+            self.assertLessEqual(delay, expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
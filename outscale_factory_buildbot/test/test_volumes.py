@@ -0,0 +1,86 @@
+"""
+Tests of volumes.
+"""
+import unittest
+
+from boto.ec2.blockdevicemapping import BlockDeviceType
+
+from outscale_factory_buildbot.tools import volumes
+from outscale_factory_buildbot.test.test_delete_images import ec2_error
+
+
+class Image(object):
+
+    def __init__(self, image_id, mapping=None, root_device_name='/dev/sda1'):
+        self.id = image_id
+        self.block_device_mapping = mapping
+        self.root_device_name = root_device_name
+
+
+class Connection(object):
+
+    def __init__(self, images, error=None):
+        self.images = images
+        self.error = error
+
+    def get_image(self, image_id):
+        if self.error:
+            raise ec2_error(self.error)
+        return self.images.get(image_id)
+
+    def delete_volume(self, volume_id):
+        if self.error:
+            raise ec2_error(self.error)
+        return True
+
+
+class ImageRootSnapshotTest(unittest.TestCase):
+
+    def test_root_snapshot(self):
+        image = Image('ami-1', {
+            '/dev/sda1': BlockDeviceType(snapshot_id='snap-1', size=10),
+            '/dev/sdb': BlockDeviceType(snapshot_id='snap-2', size=20),
+        })
+        self.assertEqual(volumes.image_root_snapshot(None, image),
+                         ('snap-1', 10))
+
+    def test_refetches_image_without_mapping(self):
+        full = Image('ami-1', {
+            '/dev/sda1': BlockDeviceType(snapshot_id='snap-1', size=10),
+        })
+        conn = Connection({'ami-1': full})
+        self.assertEqual(volumes.image_root_snapshot(conn, Image('ami-1')),
+                         ('snap-1', 10))
+
+    def test_deleted_image(self):
+        conn = Connection({})
+        self.assertEqual(volumes.image_root_snapshot(conn, Image('ami-1')),
+                         (None, None))
+
+    def test_image_not_found_error(self):
+        conn = Connection({}, error='InvalidAMIID.NotFound')
+        self.assertEqual(volumes.image_root_snapshot(conn, Image('ami-1')),
+                         (None, None))
+
+    def test_other_errors_are_raised(self):
+        conn = Connection({}, error='InternalError')
+        self.assertRaises(Exception, volumes.image_root_snapshot, conn,
+                          Image('ami-1'))
+
+
+class DeleteVolumeTest(unittest.TestCase):
+
+    def test_delete_volume(self):
+        self.assertTrue(volumes.delete_volume(Connection({}), 'vol-1'))
+
+    def test_deleted_volume(self):
+        conn = Connection({}, error='InvalidVolume.NotFound')
+        self.assertFalse(volumes.delete_volume(conn, 'vol-1'))
+
+    def test_other_errors_are_raised(self):
+        conn = Connection({}, error='VolumeInUse')
+        self.assertRaises(Exception, volumes.delete_volume, conn, 'vol-1')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,224 @@
+"""
+Tests of workqueue.
+"""
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from twisted.internet import defer, task
+
+# The ec2buildslave shim of buildbot 0.8.12, imported by the buildbot
+# subpackage, deprecates its attribute in buildbot.libvirtbuildslave,
+# which must be imported first.
+import buildbot.libvirtbuildslave
+
+from outscale_factory_buildbot.buildbot import workqueue
+
+
+class FakeClock(task.Clock):
+
+    """
+    Reactor and time module of the queue.
+    """
+
+    def time(self):
+        return self.seconds()
+
+
+class FakeRandom(object):
+
+    """
+    Always the longest backoff.
+    """
+
+    def uniform(self, low, high):
+        return high
+
+
+class Handler(object):
+
+    """
+    Work queue handler failing the first failures calls, or leaving the
+    Deferreds to the test when hold is set.
+    """
+
+    def __init__(self, failures=0, hold=False):
+        self.failures = failures
+        self.hold = hold
+        self.calls = []
+        self.held = []
+
+    def __call__(self, args):
+        self.calls.append(args)
+        if self.hold:
+            d = defer.Deferred()
+            self.held.append(d)
+            return d
+        if len(self.calls) <= self.failures:
+            raise RuntimeError('attempt {} failed'.format(len(self.calls)))
+        return defer.succeed(None)
+
+
+class WorkQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.clock.advance(1000)
+        self._reactor = workqueue.reactor
+        self._time = workqueue.time
+        self._random = workqueue.random
+        self._handlers = dict(workqueue._handlers)
+        workqueue.reactor = self.clock
+        workqueue.time = self.clock
+        workqueue.random = FakeRandom()
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'workqueue.json')
+
+    def tearDown(self):
+        workqueue.reactor = self._reactor
+        workqueue.time = self._time
+        workqueue.random = self._random
+        workqueue._handlers.clear()
+        workqueue._handlers.update(self._handlers)
+        shutil.rmtree(self.tmpdir)
+
+    def queue(self, **kw):
+        kw.setdefault('backoff_base', 30)
+        kw.setdefault('backoff_cap', 3600)
+        return workqueue.WorkQueue(self.path, **kw)
+
+    def saved(self):
+        with open(self.path) as file_handle:
+            return json.load(file_handle)
+
+    def test_item_is_run(self):
+        handler = Handler()
+        workqueue.register('cleanup', handler)
+        queue = self.queue()
+        queue.enqueue('cleanup', dict(volume_id='vol-1'))
+        self.assertEqual(len(self.saved()['items']), 1)
+        self.clock.advance(0)
+        self.assertEqual(handler.calls, [dict(volume_id='vol-1')])
+        self.assertEqual(self.saved(), dict(items=[], dead=[]))
+        stats = queue.stats()
+        self.assertEqual((stats['completed'], stats['backlog']), (1, 0))
+
+    def test_unknown_kind_is_refused(self):
+        queue = self.queue()
+        self.assertRaises(KeyError, queue.enqueue, 'cleanup', {})
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_failed_item_is_retried_with_backoff(self):
+        handler = Handler(failures=2)
+        workqueue.register('cleanup', handler)
+        queue = self.queue()
+        queue.enqueue('cleanup', {})
+        self.clock.advance(0)
+        item, = self.saved()['items']
+        self.assertEqual(item['attempts'], 1)
+        self.assertEqual(item['last_error'], 'attempt 1 failed')
+        self.assertEqual(item['next_attempt_at'], self.clock.seconds() + 60)
+
+        # Not retried before its backoff.
+        self.clock.advance(59)
+        queue._run_due()
+        self.assertEqual(len(handler.calls), 1)
+        self.clock.advance(1)
+        queue._run_due()
+        self.assertEqual(len(handler.calls), 2)
+        item, = self.saved()['items']
+        self.assertEqual(item['next_attempt_at'], self.clock.seconds() + 120)
+
+        self.clock.advance(120)
+        queue._run_due()
+        self.assertEqual(len(handler.calls), 3)
+        self.assertEqual(self.saved()['items'], [])
+        self.assertEqual(queue.stats()['failures'], 2)
+
+    def test_backoff_is_capped(self):
+        workqueue.register('cleanup', Handler(failures=10))
+        queue = self.queue(backoff_cap=100)
+        queue.enqueue('cleanup', {})
+        for _ in range(4):
+            self.clock.advance(100)
+            queue._run_due()
+        item, = self.saved()['items']
+        self.assertEqual(item['attempts'], 4)
+        self.assertEqual(item['next_attempt_at'], self.clock.seconds() + 100)
+
+    def test_item_is_dead_after_max_attempts(self):
+        handler = Handler(failures=10)
+        workqueue.register('cleanup', handler)
+        queue = self.queue(max_attempts=3)
+        queue.enqueue('cleanup', dict(volume_id='vol-1'))
+        for _ in range(5):
+            self.clock.advance(3600)
+            queue._run_due()
+        self.assertEqual(len(handler.calls), 3)
+        saved = self.saved()
+        self.assertEqual(saved['items'], [])
+        dead, = saved['dead']
+        self.assertEqual((dead['args'], dead['attempts'], dead['last_error']),
+                         (dict(volume_id='vol-1'), 3, 'attempt 3 failed'))
+        self.assertEqual(queue.stats()['dead'], 1)
+
+    def test_items_are_reloaded(self):
+        handler = Handler(hold=True)
+        workqueue.register('cleanup', handler)
+        queue = self.queue()
+        queue.enqueue('cleanup', dict(volume_id='vol-1'))
+        queue.enqueue('cleanup', dict(volume_id='vol-2'))
+        self.clock.advance(0)
+        self.assertEqual(len(handler.held), 2)
+
+        # The master stopped before the handlers finished.
+        restarted = self.queue()
+        self.assertEqual(restarted.stats()['backlog'], 2)
+        handler.hold = False
+        restarted._run_due()
+        self.assertEqual(handler.calls[2:], [dict(volume_id='vol-1'),
+                                             dict(volume_id='vol-2')])
+        self.assertEqual(self.saved()['items'], [])
+
+    def test_dead_items_are_reloaded(self):
+        workqueue.register('cleanup', Handler(failures=1))
+        queue = self.queue(max_attempts=1)
+        queue.enqueue('cleanup', {})
+        self.clock.advance(0)
+        self.assertEqual(self.queue().stats()['dead'], 1)
+
+    def test_corrupt_file_is_ignored(self):
+        with open(self.path, 'w') as file_handle:
+            file_handle.write('{"items": [')
+        self.assertEqual(self.queue().stats()['backlog'], 0)
+
+    def test_item_without_handler_fails(self):
+        workqueue.register('cleanup', Handler())
+        queue = self.queue()
+        queue.enqueue('cleanup', {})
+        # Reloaded by a master without the handler.
+        del workqueue._handlers['cleanup']
+        self.clock.advance(0)
+        item, = self.saved()['items']
+        self.assertEqual(item['attempts'], 1)
+        self.assertIn('No handler for cleanup', item['last_error'])
+
+    def test_concurrency(self):
+        handler = Handler(hold=True)
+        workqueue.register('cleanup', handler)
+        queue = self.queue(concurrency=2)
+        for index in range(3):
+            queue.enqueue('cleanup', dict(index=index))
+        self.clock.advance(0)
+        self.assertEqual(len(handler.held), 2)
+        self.assertEqual(queue.stats()['running'], 2)
+        handler.held[0].callback(None)
+        queue._run_due()
+        self.assertEqual([args['index'] for args in handler.calls],
+                         [0, 1, 2])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,19 +1,314 @@
 #!/usr/bin/env python
 """
 Tool used to delete images.
+
+Images are deleted by a bounded pool of worker threads. Throttling and
+transient errors are retried with exponential backoff and jitter, other
+errors are reported without stopping the remaining deletions.
+
+The root snapshot of an image is read first, then the image is
+deregistered and the snapshot deleted, each step with its own retries: a
+snapshot still in use must not turn into a missing image on retry.
 """
-import boto.ec2
+import logging
+import random
+import socket
 import sys
+import threading
+import time
+
+import boto.exception
+from boto.compat import http_client
+from boto.vendored.six.moves import queue
+
+from outscale_factory_buildbot.tools import ec2_pool
+from outscale_factory_buildbot.tools import image_cache
+from outscale_factory_buildbot.tools import volumes
+from outscale_factory_buildbot.tools.find_images import find_images
+
+
+DEFAULT_CONCURRENCY = 4
+DEFAULT_MAX_ATTEMPTS = 5
+DEFAULT_BACKOFF_BASE_SECONDS = 1.0
+DEFAULT_BACKOFF_CAP_SECONDS = 30.0
+
+# Error codes worth retrying: throttling, resources still in use,
+# transient server errors.
+RETRYABLE_ERROR_CODES = frozenset((
+    'RequestLimitExceeded',
+    'Throttling',
+    'ThrottlingException',
+    'DependencyViolation',
+    'InvalidSnapshot.InUse',
+    'IncorrectState',
+    'InternalError',
+    'ServiceUnavailable',
+    'Unavailable',
+))
+
+# Error codes meaning the image is already gone.
+MISSING_ERROR_CODES = frozenset((
+    'InvalidAMIID.NotFound',
+    'InvalidAMIID.Unavailable',
+))
+
+# Error codes meaning the snapshot is already gone.
+SNAPSHOT_MISSING_ERROR_CODES = frozenset((
+    'InvalidSnapshot.NotFound',
+))
+
+
+class DeleteImagesError(Exception):
+
+    """
+    Error raised when some images could not be deleted.
+    """
+
+
+class DeleteReport(object):
+
+    """
+    Outcome of a bulk deletion.
+
+    deleted: list of deleted image ids
+    snapshots_deleted: list of deleted snapshot ids
+    skipped: dictionary of image id -> reason
+    failed: dictionary of image id -> error message
+    """
+
+    def __init__(self):
+        self.deleted = []
+        self.snapshots_deleted = []
+        self.skipped = {}
+        self.failed = {}
+        self._lock = threading.Lock()
+
+    def add_deleted(self, image_id, snapshot_id=None):
+        with self._lock:
+            self.deleted.append(image_id)
+            if snapshot_id:
+                self.snapshots_deleted.append(snapshot_id)
+
+    def add_skipped(self, image_id, reason):
+        with self._lock:
+            self.skipped[image_id] = reason
+
+    def add_failed(self, image_id, error):
+        with self._lock:
+            self.failed[image_id] = str(error)
+
+    def to_dict(self):
+        """
+        Return the report as a JSON serializable dictionary.
+        """
+        return dict(
+            deleted=sorted(self.deleted),
+            snapshots_deleted=sorted(self.snapshots_deleted),
+            skipped=dict(self.skipped),
+            failed=dict(self.failed),
+        )
+
+    def summary(self):
+        """
+        Return a one line summary.
+        """
+        return '{} deleted, {} skipped, {} failed'.format(
+            len(self.deleted), len(self.skipped), len(self.failed))
+
+
+def _error_code(error):
+    """
+    Return the EC2 error code of an exception, if any.
+    """
+    return getattr(error, 'error_code', None)
+
+
+def _is_retryable(error):
+    """
+    Return True if a failed call may succeed later.
+    """
+    if isinstance(error, (socket.error, http_client.HTTPException)):
+        return True
+    if isinstance(error, boto.exception.BotoServerError):
+        return (_error_code(error) in RETRYABLE_ERROR_CODES
+                or error.status >= 500)
+    return False
+
+
+def _backoff_seconds(attempt, base, cap):
+    """
+    Return a delay before retry number attempt, with full jitter.
+    """
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def _call(region, description, func, args, max_attempts, backoff_base,
+          backoff_cap):
+    """
+    Call func(conn, *args) with a pooled connection, retrying transient
+    errors. Return its result, raise the last error.
+    """
+    for attempt in range(max_attempts):
+        try:
+            with ec2_pool.connection(region) as conn:
+                return func(conn, *args)
+        except Exception as error:
+            if not _is_retryable(error) or attempt + 1 == max_attempts:
+                raise
+            delay = _backoff_seconds(attempt, backoff_base, backoff_cap)
+            logging.info('Retrying {} in {:.1f}s: {}'
+                         .format(description, delay, error))
+            time.sleep(delay)
 
 
-def delete_images(region, image_id_list):
+def _root_snapshot(conn, image_id):
+    """
+    Return (True, root snapshot id) of an image, (False, None) if the
+    image does not exist.
+    """
+    image = conn.get_image(image_id)
+    if image is None:
+        return False, None
+    snapshot_id, _ = volumes.image_root_snapshot(conn, image)
+    return True, snapshot_id
+
+
+def _deregister_image(conn, image_id):
+    return conn.deregister_image(image_id)
+
+
+def _delete_snapshot(conn, snapshot_id):
+    return conn.delete_snapshot(snapshot_id)
+
+
+def _delete_image(region, image_id, report, max_attempts, backoff_base,
+                  backoff_cap):
+    """
+    Delete one image and its root snapshot, retrying transient errors.
+
+    The image counts as deleted once both are gone.
+    """
+    def call(description, func, *args):
+        return _call(region, description, func, args, max_attempts,
+                     backoff_base, backoff_cap)
+
+    try:
+        exists, snapshot_id = call('lookup of {}'.format(image_id),
+                                   _root_snapshot, image_id)
+        if exists:
+            call('deregistration of {}'.format(image_id),
+                 _deregister_image, image_id)
+    except Exception as error:
+        if _error_code(error) not in MISSING_ERROR_CODES:
+            logging.error('Could not delete {}: {}'.format(image_id, error))
+            report.add_failed(image_id, error)
+            return
+        exists = False
+    image_cache.discard_images(region, [image_id])
+    if not exists:
+        report.add_skipped(image_id, 'not found')
+        return
+
+    if snapshot_id:
+        try:
+            call('deletion of snapshot {}'.format(snapshot_id),
+                 _delete_snapshot, snapshot_id)
+        except Exception as error:
+            if _error_code(error) not in SNAPSHOT_MISSING_ERROR_CODES:
+                logging.error('Deregistered {} but could not delete its '
+                              'snapshot {}: {}'
+                              .format(image_id, snapshot_id, error))
+                report.add_failed(image_id, 'deregistered, snapshot {} not '
+                                            'deleted: {}'
+                                            .format(snapshot_id, error))
+                return
+            snapshot_id = None
+    logging.info('Deleted {}'.format(image_id))
+    report.add_deleted(image_id, snapshot_id)
+
+
+def delete_images(region,
+                  image_id_list,
+                  concurrency=DEFAULT_CONCURRENCY,
+                  dry_run=False,
+                  max_attempts=DEFAULT_MAX_ATTEMPTS,
+                  backoff_base=DEFAULT_BACKOFF_BASE_SECONDS,
+                  backoff_cap=DEFAULT_BACKOFF_CAP_SECONDS):
     """
     Delete all images and associated snapshots.
+
+    image_id_list can be any iterable, it is consumed as the workers
+    progress. Return a DeleteReport.
+    """
+    report = DeleteReport()
+    tasks = queue.Queue(maxsize=2 * concurrency)
+
+    def work():
+        while True:
+            image_id = tasks.get()
+            if image_id is None:
+                return
+            try:
+                _delete_image(region, image_id, report, max_attempts,
+                              backoff_base, backoff_cap)
+            except Exception as error:
+                report.add_failed(image_id, error)
+
+    workers = []
+    if not dry_run:
+        for _ in range(max(1, concurrency)):
+            worker = threading.Thread(target=work)
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+
+    seen = set()
+    try:
+        for image_id in image_id_list:
+            if image_id in seen:
+                continue
+            seen.add(image_id)
+            if dry_run:
+                logging.info('Would delete {}'.format(image_id))
+                report.add_skipped(image_id, 'dry run')
+            else:
+                tasks.put(image_id)
+    finally:
+        for _ in workers:
+            tasks.put(None)
+        for worker in workers:
+            worker.join()
+
+    logging.info('Image deletion in {}: {}'.format(region, report.summary()))
+    return report
+
+
+def delete_old_images(region, appliance, max_versions, **kw):
     """
-    conn = boto.ec2.connect_to_region(region)
-    for image_id in image_id_list:
-        sys.stderr.write('Deleting {}\n'.format(image_id))
-        conn.deregister_image(image_id, delete_snapshot=True)
+    Delete all but the max_versions most recent images of an appliance,
+    by timestamp tag. Other arguments are passed to delete_images.
+
+    Return a DeleteReport.
+    """
+    images = find_images(region,
+                         tags=dict(appliance=appliance),
+                         owners=['self'])
+    images.sort(key=lambda x: x.tags['timestamp'])
+    ids = [each.id for each in images[:-max_versions]]
+    return delete_images(region, ids, **kw)
+
+
+def read_image_ids(stream):
+    """
+    Yield image ids read from a stream as they arrive.
+
+    Accept one id per line as well as the JSON array printed by find_images.
+    """
+    for line in stream:
+        for token in line.replace(',', ' ').split():
+            token = token.strip('[]"\'')
+            if token:
+                yield token
 
 
 def main():
@@ -21,16 +316,30 @@ def main():
     Main function.
     """
     import json
-    if len(sys.argv) not in (2, 3):
-        sys.stderr.write('Usage: {} REGION AMI_ID_LIST_JSON\n'
-                         .format(sys.argv[0]))
-        sys.exit(1)
-    region = sys.argv[1]
-    if sys.argv[2] == '-':
-        ami_id_list = json.load(sys.stdin)
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description='Delete images and their snapshots.')
+    parser.add_argument('region')
+    parser.add_argument('ami_id_list_json', nargs='?', default='-',
+                        help='JSON list of image ids, or - to read ids '
+                             'from stdin (default)')
+    parser.add_argument('--concurrency', type=int,
+                        default=DEFAULT_CONCURRENCY)
+    parser.add_argument('--dry-run', action='store_true')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(levelname)s: %(message)s',
+                        level=logging.INFO)
+    if args.ami_id_list_json == '-':
+        ami_id_list = read_image_ids(sys.stdin)
     else:
-        ami_id_list = json.loads(sys.argv[2])
-    delete_images(region, ami_id_list)
+        ami_id_list = json.loads(args.ami_id_list_json)
+    report = delete_images(args.region, ami_id_list,
+                           concurrency=args.concurrency,
+                           dry_run=args.dry_run)
+    json.dump(report.to_dict(), sys.stdout, indent=4, separators=(',', ': '))
+    sys.stdout.write('\n')
+    sys.exit(1 if report.failed else 0)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,224 @@
+"""
+Pool of long-lived EC2 connections.
+
+Opening a connection with boto.ec2.connect_to_region costs a TLS handshake
+on first use. The buildsteps and the tools borrow connections from a
+module level pool instead, so that a connection is reused across steps and
+builds. Their requests go through the shared rate limiter of ratelimit.
+
+A boto connection must not be used by two threads at the same time, so a
+borrowed connection is owned by the borrower until it is given back.
+"""
+import contextlib
+import logging
+import socket
+import threading
+import time
+
+import boto.ec2
+import boto.exception
+from boto.compat import http_client
+
+from outscale_factory_buildbot.tools import ratelimit
+
+
+# Idle connections kept per region.
+DEFAULT_MAX_SIZE = 8
+
+# Idle connections older than this are closed instead of being reused.
+DEFAULT_MAX_IDLE_SECONDS = 300
+
+# Idle connections older than this are checked before being reused.
+DEFAULT_CHECK_AFTER_SECONDS = 60
+
+# Errors meaning the connection itself is broken, not the request.
+CONNECTION_ERRORS = (socket.error, http_client.HTTPException)
+
+
+class ConnectionPool(object):
+
+    """
+    Thread-safe pool of EC2 connections, keyed by region.
+    """
+
+    def __init__(self,
+                 max_size=DEFAULT_MAX_SIZE,
+                 max_idle_seconds=DEFAULT_MAX_IDLE_SECONDS,
+                 check_after_seconds=DEFAULT_CHECK_AFTER_SECONDS,
+                 connect=None):
+        self.max_size = max_size
+        self.max_idle_seconds = max_idle_seconds
+        self.check_after_seconds = check_after_seconds
+        self._connect = connect or boto.ec2.connect_to_region
+        self._lock = threading.Lock()
+        self._idle = {}
+        self._stats = dict(
+            hits=0,
+            misses=0,
+            evictions=0,
+            discards=0,
+            failed_checks=0,
+        )
+
+    def acquire(self, region):
+        """
+        Return a connection to region, reusing an idle one if possible.
+        """
+        self.evict_idle()
+        while True:
+            conn, last_used = self._pop_idle(region)
+            if conn is None:
+                break
+            if time.time() - last_used < self.check_after_seconds:
+                return conn
+            if self._check(conn):
+                return conn
+            self._close(conn)
+            with self._lock:
+                self._stats['failed_checks'] += 1
+
+        conn = self._connect(region)
+        if conn is None:
+            raise ValueError('Unknown region {}'.format(repr(region)))
+        return ratelimit.install(conn)
+
+    def release(self, region, conn, discard=False):
+        """
+        Give a connection back to the pool.
+
+        Broken connections should be released with discard=True.
+        """
+        with self._lock:
+            idle = self._idle.setdefault(region, [])
+            if discard:
+                self._stats['discards'] += 1
+            elif len(idle) < self.max_size:
+                idle.append((conn, time.time()))
+                return
+        self._close(conn)
+
+    @contextlib.contextmanager
+    def connection(self, region):
+        """
+        Context manager borrowing a connection for the duration of a block.
+        """
+        conn = self.acquire(region)
+        try:
+            yield conn
+        except CONNECTION_ERRORS:
+            self.release(region, conn, discard=True)
+            raise
+        except:
+            self.release(region, conn)
+            raise
+        else:
+            self.release(region, conn)
+
+    def evict_idle(self):
+        """
+        Close idle connections which exceeded max_idle_seconds.
+        """
+        expired = []
+        deadline = time.time() - self.max_idle_seconds
+        with self._lock:
+            for region, idle in self._idle.items():
+                expired.extend(conn for conn, last_used in idle
+                               if last_used < deadline)
+                idle[:] = [(conn, last_used) for conn, last_used in idle
+                           if last_used >= deadline]
+            self._stats['evictions'] += len(expired)
+        for conn in expired:
+            self._close(conn)
+
+    def clear(self):
+        """
+        Close all idle connections.
+        """
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for entries in idle.values():
+            for conn, _ in entries:
+                self._close(conn)
+
+    def stats(self):
+        """
+        Return a copy of the pool counters, with idle connections per region.
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats['idle'] = dict((region, len(idle))
+                                 for region, idle in self._idle.items())
+        return stats
+
+    def _pop_idle(self, region):
+        """
+        Pop the most recently used idle connection to region.
+        """
+        with self._lock:
+            idle = self._idle.get(region)
+            if idle:
+                self._stats['hits'] += 1
+                return idle.pop()
+            self._stats['misses'] += 1
+            return None, None
+
+    def _check(self, conn):
+        """
+        Return True if the connection still works.
+        """
+        try:
+            conn.get_all_zones()
+        except (boto.exception.BotoClientError,
+                boto.exception.BotoServerError) + CONNECTION_ERRORS as error:
+            logging.info('Dropping EC2 connection: {}'.format(error))
+            return False
+        return True
+
+    def _close(self, conn):
+        """
+        Close a connection, ignoring errors.
+        """
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+
+_pool = ConnectionPool()
+
+
+def configure(max_size=None, max_idle_seconds=None, check_after_seconds=None,
+              connect=None):
+    """
+    Change the settings of the module level pool.
+
+    connect(region) replaces boto.ec2.connect_to_region, to use another
+    endpoint; idle connections are then closed.
+    """
+    if max_size is not None:
+        _pool.max_size = max_size
+    if max_idle_seconds is not None:
+        _pool.max_idle_seconds = max_idle_seconds
+    if check_after_seconds is not None:
+        _pool.check_after_seconds = check_after_seconds
+    if connect is not None:
+        _pool._connect = connect
+        _pool.clear()
+
+
+def connection(region):
+    """
+    Borrow a connection to region from the module level pool.
+
+    Usage:
+        with ec2_pool.connection(region) as conn:
+            conn.get_all_images()
+    """
+    return _pool.connection(region)
+
+
+def stats():
+    """
+    Return the counters of the module level pool.
+    """
+    return _pool.stats()
@@ -3,52 +3,167 @@
 Tool used to find virtual machine images by name.
 """
 from fnmatch import fnmatch
-import boto.ec2
 
+from boto.ec2.image import Image
 
-def find_images(region, pattern='', tags={}):
+from outscale_factory_buildbot.tools import ec2_pool
+from outscale_factory_buildbot.tools import image_cache
+
+
+def _server_filters(pattern='', tags={}, is_public=None):
+    """
+    Return the EC2 filters selecting images by name pattern, tags and
+    visibility.
+
+    EC2 name filters understand the * and ? wildcards. Patterns using
+    [seq] classes are sent as their literal prefix followed by *, the
+    class is then matched locally.
+    """
+    filters = dict(('tag:' + k, tags[k]) for k in tags)
+    if pattern:
+        if '[' not in pattern:
+            filters['name'] = pattern
+        else:
+            prefix = image_cache.literal_prefix(pattern)
+            if prefix:
+                filters['name'] = prefix + '*'
+    if is_public is not None:
+        filters['is-public'] = 'true' if is_public else 'false'
+    return filters
+
+
+def _iter_pages(region, filters, owners=None, page_size=None):
+    """
+    Yield pages of images from the cloud.
+
+    A connection is only borrowed while a page is fetched.
+    """
+    params = {}
+    if page_size:
+        params['MaxResults'] = page_size
+    while True:
+        with ec2_pool.connection(region) as conn:
+            if owners:
+                conn.build_list_params(params, owners, 'Owner')
+            conn.build_filter_params(params, filters)
+            page = conn.get_list('DescribeImages', params, [('item', Image)],
+                                 verb='POST')
+        yield page
+        next_token = getattr(page, 'next_token', None)
+        if not next_token:
+            return
+        params['NextToken'] = next_token
+
+
+def iter_images(region, pattern='', tags={}, owners=None, is_public=None,
+                page_size=None):
+    """
+    Take name pattern and/or tags,
+    yield image objects as pages arrive from the cloud.
+
+    The name pattern is shell style: ?*[seq][!seq].
+    owners is a list of account ids, or 'self'.
+    is_public restricts to public (True) or private (False) images.
+
+    Not cached and not sorted.
+    """
+    filters = _server_filters(pattern, tags, is_public)
+    local = pattern and filters.get('name') != pattern
+    for page in _iter_pages(region, filters, owners, page_size):
+        for image in page:
+            if not local or fnmatch(image.name, pattern):
+                yield image
+
+
+def _find_images(region, pattern, tags, owners, is_public):
+    """
+    Return unsorted list of images, using the image catalog.
+    """
+    return image_cache.find(
+        region,
+        lambda: list(iter_images(region, pattern, tags, owners, is_public)),
+        pattern,
+        _server_filters(pattern, tags, is_public),
+        owners)
+
+
+def find_images(region, pattern='', tags={}, owners=None, is_public=None):
     """
     Take name pattern and/or tags,
     return list of image objects,
     sorted by name in reverse order.
 
     The name pattern is shell style: ?*[seq][!seq].
+    owners and is_public scope the search, see iter_images.
+
+    Listings are cached, see image_cache.
     """
-    conn = boto.ec2.connect_to_region(region)
-    filters = {}
-    if tags:
-        filters.update(('tag:' + k, tags[k]) for k in tags)
-    images = conn.get_all_images(filters=filters)
-    if pattern:
-        images = [each for each in images
-                  if fnmatch(each.name, pattern)]
     return sorted(
-        images,
+        _find_images(region, pattern, tags, owners, is_public),
         reverse=True,
         key=lambda x: x.name)
 
 
+def find_last_image(region, pattern='', tags={}, owners=None, is_public=None):
+    """
+    Return the image with the greatest name, as find_images()[0] would,
+    without sorting. Return None if no image matches.
+
+    DescribeImages does not return images ordered by name, so the whole
+    matching listing is still fetched (or read from the image catalog)
+    before the greatest name is known. Only the sort is saved.
+    """
+    images = _find_images(region, pattern, tags, owners, is_public)
+    if not images:
+        return None
+    return max(images, key=lambda x: x.name)
+
+
 def main():
     """
     Main function.
     """
     import json
-    import pprint
     import sys
-    if len(sys.argv) != 4:
-        sys.stderr.write('Usage: {} REGION NAME_PATTERN TAGS_JSON\n'
-                         .format(sys.argv[0]))
-        sys.exit(1)
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description='Find images by name and tags.')
+    parser.add_argument('region')
+    parser.add_argument('name_pattern')
+    parser.add_argument('tags_json')
+    parser.add_argument('--owner', action='append', dest='owners',
+                        help='account id or "self", can be repeated')
+    parser.add_argument('--public', action='store_true', default=None,
+                        dest='is_public', help='only public images')
+    parser.add_argument('--private', action='store_false',
+                        dest='is_public', help='only private images')
+    parser.add_argument('--stream', action='store_true',
+                        help='print ids one per line as they arrive, '
+                             'unsorted')
+    args = parser.parse_args()
+
+    if args.stream:
+        for image in iter_images(args.region,
+                                 args.name_pattern,
+                                 json.loads(args.tags_json),
+                                 args.owners,
+                                 args.is_public):
+            sys.stdout.write('{}\n'.format(image.id))
+            sys.stdout.flush()
+        return
+
     images = find_images(
-        sys.argv[1],
-        sys.argv[2],
-        json.loads(sys.argv[3]))
+        args.region,
+        args.name_pattern,
+        json.loads(args.tags_json),
+        args.owners,
+        args.is_public)
     name_list = [each.name for each in images]
     id_list = [each.id for each in images]
     json.dump(name_list, sys.stderr, indent=4, separators=(',', ': '))
     sys.stderr.write('\n')
     json.dump(id_list, sys.stdout, indent=4, separators=(',', ': '))
     sys.stdout.write('\n')
-    
+
 if __name__ == '__main__':
     main()
@@ -2,7 +2,7 @@
 """
 Tool used to find a single image by name.
 """
-from outscale_factory_buildbot.tools.find_images import find_images
+from outscale_factory_buildbot.tools.find_images import find_last_image
 
 
 class ImageNotFound(Exception):
@@ -12,15 +12,17 @@ class ImageNotFound(Exception):
     """
 
 
-def get_image_id(region, pattern='', tags={}):
+def get_image_id(region, pattern='', tags={}, owners=None, is_public=None):
     """
-    Return first image id found.
+    Return the id of the image with the greatest name.
+
+    Lists every matching image, see find_last_image.
     """
-    images = find_images(region, pattern, tags)
-    if not images:
+    image = find_last_image(region, pattern, tags, owners, is_public)
+    if image is None:
         raise ImageNotFound('No such image region={} pattern={} tags={}'
                             .format(repr(region), repr(pattern), repr(tags)))
-    return images[0].id
+    return image.id
 
 
 def main():
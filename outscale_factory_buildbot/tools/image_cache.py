@@ -0,0 +1,309 @@
+"""
+In-memory catalog of images, shared by find_images and the buildsteps.
+
+Each listing fetched from the cloud is kept for a limited time and indexed
+by tag key/value and by name. A query is answered from any fresh listing
+with the same owner scope whose server-side filters are a subset of the
+query's filters, without calling the cloud.
+
+Images created or deleted by the factory are written through to the
+catalog, so it does not serve stale data after our own writes.
+"""
+import bisect
+import threading
+import time
+from fnmatch import fnmatch
+
+
+# Seconds a listing is reused before being fetched again.
+DEFAULT_TTL_SECONDS = 300
+
+# Shell pattern characters. The name prefix before them is a literal.
+PATTERN_CHARS = '*?['
+
+
+class ImageRecord(object):
+
+    """
+    Image created by the factory, known without asking the cloud.
+
+    Has the attributes of a boto image used by the package.
+    """
+
+    def __init__(self, id, name, tags, is_public=False):
+        self.id = id
+        self.name = name
+        self.tags = dict(tags)
+        self.is_public = is_public
+
+    def __repr__(self):
+        return 'ImageRecord:{}'.format(self.id)
+
+
+def literal_prefix(pattern):
+    """
+    Return the part of a shell pattern before the first wildcard.
+    """
+    for index, char in enumerate(pattern):
+        if char in PATTERN_CHARS:
+            return pattern[:index]
+    return pattern
+
+
+def _filter_matches(key, value, image):
+    """
+    Evaluate an EC2 image filter locally.
+    """
+    if key.startswith('tag:'):
+        return (image.tags or {}).get(key[len('tag:'):]) == value
+    if key == 'name':
+        return fnmatch(image.name or '', value)
+    if key == 'is-public':
+        return bool(getattr(image, 'is_public', False)) == (value == 'true')
+    raise ValueError('Unsupported image filter {}'.format(repr(key)))
+
+
+class _Listing(object):
+
+    """
+    Images returned by one query, indexed by tag and by name.
+    """
+
+    def __init__(self, filters, images, fetched_at):
+        self.filters = dict(filters)
+        self.fetched_at = fetched_at
+        self._by_id = {}
+        self._by_tag = {}
+        self._names = []
+        for image in images:
+            self.add(image)
+
+    def __len__(self):
+        return len(self._by_id)
+
+    def matches(self, image):
+        """
+        Return True if the image would be returned by the listing's query.
+        """
+        return all(_filter_matches(key, value, image)
+                   for key, value in self.filters.items())
+
+    def add(self, image):
+        """
+        Add or replace an image.
+        """
+        self.remove(image.id)
+        self._by_id[image.id] = image
+        for item in (image.tags or {}).items():
+            self._by_tag.setdefault(item, set()).add(image.id)
+        bisect.insort(self._names, (image.name or '', image.id))
+
+    def remove(self, image_id):
+        """
+        Remove an image if present.
+        """
+        image = self._by_id.pop(image_id, None)
+        if image is None:
+            return
+        for item in (image.tags or {}).items():
+            ids = self._by_tag.get(item)
+            if ids is not None:
+                ids.discard(image_id)
+                if not ids:
+                    del self._by_tag[item]
+        entry = (image.name or '', image_id)
+        index = bisect.bisect_left(self._names, entry)
+        if index < len(self._names) and self._names[index] == entry:
+            del self._names[index]
+
+    def lookup(self, pattern, filters):
+        """
+        Return images matching a name pattern and filters.
+
+        The name filter, if any, must be implied by the pattern.
+        """
+        ids = None
+        others = []
+        for key, value in filters.items():
+            if key in self.filters or key == 'name':
+                continue
+            if not key.startswith('tag:'):
+                others.append((key, value))
+                continue
+            tagged = self._by_tag.get((key[len('tag:'):], value), set())
+            ids = tagged if ids is None else ids & tagged
+            if not ids:
+                return []
+
+        if pattern:
+            prefix = literal_prefix(pattern)
+            start = bisect.bisect_left(self._names, (prefix,))
+            named = []
+            for name, image_id in self._names[start:]:
+                if not name.startswith(prefix):
+                    break
+                if fnmatch(name, pattern) and (ids is None or image_id in ids):
+                    named.append(image_id)
+            ids = named
+        elif ids is None:
+            ids = self._by_id
+
+        return [self._by_id[image_id] for image_id in ids
+                if all(_filter_matches(key, value, self._by_id[image_id])
+                       for key, value in others)]
+
+
+class ImageCatalog(object):
+
+    """
+    Thread-safe cache of image listings, keyed by region, owners and filters.
+    """
+
+    def __init__(self, ttl_seconds=DEFAULT_TTL_SECONDS):
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._listings = {}
+        self._stats = dict(hits=0, misses=0)
+
+    def find(self, region, fetch, pattern='', filters={}, owners=None):
+        """
+        Return images matching a shell name pattern and EC2 filters.
+
+        Supported filters are tag:KEY, name and is-public. fetch() is called
+        to list images from the cloud when no fresh listing can answer the
+        query, it must return the images matching filters and owners.
+        """
+        scope = tuple(sorted(owners)) if owners else None
+        with self._lock:
+            listing = self._best_listing(region, scope, filters)
+            if listing is not None:
+                self._stats['hits'] += 1
+                return listing.lookup(pattern, filters)
+            self._stats['misses'] += 1
+
+        fetched_at = time.time()
+        listing = _Listing(filters, fetch(), fetched_at)
+        if self.ttl_seconds > 0:
+            with self._lock:
+                key = region, scope, frozenset(filters.items())
+                self._listings[key] = (region, listing)
+        return listing.lookup(pattern, filters)
+
+    def add_image(self, region, image):
+        """
+        Record an image created in region.
+
+        Listings scoped to explicit owners cannot tell whether the image
+        belongs to them, they are dropped.
+        """
+        with self._lock:
+            for key, (listing_region, listing) in list(self._listings.items()):
+                if listing_region != region:
+                    continue
+                scope = key[1]
+                if scope is not None and scope != ('self',):
+                    del self._listings[key]
+                elif listing.matches(image):
+                    listing.add(image)
+
+    def discard_images(self, region, image_ids):
+        """
+        Forget images deleted from region.
+        """
+        with self._lock:
+            for listing_region, listing in self._listings.values():
+                if listing_region == region:
+                    for image_id in image_ids:
+                        listing.remove(image_id)
+
+    def invalidate(self, region=None):
+        """
+        Drop the listings of a region, or of all regions.
+        """
+        with self._lock:
+            if region is None:
+                self._listings.clear()
+                return
+            for key, (listing_region, _) in list(self._listings.items()):
+                if listing_region == region:
+                    del self._listings[key]
+
+    def stats(self):
+        """
+        Return a copy of the catalog counters.
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats['listings'] = len(self._listings)
+            stats['images'] = sum(len(listing)
+                                  for _, listing in self._listings.values())
+        return stats
+
+    def _best_listing(self, region, scope, filters):
+        """
+        Return the smallest fresh listing able to answer the query.
+
+        Drop expired listings on the way. Must be called with the lock held.
+        """
+        deadline = time.time() - self.ttl_seconds
+        query = set(filters.items())
+        best = None
+        for key, (listing_region, listing) in list(self._listings.items()):
+            if listing.fetched_at < deadline:
+                del self._listings[key]
+                continue
+            if listing_region != region or key[1] != scope:
+                continue
+            if not set(listing.filters.items()) <= query:
+                continue
+            if best is None or len(listing) < len(best):
+                best = listing
+        return best
+
+
+_catalog = ImageCatalog()
+
+
+def configure(ttl_seconds=None):
+    """
+    Change the settings of the module level catalog.
+    """
+    if ttl_seconds is not None:
+        _catalog.ttl_seconds = ttl_seconds
+        if ttl_seconds <= 0:
+            _catalog.invalidate()
+
+
+def find(region, fetch, pattern='', filters={}, owners=None):
+    """
+    Find images with the module level catalog. See ImageCatalog.find.
+    """
+    return _catalog.find(region, fetch, pattern, filters, owners)
+
+
+def add_image(region, image):
+    """
+    Record an image created in region.
+    """
+    _catalog.add_image(region, image)
+
+
+def discard_images(region, image_ids):
+    """
+    Forget images deleted from region.
+    """
+    _catalog.discard_images(region, image_ids)
+
+
+def invalidate(region=None):
+    """
+    Drop cached listings.
+    """
+    _catalog.invalidate(region)
+
+
+def stats():
+    """
+    Return the counters of the module level catalog.
+    """
+    return _catalog.stats()
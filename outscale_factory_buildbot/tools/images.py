@@ -0,0 +1,78 @@
+"""
+Image operations used by the buildsteps.
+
+Each function makes a single EC2 call and returns without waiting for the
+snapshot or image to change state, so that callers can wait without
+holding a thread.
+"""
+import boto.exception
+from boto.ec2.blockdevicemapping import BlockDeviceMapping
+from boto.ec2.blockdevicemapping import BlockDeviceType
+
+
+# Device name of the root volume of the images.
+ROOT_DEVICE_NAME = '/dev/sda1'
+
+# Error codes meaning a new snapshot or image is not visible yet.
+NOT_VISIBLE_ERROR_CODES = frozenset((
+    'InvalidSnapshot.NotFound',
+    'InvalidAMIID.NotFound',
+))
+
+
+def create_snapshot(conn, volume_id, description=None):
+    """
+    Start a snapshot of a volume, return its id.
+    """
+    return conn.create_snapshot(volume_id, description).id
+
+
+def snapshot_status(conn, snapshot_id):
+    """
+    Return the status of a snapshot: pending, completed or error.
+
+    A snapshot not visible yet is pending.
+    """
+    try:
+        snapshots = conn.get_all_snapshots(snapshot_ids=[snapshot_id])
+    except boto.exception.EC2ResponseError as error:
+        if error.error_code in NOT_VISIBLE_ERROR_CODES:
+            return 'pending'
+        raise
+    if not snapshots:
+        return 'pending'
+    return snapshots[0].status
+
+
+def register_image(conn, name, snapshot_id, arch, description, tags):
+    """
+    Register and tag an image booting from a snapshot, return its id.
+    """
+    mapping = BlockDeviceMapping()
+    mapping[ROOT_DEVICE_NAME] = BlockDeviceType(snapshot_id=snapshot_id,
+                                                delete_on_termination=True)
+    image_id = conn.register_image(name=name,
+                                   description=description,
+                                   architecture=arch,
+                                   root_device_name=ROOT_DEVICE_NAME,
+                                   block_device_map=mapping)
+    if tags:
+        conn.create_tags([image_id], tags)
+    return image_id
+
+
+def image_state(conn, image_id):
+    """
+    Return the state of an image: pending, available or failed.
+
+    An image not visible yet is pending.
+    """
+    try:
+        images = conn.get_all_images(image_ids=[image_id])
+    except boto.exception.EC2ResponseError as error:
+        if error.error_code in NOT_VISIBLE_ERROR_CODES:
+            return 'pending'
+        raise
+    if not images:
+        return 'pending'
+    return images[0].state
@@ -0,0 +1,321 @@
+"""
+Shared rate limiter of the EC2 API calls.
+
+Buildsteps, tools and slaves call EC2 independently, and used to retry
+throttled calls on their own schedule, which makes throttling worse. All
+connections of ec2_pool, and those of the latent slaves, send their
+requests through one limiter instead: a token bucket per class of API
+action, describe for read-only calls and mutate for the others.
+
+The rate of a bucket adapts to the cloud (AIMD): it is halved when a call
+is throttled, at most once per decrease_interval, and grows back by
+increase requests per second every second while calls succeed. Throttled
+calls back off exponentially, wait for a new token and are sent again, up
+to the number of retries of the boto connection. The last throttled
+attempt raises at once, without the sleep boto adds before raising.
+"""
+import collections
+import logging
+import random
+import threading
+import time
+
+import boto
+import boto.exception
+
+
+# Initial (rate in requests per second, burst) of each class of action.
+DEFAULT_LIMITS = dict(
+    describe=(10.0, 20),
+    mutate=(5.0, 10),
+)
+
+# The rate of a bucket stays between MIN_RATE and MAX_RATE_FACTOR times
+# its initial rate.
+MIN_RATE = 0.5
+MAX_RATE_FACTOR = 2.0
+
+DEFAULT_INCREASE = 0.5
+DEFAULT_DECREASE = 0.5
+DEFAULT_DECREASE_INTERVAL_SECONDS = 1.0
+
+# Backoff before retrying a throttled call: base * 2 ** attempt seconds,
+# up to cap, half of it random.
+THROTTLE_BACKOFF_BASE_SECONDS = 0.5
+THROTTLE_BACKOFF_CAP_SECONDS = 10.0
+
+# Seconds of calls used to compute the effective rate.
+RATE_WINDOW_SECONDS = 60
+
+# Error codes of throttled calls.
+THROTTLE_ERROR_CODES = (
+    'RequestLimitExceeded',
+    'Throttling',
+    'ThrottlingException',
+)
+
+# Prefixes of read-only actions.
+DESCRIBE_PREFIXES = ('Describe', 'Get', 'List')
+
+
+def action_class(action):
+    """
+    Return the class of an EC2 action: describe or mutate.
+    """
+    if action and action.startswith(DESCRIBE_PREFIXES):
+        return 'describe'
+    return 'mutate'
+
+
+def _backoff_seconds(attempt):
+    """
+    Return the delay before retrying a throttled call, with equal jitter.
+    """
+    delay = min(THROTTLE_BACKOFF_CAP_SECONDS,
+                THROTTLE_BACKOFF_BASE_SECONDS * 2 ** attempt)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def _is_throttled(response):
+    """
+    Return True if an EC2 response is a throttling error.
+    """
+    if response.status not in (400, 503):
+        return False
+    body = response.read()
+    if isinstance(body, bytes):
+        body = body.decode('utf-8', 'replace')
+    return any(code in body for code in THROTTLE_ERROR_CODES)
+
+
+class TokenBucket(object):
+
+    """
+    Thread-safe token bucket with an adaptive rate.
+    """
+
+    def __init__(self,
+                 rate,
+                 burst,
+                 min_rate=MIN_RATE,
+                 max_rate=None,
+                 increase=DEFAULT_INCREASE,
+                 decrease=DEFAULT_DECREASE,
+                 decrease_interval=DEFAULT_DECREASE_INTERVAL_SECONDS):
+        self.initial_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.min_rate = min(min_rate, rate)
+        self.max_rate = max_rate or rate * MAX_RATE_FACTOR
+        self.increase = increase
+        self.decrease = decrease
+        self.decrease_interval = decrease_interval
+        self._tokens = float(burst)
+        self._updated = time.time()
+        self._last_decrease = 0
+        self._lock = threading.Lock()
+        self._recent = collections.deque()
+        self._stats = dict(calls=0, throttles=0, waits=0, wait_seconds=0.0,
+                           max_wait_seconds=0.0, decreases=0)
+        self._actions = {}
+        self._throttled_actions = {}
+
+    def _refill(self, now):
+        self._tokens = min(self.burst,
+                           self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, action=None):
+        """
+        Take a token, sleeping until it is available.
+
+        Return the seconds waited.
+        """
+        with self._lock:
+            now = time.time()
+            self._refill(now)
+            # Tokens are reserved in order: a negative count is the
+            # backlog of waiting callers.
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+            self._stats['calls'] += 1
+            if action:
+                self._actions[action] = self._actions.get(action, 0) + 1
+            self._recent.append(now + wait)
+            while self._recent and self._recent[0] < now - RATE_WINDOW_SECONDS:
+                self._recent.popleft()
+            if wait:
+                self._stats['waits'] += 1
+                self._stats['wait_seconds'] += wait
+                self._stats['max_wait_seconds'] = max(
+                    self._stats['max_wait_seconds'], wait)
+        if wait:
+            time.sleep(wait)
+        return wait
+
+    def succeeded(self):
+        """
+        Grow the rate after a call which was not throttled.
+        """
+        with self._lock:
+            # At full use, rate calls succeed per second: the rate grows
+            # by increase per second.
+            self.rate = min(self.max_rate,
+                            self.rate + self.increase / self.rate)
+
+    def throttled(self, action=None):
+        """
+        Shrink the rate after a throttled call.
+        """
+        with self._lock:
+            now = time.time()
+            self._stats['throttles'] += 1
+            if action:
+                self._throttled_actions[action] = (
+                    self._throttled_actions.get(action, 0) + 1)
+            # Calls in flight when the limit was hit are throttled
+            # together, they count as one signal.
+            if now - self._last_decrease < self.decrease_interval:
+                return
+            self._last_decrease = now
+            self._stats['decreases'] += 1
+            self._refill(now)
+            self.rate = max(self.min_rate, self.rate * self.decrease)
+            self._tokens = min(self._tokens, 0)
+        logging.info('EC2 throttling, rate lowered to {:.2f}/s'
+                     .format(self.rate))
+
+    def stats(self):
+        """
+        Return the counters, current and effective rates.
+        """
+        with self._lock:
+            now = time.time()
+            recent = len([each for each in self._recent
+                          if now - RATE_WINDOW_SECONDS <= each <= now])
+            stats = dict(self._stats)
+            stats.update(
+                rate=self.rate,
+                initial_rate=self.initial_rate,
+                burst=self.burst,
+                effective_rate=float(recent) / RATE_WINDOW_SECONDS,
+                calls_by_action=dict(self._actions),
+                throttles_by_action=dict(self._throttled_actions),
+            )
+        return stats
+
+
+class RateLimiter(object):
+
+    """
+    Token buckets of the classes of EC2 actions.
+    """
+
+    def __init__(self, limits=None):
+        self._buckets = {}
+        for name, (rate, burst) in (limits or DEFAULT_LIMITS).items():
+            self._buckets[name] = TokenBucket(rate, burst)
+
+    def bucket(self, action):
+        """
+        Return the bucket of an action.
+        """
+        return self._buckets[action_class(action)]
+
+    def set_limit(self, name, rate=None, burst=None):
+        """
+        Change the initial rate or the burst of a class of actions.
+
+        A new rate resets the adaptive rate of the class.
+        """
+        bucket = self._buckets[name]
+        with bucket._lock:
+            if rate is not None and rate != bucket.initial_rate:
+                bucket.initial_rate = bucket.rate = rate
+                bucket.min_rate = min(MIN_RATE, rate)
+                bucket.max_rate = rate * MAX_RATE_FACTOR
+            if burst is not None:
+                bucket.burst = burst
+
+    def stats(self):
+        """
+        Return the counters of each class of actions.
+        """
+        return dict((name, bucket.stats())
+                    for name, bucket in self._buckets.items())
+
+
+_limiter = RateLimiter()
+
+
+def configure(describe_rate=None, describe_burst=None,
+              mutate_rate=None, mutate_burst=None):
+    """
+    Change the limits of the module level limiter.
+    """
+    _limiter.set_limit('describe', describe_rate, describe_burst)
+    _limiter.set_limit('mutate', mutate_rate, mutate_burst)
+
+
+def install(conn):
+    """
+    Send the requests of a boto connection through the module level
+    limiter. Return the connection.
+
+    The limiter wraps the request loop of the connection, _mexe, which
+    retries throttled requests after a backoff, once a new token is
+    available.
+    """
+    if getattr(conn, '_rate_limited', False) or not hasattr(conn, '_mexe'):
+        return conn
+    mexe = conn._mexe
+
+    def limited_mexe(request, sender=None, override_num_retries=None,
+                     retry_handler=None):
+        action = request.params.get('Action')
+        bucket = _limiter.bucket(action)
+        if override_num_retries is None:
+            retries = boto.config.getint('Boto', 'num_retries',
+                                         conn.num_retries)
+        else:
+            retries = override_num_retries
+
+        throttled = [False]
+
+        def handle(response, attempt, next_sleep):
+            if retry_handler is not None:
+                status = retry_handler(response, attempt, next_sleep)
+                if status:
+                    return status
+            throttled[0] = _is_throttled(response)
+            if not throttled[0]:
+                return None
+            bucket.throttled(action)
+            if attempt >= retries:
+                # Left to boto, a 5xx error would be raised after a sleep
+                # of up to a minute.
+                error_class = getattr(conn, 'ResponseError',
+                                      boto.exception.BotoServerError)
+                raise error_class(response.status, response.reason,
+                                  response.read())
+            delay = _backoff_seconds(attempt)
+            bucket.acquire(action)
+            return ('{} throttled, retrying in {:.1f}s'.format(action, delay),
+                    attempt + 1, delay)
+
+        bucket.acquire(action)
+        response = mexe(request, sender, override_num_retries, handle)
+        if not throttled[0]:
+            bucket.succeeded()
+        return response
+
+    conn._mexe = limited_mexe
+    conn._rate_limited = True
+    return conn
+
+
+def stats():
+    """
+    Return the counters of the module level limiter.
+    """
+    return _limiter.stats()
@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+"""
+Tool used to copy an image to other regions.
+
+Copies to all regions are started at once, then polled together until
+they are all available: replication takes as long as the slowest copy
+instead of the sum of all copies. Tags are carried over, and the
+retention of delete_old_images can be applied in each region.
+"""
+import logging
+import sys
+import threading
+import time
+
+import boto.exception
+
+from outscale_factory_buildbot.tools import ec2_pool
+from outscale_factory_buildbot.tools import image_cache
+from outscale_factory_buildbot.tools.delete_images import delete_old_images
+
+
+DEFAULT_POLL_INTERVAL_SECONDS = 30
+DEFAULT_TIMEOUT_SECONDS = 2 * 3600
+
+
+class ReplicationError(Exception):
+
+    """
+    Error raised when a copy fails.
+    """
+
+
+def get_source_image(region, image_id):
+    """
+    Return the image to replicate.
+    """
+    with ec2_pool.connection(region) as conn:
+        return conn.get_image(image_id)
+
+
+def start_copy(region, source_region, image_id, name, description, tags):
+    """
+    Start copying an image to region and tag the copy, return its id.
+    """
+    with ec2_pool.connection(region) as conn:
+        copy = conn.copy_image(source_region, image_id,
+                               name=name, description=description)
+        if tags:
+            conn.create_tags([copy.image_id], tags)
+    image_cache.add_image(
+        region, image_cache.ImageRecord(copy.image_id, name, dict(tags)))
+    return copy.image_id
+
+
+def copy_state(region, image_id):
+    """
+    Return the state of a copy: pending, available or failed.
+    """
+    try:
+        with ec2_pool.connection(region) as conn:
+            images = conn.get_all_images(image_ids=[image_id])
+    except boto.exception.EC2ResponseError as error:
+        if error.error_code == 'InvalidAMIID.NotFound':
+            # A new copy may not be visible yet.
+            return 'pending'
+        raise
+    if not images:
+        return 'pending'
+    return images[0].state
+
+
+class ReplicationReport(object):
+
+    """
+    Outcome of a replication.
+
+    copies: dictionary of region -> image id
+    available: list of regions where the copy is available
+    failed: dictionary of region -> error message
+    """
+
+    def __init__(self):
+        self.copies = {}
+        self.available = []
+        self.failed = {}
+        self._lock = threading.Lock()
+
+    def add_copy(self, region, image_id):
+        with self._lock:
+            self.copies[region] = image_id
+
+    def add_failed(self, region, error):
+        with self._lock:
+            self.failed[region] = str(error)
+
+    def to_dict(self):
+        return dict(
+            copies=dict(self.copies),
+            available=sorted(self.available),
+            failed=dict(self.failed),
+        )
+
+    def summary(self):
+        return '{} available, {} failed'.format(len(self.available),
+                                                len(self.failed))
+
+
+def start_copies(source_region, image, regions, report):
+    """
+    Start all copies concurrently, one thread per region.
+    """
+    def start(region):
+        try:
+            image_id = start_copy(region, source_region, image.id,
+                                  image.name, image.description, image.tags)
+        except Exception as error:
+            logging.error('Could not copy {} to {}: {}'
+                          .format(image.id, region, error))
+            report.add_failed(region, error)
+        else:
+            logging.info('Copying {} to {} as {}'
+                         .format(image.id, region, image_id))
+            report.add_copy(region, image_id)
+
+    threads = [threading.Thread(target=start, args=(region,))
+               for region in regions if region != source_region]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def replicate_image(source_region,
+                    image_id,
+                    regions,
+                    max_versions=None,
+                    poll_interval=DEFAULT_POLL_INTERVAL_SECONDS,
+                    timeout=DEFAULT_TIMEOUT_SECONDS):
+    """
+    Copy an image to regions and wait for all copies.
+
+    With max_versions, old images of the same appliance are then deleted
+    in each region where the copy is available.
+
+    Return a ReplicationReport.
+    """
+    report = ReplicationReport()
+    image = get_source_image(source_region, image_id)
+    start_copies(source_region, image, regions, report)
+
+    pending = dict(report.copies)
+    deadline = time.time() + timeout
+    while pending:
+        for region, copy_id in list(pending.items()):
+            try:
+                state = copy_state(region, copy_id)
+            except Exception as error:
+                logging.warning('Could not check {} in {}: {}'
+                                .format(copy_id, region, error))
+                continue
+            if state == 'available':
+                logging.info('{} available in {}'.format(copy_id, region))
+                report.available.append(region)
+                del pending[region]
+            elif state != 'pending':
+                report.add_failed(region, ReplicationError(
+                    'Copy {} is {}'.format(copy_id, state)))
+                del pending[region]
+        if not pending:
+            break
+        if time.time() > deadline:
+            for region, copy_id in pending.items():
+                report.add_failed(region, ReplicationError(
+                    'Timed out waiting for {}'.format(copy_id)))
+            break
+        time.sleep(poll_interval)
+
+    appliance = image.tags.get('appliance')
+    if max_versions and appliance:
+        for region in report.available:
+            deleted = delete_old_images(region, appliance, max_versions)
+            if deleted.failed:
+                report.add_failed(region, deleted.summary())
+
+    logging.info('Replication of {}: {}'.format(image_id, report.summary()))
+    return report
+
+
+def main():
+    """
+    Main function.
+    """
+    import json
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description='Copy an image to other regions.')
+    parser.add_argument('source_region')
+    parser.add_argument('image_id')
+    parser.add_argument('regions', nargs='+')
+    parser.add_argument('--max-versions', type=int,
+                        help='keep this many images of the appliance '
+                             'in each region')
+    parser.add_argument('--poll-interval', type=float,
+                        default=DEFAULT_POLL_INTERVAL_SECONDS)
+    parser.add_argument('--timeout', type=float,
+                        default=DEFAULT_TIMEOUT_SECONDS)
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(levelname)s: %(message)s',
+                        level=logging.INFO)
+    report = replicate_image(args.source_region, args.image_id, args.regions,
+                             max_versions=args.max_versions,
+                             poll_interval=args.poll_interval,
+                             timeout=args.timeout)
+    json.dump(report.to_dict(), sys.stdout, indent=4, separators=(',', ': '))
+    sys.stdout.write('\n')
+    sys.exit(1 if report.failed else 0)
+
+if __name__ == '__main__':
+    main()
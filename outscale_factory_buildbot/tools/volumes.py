@@ -0,0 +1,144 @@
+"""
+Volume operations used by the buildsteps.
+
+Each function makes a single EC2 call and returns without waiting for the
+volume to change state, so that callers can wait without holding a thread.
+"""
+import string
+
+import boto.exception
+
+
+# Error codes meaning an image does not exist anymore.
+MISSING_IMAGE_ERROR_CODES = frozenset((
+    'InvalidAMIID.NotFound',
+    'InvalidAMIID.Unavailable',
+))
+
+# Error codes meaning a volume does not exist anymore.
+MISSING_VOLUME_ERROR_CODES = frozenset((
+    'InvalidVolume.NotFound',
+))
+
+# Device names tried when attaching a build volume.
+DEVICE_NAMES = ['/dev/xvd' + letter for letter in string.ascii_lowercase[5:16]]
+
+
+class NoFreeDevice(Exception):
+
+    """
+    Error raised when all device names are used on an instance.
+    """
+
+
+def create_volume(conn, size_gib, location, tags, snapshot_id=None):
+    """
+    Create and tag a volume, return its id.
+    """
+    volume = conn.create_volume(size_gib, location, snapshot=snapshot_id)
+    if tags:
+        conn.create_tags([volume.id], tags)
+    return volume.id
+
+
+def image_root_snapshot(conn, image):
+    """
+    Return (snapshot id, size in GiB) of the root device of an image,
+    or (None, None) if the image has no snapshot-backed root device or
+    does not exist anymore.
+
+    The image is fetched again if it lacks a block device mapping, as
+    image_cache.ImageRecord does.
+    """
+    mapping = getattr(image, 'block_device_mapping', None)
+    root_device = getattr(image, 'root_device_name', None)
+    if mapping is None:
+        try:
+            image = conn.get_image(image.id)
+        except boto.exception.EC2ResponseError as error:
+            if error.error_code in MISSING_IMAGE_ERROR_CODES:
+                return None, None
+            raise
+        if image is None:
+            return None, None
+        mapping = image.block_device_mapping
+        root_device = image.root_device_name
+    device = mapping.get(root_device) if mapping else None
+    if device is None and mapping:
+        devices = [each for each in mapping.values() if each.snapshot_id]
+        if len(devices) == 1:
+            device = devices[0]
+    if device is None or not device.snapshot_id:
+        return None, None
+    return device.snapshot_id, device.size
+
+
+def get_volume(conn, volume_id):
+    """
+    Return volume object, or None if the volume does not exist.
+    """
+    volumes = conn.get_all_volumes(filters={'volume-id': volume_id})
+    if not volumes:
+        return None
+    return volumes[0]
+
+
+def volume_status(conn, volume_id):
+    """
+    Return (status, attachment status) of a volume.
+
+    Status is None if the volume does not exist.
+    """
+    volume = get_volume(conn, volume_id)
+    if volume is None:
+        return None, None
+    return volume.status, volume.attachment_state()
+
+
+def free_device(conn, instance_id):
+    """
+    Return a device name not used on an instance.
+    """
+    instance = conn.get_only_instances([instance_id])[0]
+    used = set(instance.block_device_mapping or {})
+    for device in DEVICE_NAMES:
+        if device not in used and device.replace('xvd', 'sd') not in used:
+            return device
+    raise NoFreeDevice('No free device on instance {}'.format(instance_id))
+
+
+def attach_volume(conn, volume_id, instance_id):
+    """
+    Attach a volume to an instance, return the device name.
+    """
+    device = free_device(conn, instance_id)
+    conn.attach_volume(volume_id, instance_id, device)
+    return device
+
+
+def detach_volume(conn, volume_id, force=False):
+    """
+    Detach a volume if it is attached.
+
+    Return False if the volume does not exist.
+    """
+    volume = get_volume(conn, volume_id)
+    if volume is None:
+        return False
+    if volume.attachment_state() in ('attaching', 'attached'):
+        conn.detach_volume(volume_id, force=force)
+    return True
+
+
+def delete_volume(conn, volume_id):
+    """
+    Delete a volume.
+
+    Return False if the volume does not exist anymore.
+    """
+    try:
+        return conn.delete_volume(volume_id)
+    except boto.exception.EC2ResponseError as error:
+        if error.error_code in MISSING_VOLUME_ERROR_CODES:
+            return False
+        raise
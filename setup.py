@@ -4,6 +4,7 @@ scripts = []
 scripts.append('find_images=outscale_factory_buildbot.tools.find_images:main')
 scripts.append('get_image=outscale_factory_buildbot.tools.get_image:main')
 scripts.append('delete_images=outscale_factory_buildbot.tools.delete_images:main')
+scripts.append('replicate_image=outscale_factory_buildbot.tools.replicate_image:main')
 scripts.append('gen_password=outscale_factory_buildbot.tools.gen_password:main')
 
 setup(